@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for each stage of evaluating an expression (strip, parse,
+make_tree, apply, and process end to end), compared against non_OOP_version
+and Python's eval, on generated expressions of controlled length, nesting
+depth, and operator mix
+
+Command line usage, from the project root:
+    python -m benchmarks [--sizes N [N ...]] [--save FILE] [--compare FILE] [--threshold FRACTION]
+Saving writes a JSON baseline. Comparing against one exits with status 1 if
+any stage got slower than the threshold, or scales worse with input size
+"""
+
+from benchmarks.generate import generate
+from benchmarks.run import run_benchmarks, time_stages, fit_scaling, compare
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+Run the benchmarks from the project root with "python -m benchmarks"
+"""
+
+import sys
+
+from benchmarks.run import main
+
+sys.exit(main())
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Generate random, valid expressions of a controlled length, nesting depth, and
+operator mix to benchmark with
+"""
+
+import random
+
+# Binary operators generate can use, as they're written in expressions
+all_ops = '+-*/x^'
+
+def _number(rng, negate):
+    """Returns the text of a random number, about half ints and half floats
+    near 1, so that long chains don't overflow or grow huge ints
+    negate - chance of the number being negated"""
+    if rng.random() < 0.5:
+        text = str(rng.randint(1, 9))
+    else:
+        text = f"{rng.uniform(0.5, 2):.2f}"
+    if negate and rng.random() < negate:
+        text = '-' + text
+    return text
+
+def generate(terms, depth=0, ops='+-*/', negate=0.0, spaces=True, seed=0):
+    """Generate the text of a random expression that operators.process accepts
+    terms - number of numbers in the expression, not counting exponents
+    depth - how deeply parentheses are nested. The terms are shared out
+    evenly between the levels
+    ops - the binary operators to choose from, any of "+-*/x^". "^" is only
+    used to raise single numbers to a small power (2, 3, or 0.5), so values
+    stay finite, and needs at least one other operator to join terms with
+    negate - chance of each number being negated (ex. "2 * -3")
+    spaces - whether to put spaces around binary operators
+    seed - random seed, so the same arguments always give the same text
+    returns the expression text"""
+    if terms < 1:
+        raise ValueError("terms must be at least 1")
+    if depth < 0:
+        raise ValueError("depth can't be negative")
+    if not set(ops) <= set(all_ops):
+        raise ValueError(f"ops must be made of {all_ops!r}, not {ops!r}")
+    joins = [op for op in ops if op != '^'] # Operators that join terms
+    if not joins:
+        raise ValueError("ops needs at least one operator besides ^")
+    power = '^' in ops
+    rng = random.Random(seed)
+    sep = ' ' if spaces else ''
+
+    # Number of terms at each level, outermost first. Leftovers go to the
+    # innermost level, so it always has at least one
+    levels = [terms // (depth+1)] * (depth+1)
+    levels[-1] += terms % (depth+1)
+
+    # Build from the inside out, so deep nesting doesn't need recursion
+    text = None # The innermost levels built so far
+    for count in reversed(levels):
+        items = [_number(rng, negate) for _ in range(count)]
+        if power:
+            items = [f"{item}^{rng.choice(['2', '3', '0.5'])}" if rng.random() < 0.2 else item
+                     for item in items]
+        if text is not None:
+            items.insert(rng.randint(0, count), f"({text})")
+        pieces = [items[0]]
+        for item in items[1:]:
+            pieces.append(f"{sep}{rng.choice(joins)}{sep}{item}")
+        text = ''.join(pieces)
+    return text
+
+def to_python(text):
+    """Convert a generated expression to Python syntax, for eval
+    The value can differ, since negation binds tighter than powers in
+    operators but not in Python, but the amount of work is the same"""
+    return text.replace('x', '*').replace('X', '*').replace('^', '**')
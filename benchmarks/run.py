@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Time each stage of evaluating generated expressions, fit how the time of each
+stage grows with the size of the input, and compare against a saved baseline
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import platform
+import sys
+import time
+
+from bytecode import Program
+from operators import normalize, parse, make_tree, process
+from benchmarks.generate import generate, to_python
+
+with contextlib.redirect_stdout(io.StringIO()):
+    # non_OOP_version runs (and prints) its own examples when imported
+    import non_OOP_version
+
+# Stages timed for each expression, in pipeline order, then the other
+# implementations to compare against
+stages = ('strip', 'parse', 'make_tree', 'apply', 'bytecode', 'process', 'non_oop', 'eval')
+
+# Kinds of expression to time at each size.
+# {name: function of the size (number of terms) returning keyword arguments for generate}
+cases = {'flat': lambda n: {'terms': n},
+         'nested': lambda n: {'terms': n, 'depth': n // 4},
+         'mixed': lambda n: {'terms': n, 'depth': math.isqrt(n), 'ops': '+-*/x^', 'negate': 0.1},
+         }
+
+def _best_time(func, arg, min_time=0.05, repeat=3):
+    """Time func(arg), calling it enough times per run to take at least
+    min_time seconds, and keeping the fastest of repeat runs
+    returns seconds per call, or None if func raises (ex. eval can't handle
+    deep nesting, and non_OOP_version doesn't support every operator)"""
+    try:
+        # Also silences non_OOP_version, which prints input it fails on
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func(arg)
+            once = time.perf_counter() - start
+    except Exception:
+        return None
+    number = max(1, int(min_time / max(once, 1e-9)))
+    best = once
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(arg)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def time_stages(text, min_time=0.05, repeat=3):
+    """Time each stage for one expression
+    text - the expression
+    returns {stage: seconds per call, or None if the stage failed}"""
+    tokens = parse(text)
+    tree = make_tree(tokens)
+    program = Program.from_tree(tree)
+    python_text = to_python(text)
+    funcs = {'strip': normalize, # The whitespace pass used for cache keys
+             'parse': parse,
+             'make_tree': make_tree,
+             'apply': lambda tree: tree.apply(),
+             'bytecode': lambda program: program.run(), # Running an already lowered tree
+             'process': process,
+             'non_oop': non_OOP_version.total_solver,
+             'eval': eval,
+             }
+    args = {'make_tree': tokens, 'apply': tree, 'bytecode': program, 'eval': python_text}
+    return {stage: _best_time(funcs[stage], args.get(stage, text), min_time, repeat)
+            for stage in stages}
+
+def fit_scaling(sizes, times):
+    """Fit times = c * sizes^k by least squares on a log-log scale
+    An exponent near 1 means the stage is linear in the input size, near 2
+    quadratic
+    returns k, or None if there are fewer than two usable points"""
+    points = [(math.log(size), math.log(t)) for size, t in zip(sizes, times) if t]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x)**2 for x, _ in points)
+    if not spread:
+        return None
+    return sum((x - mean_x)*(y - mean_y) for x, y in points) / spread
+
+def run_benchmarks(sizes=(100, 1000, 10000), case_names=None, min_time=0.05, repeat=3, progress=None):
+    """Time every stage for each case at each size
+    sizes - numbers of terms to generate expressions with
+    case_names - names of the cases to run (see cases). None for all
+    progress - called with a message before each expression is timed
+    returns a dict, ready to save as JSON, of
+    {'results': {case: {size: {stage: seconds}}}, 'scaling': {case: {stage: exponent}}, ...}
+    Sizes are strings, since JSON keys have to be"""
+    sizes = sorted(sizes)
+    results = {}
+    scaling = {}
+    for name in (cases if case_names is None else case_names):
+        results[name] = {}
+        for size in sizes:
+            if progress is not None:
+                progress(f"{name} {size}")
+            text = generate(**cases[name](size))
+            results[name][str(size)] = time_stages(text, min_time, repeat)
+        scaling[name] = {stage: fit_scaling(sizes, [results[name][str(size)][stage] for size in sizes])
+                         for stage in stages}
+    return {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'sizes': sizes,
+            'results': results,
+            'scaling': scaling,
+            }
+
+def compare(current, baseline, threshold=0.25, scaling_threshold=0.2):
+    """Find regressions from baseline to current (both from run_benchmarks)
+    threshold - how much slower (as a fraction) a stage can get before it's a
+    regression
+    scaling_threshold - how much a scaling exponent can grow before it's a
+    regression (ex. a linear stage becoming quadratic)
+    Only cases, sizes, and stages timed in both are compared
+    returns a list of messages, one per regression"""
+    regressions = []
+    for name, by_size in current['results'].items():
+        for size, times in by_size.items():
+            old_times = baseline['results'].get(name, {}).get(size, {})
+            for stage, new in times.items():
+                old = old_times.get(stage)
+                if old and new and new > old * (1 + threshold):
+                    regressions.append(f"{name} {size} {stage}: {old*1e3:.3f} ms -> {new*1e3:.3f} ms ({new/old:.2f}x)")
+        for stage, new in current['scaling'].get(name, {}).items():
+            old = baseline.get('scaling', {}).get(name, {}).get(stage)
+            if old is not None and new is not None and new > old + scaling_threshold:
+                regressions.append(f"{name} {stage} scaling: n^{old:.2f} -> n^{new:.2f}")
+    return regressions
+
+def format_report(report):
+    """Format the results of run_benchmarks as a table, in milliseconds"""
+    lines = ['case      size  ' + ''.join(f"{stage:>11}" for stage in stages)]
+    for name, by_size in report['results'].items():
+        for size, times in by_size.items():
+            cells = ''.join(f"{'-':>11}" if times[stage] is None else f"{times[stage]*1e3:11.3f}"
+                            for stage in stages)
+            lines.append(f"{name:<8}{size:>6}  {cells}")
+        exponents = report['scaling'][name]
+        cells = ''.join(f"{'-':>11}" if exponents[stage] is None else f"{'n^':>6}{exponents[stage]:<5.2f}"
+                        for stage in stages)
+        lines.append(f"{name:<8}{'scale':>6}  {cells}")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    """Command line entry point. Returns the exit status: 1 if compared
+    against a baseline and anything regressed, 0 otherwise"""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description="Time each stage of expression evaluation")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='numbers of terms to generate expressions with')
+    parser.add_argument('--cases', nargs='+', choices=list(cases), help='cases to run (default all)')
+    parser.add_argument('--min-time', type=float, default=0.05, help='seconds per timing run')
+    parser.add_argument('--save', help='write the results to this JSON file, as a new baseline')
+    parser.add_argument('--compare', help='JSON baseline to check for regressions against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    progress = lambda message: print(message, file=sys.stderr)
+    report = run_benchmarks(args.sizes, args.cases, args.min_time, progress=progress)
+    print(format_report(report))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if not args.compare:
+        return 0
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, args.threshold)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    return 1 if regressions else 0
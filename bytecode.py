@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Lower a syntax tree into flat postfix bytecode, and run it on a small stack
+machine
+Applying a tree calls a method, checks operand types, and builds an argument
+list at every node. A Program is built once from the tree and then only runs
+one loop over two arrays (opcodes and their arguments), pushing and popping
+plain values, which is several times faster for repeat evaluation
+"""
+
+from array import array
+
+from operators import MyOp, MyNaryOp, Expression, Num, Placeholder, OpenParen, Add, Sub, Mul, Div, Neg
+from operators import compile as compile_expression
+
+# Opcodes. Each instruction is an opcode and one argument (0 when unused)
+CONST = 0 # Push constants[arg]
+LOAD = 1 # Push the value bound to placeholder keys[arg]
+ADD = 2 # Pop b, replace a on top with a + b
+SUB = 3 # a - b
+MUL = 4 # a * b
+DIV = 5 # a / b
+NEG = 6 # Replace a on top with -a
+CALL = 7 # Pop the n operands of calls[arg] = (func, n), push func(*operands)
+APPLY = 8 # Push constants[arg].apply(bindings), for MyOps with no operands
+
+opnames = ('CONST', 'LOAD', 'ADD', 'SUB', 'MUL', 'DIV', 'NEG', 'CALL', 'APPLY')
+
+# Opcode for each operator with its own instruction. Only exactly these
+# classes, since subclasses could change func
+_opcodes = {Add: ADD,
+            Sub: SUB,
+            Mul: MUL,
+            Div: DIV,
+            Neg: NEG,
+            }
+
+class Program:
+    """Postfix bytecode for one syntax tree, ready to run any number of times
+    Create with compile_program
+    Holds no MyOps except operators that can only be applied as themselves
+    (ex. the child groups of incremental.Document), so it takes much less
+    memory than the tree"""
+    __slots__ = ('ops', 'args', 'constants', 'keys', 'calls')
+
+    def __init__(self, ops, args, constants, keys, calls):
+        """ops - array of opcodes
+        args - array of the argument of each opcode
+        constants - values (and MyOps, for APPLY) that CONST pushes
+        keys - placeholder keys that LOAD looks up
+        calls - (func, number of operands) for each operator that CALL applies"""
+        self.ops = ops
+        self.args = args
+        self.constants = constants
+        self.keys = keys
+        self.calls = calls
+
+    def __len__(self):
+        """Number of instructions"""
+        return len(self.ops)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({len(self)} instructions)"
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Lower a syntax tree to bytecode
+        Operands are emitted before their operator (postorder), so running the
+        instructions in order applies the tree. Parentheses emit nothing. Uses
+        an explicit stack instead of recursion, so deep trees work
+        tree - the root MyOp of a syntax tree
+        returns a Program"""
+        ops = array('B')
+        args = array('q')
+        constants = []
+        constant_index = {} # {(type, repr): index} of values in constants, so repeats share a slot
+        keys = []
+        key_index = {}
+        calls = []
+        todo = [tree] # MyOps still to emit, last first
+        while todo:
+            item = todo.pop()
+            if item.__class__ is tuple:
+                # All operands have been emitted, emit the operator
+                op_class, func, n = item
+                opcode = _opcodes.get(op_class)
+                if opcode is not None:
+                    ops.append(opcode)
+                    args.append(0)
+                elif op_class is not OpenParen:
+                    ops.append(CALL)
+                    args.append(len(calls))
+                    calls.append((func, n))
+                continue
+
+            if not isinstance(item, MyOp) or item.__class__ is Num:
+                value = item.value if isinstance(item, Num) else item
+                key = (value.__class__, repr(value)) # Not by equality, which would merge 0.0 and -0.0
+                if key not in constant_index:
+                    constant_index[key] = len(constants)
+                    constants.append(value)
+                ops.append(CONST)
+                args.append(constant_index[key])
+                continue
+
+            if isinstance(item, Placeholder):
+                if item.key not in key_index:
+                    key_index[item.key] = len(keys)
+                    keys.append(item.key)
+                ops.append(LOAD)
+                args.append(key_index[item.key])
+                continue
+
+            operands = item.operands()
+            if not operands:
+                # Some other operand, ex. a constant operator
+                ops.append(APPLY)
+                args.append(len(constants))
+                constants.append(item)
+            elif isinstance(item, MyNaryOp) and item.binary in _opcodes:
+                # Chain of a binary operator with its own opcode. Emit it
+                # after each term but the first instead ("1 2 + 3 +" for "1+2+3")
+                binary = (item.binary, item.binary.func, 2)
+                pieces = [operands[0]]
+                for term in operands[1:]:
+                    pieces.append(term)
+                    pieces.append(binary)
+                todo.extend(reversed(pieces))
+            else:
+                todo.append((item.__class__, item.func, len(operands)))
+                todo.extend(reversed(operands))
+        return cls(ops, args, constants, keys, calls)
+
+    def run(self, bindings=None):
+        """Run the program, equivalent to applying the tree it was made from
+        bindings - values for any Placeholders (see Placeholder)
+        returns the value of the expression"""
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        constants = self.constants
+        # Most common instructions first
+        for op, arg in zip(self.ops, self.args):
+            if op == CONST:
+                push(constants[arg])
+            elif op == ADD:
+                b = pop()
+                stack[-1] = stack[-1] + b
+            elif op == MUL:
+                b = pop()
+                stack[-1] = stack[-1] * b
+            elif op == SUB:
+                b = pop()
+                stack[-1] = stack[-1] - b
+            elif op == DIV:
+                b = pop()
+                stack[-1] = stack[-1] / b
+            elif op == LOAD:
+                key = self.keys[arg]
+                try:
+                    push(bindings[key])
+                except (KeyError, IndexError, TypeError):
+                    key = '' if key is None else key
+                    raise ValueError(f"No value given for placeholder {{{key}}}")
+            elif op == NEG:
+                stack[-1] = -stack[-1]
+            elif op == CALL:
+                func, n = self.calls[arg]
+                if n == 2:
+                    b = pop()
+                    stack[-1] = func(stack[-1], b)
+                elif n == 1:
+                    stack[-1] = func(stack[-1])
+                else:
+                    operands = stack[-n:]
+                    del stack[-n:]
+                    push(func(*operands))
+            else:
+                push(constants[arg].apply(bindings))
+        return stack[0]
+
+    def disassemble(self):
+        """returns the instructions as text, one per line, for debugging"""
+        lines = []
+        for i, (op, arg) in enumerate(zip(self.ops, self.args)):
+            if op == CONST:
+                detail = repr(self.constants[arg])
+            elif op == LOAD:
+                detail = f"{{{'' if self.keys[arg] is None else self.keys[arg]}}}"
+            elif op == CALL:
+                func, n = self.calls[arg]
+                detail = f"{getattr(func, '__qualname__', func)} ({n})"
+            elif op == APPLY:
+                detail = repr(self.constants[arg])
+            else:
+                detail = ''
+            lines.append(f"{i:>4} {opnames[op]:<6}{detail}".rstrip())
+        return '\n'.join(lines)
+
+def compile_program(expr):
+    """Lower an expression to a Program
+    expr - an Expression (from operators.compile), the root MyOp of a syntax
+    tree, or the text of an expression
+    returns a Program, whose run method takes the same bindings as
+    Expression.evaluate"""
+    if isinstance(expr, str):
+        expr = compile_expression(expr)
+    tree = expr.tree if isinstance(expr, Expression) else expr
+    return Program.from_tree(tree)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Size-bounded LRU cache in front of process, for traffic where the same
+expressions come up over and over
+"""
+
+from collections import OrderedDict, namedtuple
+import sys
+
+from operators import MyOp, normalize, parse, make_tree
+
+# Snapshot of the cache counters, returned by ProcessCache.info
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'entries', 'nbytes'])
+
+def _tree_size(tree):
+    """Approximate memory used by a syntax tree, in bytes"""
+    total = 0
+    todo = [tree] # Explicit stack, so deep trees can't hit the recursion limit
+    while todo:
+        item = todo.pop()
+        total += sys.getsizeof(item)
+        if isinstance(item, MyOp):
+            if hasattr(item, '__dict__'):
+                # Only MyOps defined without __slots__ have one
+                total += sys.getsizeof(item.__dict__)
+            todo.extend(getattr(item, field) for field in item._fields)
+    return total
+
+class ProcessCache:
+    """Least-recently-used cache of process results, keyed on the normalized
+    text of the expression (see operators.normalize)
+    ValueErrors from invalid input are cached and raised again on a hit, so
+    bad input isn't re-parsed either. Other exceptions (ex. ZeroDivisionError)
+    are not cached
+    Entries are evicted, least recently used first, once there are more than
+    maxsize of them or they use more than maxbytes (approximately)"""
+
+    # What each entry can hold
+    stores = ('value', 'tree')
+
+    def __init__(self, maxsize=1024, maxbytes=None, store='value'):
+        """maxsize - maximum number of entries, or None for no limit
+        maxbytes - maximum approximate size of all entries in bytes, or None for no limit
+        store - 'value' to cache the result of each expression, or 'tree' to
+        cache its syntax tree and apply it on every call"""
+        if store not in self.stores:
+            raise ValueError(f"store must be one of {self.stores}, not {store!r}")
+        self.store = store
+        self._entries = OrderedDict() # {key: (is_error, value or tree or ValueError, nbytes)}, least recent first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0 # Approximate size of all entries
+        self.resize(maxsize, maxbytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def process(self, text):
+        """Equivalent to operators.process, but uses the cache
+        text - string representing an arithmetic expression to evaluate
+        returns the value of text"""
+        key = normalize(text)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._add(key, text)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key) # Most recently used
+        is_error, cached, _ = entry
+
+        if is_error:
+            raise cached
+        if self.store == 'tree':
+            return cached.apply()
+        return cached
+
+    def _add(self, key, text):
+        """Evaluate (or build the tree for) text and add the result to the
+        cache under key, its normalized text
+        returns the new entry"""
+        try:
+            tree = make_tree(parse(text))
+            cached = tree if self.store == 'tree' else tree.apply()
+        except ValueError as e:
+            is_error, cached, nbytes = True, e, sys.getsizeof(e) + sys.getsizeof(str(e))
+        else:
+            is_error = False
+            nbytes = _tree_size(cached) if self.store == 'tree' else sys.getsizeof(cached)
+        nbytes += sys.getsizeof(key)
+
+        entry = (is_error, cached, nbytes)
+        self._entries[key] = entry
+        self.nbytes += nbytes
+        self._evict()
+        return entry
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits its limits"""
+        entries = self._entries
+        while entries and ((self.maxsize is not None and len(entries) > self.maxsize)
+                           or (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            _, (_, _, nbytes) = entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def resize(self, maxsize=None, maxbytes=None):
+        """Change the limits, evicting entries right away if needed
+        maxsize - maximum number of entries, or None for no limit
+        maxbytes - maximum approximate size of all entries in bytes, or None for no limit"""
+        if maxsize is not None and maxsize < 0:
+            raise ValueError("maxsize can't be negative")
+        if maxbytes is not None and maxbytes < 0:
+            raise ValueError("maxbytes can't be negative")
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._evict()
+
+    def clear(self):
+        """Remove every entry. Counters are kept"""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """Returns a CacheInfo with the current counters and size"""
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self._entries), self.nbytes)
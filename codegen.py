@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Compile a syntax tree into a native Python function, for formulas that are
+evaluated very often
+The function is built as a Python AST from the tree (never from the text of
+the expression, which is only ever read by parse), so input is validated
+exactly as by process, and operators keep their meaning here (ex. "x" is Mul,
+"^" is Pow, and Neg binds tighter than Pow)
+"""
+
+import ast
+
+from operators import MyOp, MyNaryOp, Expression, Num, Placeholder, OpenParen, Add, Sub, Mul, Div, Neg
+from operators import compile as compile_expression
+
+# Python operator for each operator that is exactly one. Only exactly these
+# classes, since subclasses could change func. Everything else (ex. Pow, for
+# its limit check) calls its func
+_binary_ops = {Add: ast.Add,
+               Sub: ast.Sub,
+               Mul: ast.Mult,
+               Div: ast.Div,
+               }
+
+# Deepest an expression in the generated code gets before it's stored in a
+# variable and continued from there. CPython's compiler recurses on nested
+# expressions, and fails somewhere below 1000 levels
+max_expression_depth = 50
+
+class Function:
+    """A syntax tree compiled to a Python function. Create with compile_function
+    Call it with the same values as Expression.evaluate, or call func directly
+    with the value of each of keys, in order, to skip looking them up"""
+    __slots__ = ('func', 'keys', 'source')
+
+    def __init__(self, func, keys, source):
+        """func - the compiled function, taking one argument per key
+        keys - keys of the Placeholders, in the order func takes them
+        source - Python source of func, for reading"""
+        self.func = func
+        self.keys = keys
+        self.source = source
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.source})"
+
+    def __call__(self, values=()):
+        """Evaluate the expression
+        values - the numbers to use for the placeholders. A list for positional
+        placeholders, or a dict for named (and/or positional) ones
+        returns the value of the expression"""
+        if not self.keys:
+            return self.func()
+        args = []
+        for key in self.keys:
+            try:
+                args.append(values[key])
+            except (KeyError, IndexError, TypeError):
+                key = '' if key is None else key
+                raise ValueError(f"No value given for placeholder {{{key}}}")
+        return self.func(*args)
+
+class _Builder:
+    """Builds the AST of a lambda equivalent to a syntax tree, along with the
+    namespace it needs"""
+    def __init__(self):
+        self.namespace = {'__builtins__': {}} # Values the code refers to by name. No builtins
+        self.names = {} # {id of value: its name in namespace}
+        self.keys = [] # Placeholder keys, one parameter each
+        self.params = {} # {key: parameter name}
+        self.steps = [] # Expressions stored in variables so far, in order
+
+    def refer(self, value, prefix):
+        """returns an AST name for value, adding it to the namespace"""
+        name = self.names.get(id(value))
+        if name is None:
+            name = self.names[id(value)] = f"{prefix}{len(self.names)}"
+            self.namespace[name] = value
+        return ast.Name(name, ast.Load())
+
+    def leaf(self, item):
+        """returns the AST of an operand with no operands of its own"""
+        if isinstance(item, Placeholder):
+            if item.key not in self.params:
+                self.params[item.key] = f"_v{len(self.keys)}"
+                self.keys.append(item.key)
+            return ast.Name(self.params[item.key], ast.Load())
+        value = item.value if item.__class__ is Num else item
+        if isinstance(value, MyOp):
+            # Some other operand, ex. a constant operator
+            return ast.Call(self.refer(value.apply, '_f'), [], [])
+        if value.__class__ in (int, float) and repr(value)[0].isdigit():
+            return ast.Constant(value)
+        # Negative, inf, nan, or another type (ex. Decimal) that isn't a literal
+        return self.refer(value, '_c')
+
+    def node(self, item, operands):
+        """returns the AST applying item to the ASTs of its operands"""
+        cls = item.__class__
+        if cls in _binary_ops:
+            return ast.BinOp(operands[0], _binary_ops[cls](), operands[1])
+        if cls is Neg:
+            return ast.UnaryOp(ast.USub(), operands[0])
+        if cls is OpenParen:
+            # Parentheses are already in the structure of the tree
+            return operands[0]
+        if isinstance(item, MyNaryOp) and item.binary in _binary_ops:
+            # Same as the chain of binary operators, left to right
+            out = operands[0]
+            for operand in operands[1:]:
+                out = self.spill(ast.BinOp(out, _binary_ops[item.binary](), operand))
+            return out
+        return ast.Call(self.refer(item.func, '_f'), list(operands), [])
+
+    def spill(self, expr):
+        """Store expr in a variable if it's getting too deep
+        returns expr, or the name of the variable"""
+        if _depth(expr) <= max_expression_depth:
+            return expr
+        name = f"_t{len(self.steps)}"
+        self.steps.append(ast.NamedExpr(ast.Name(name, ast.Store()), expr))
+        return ast.Name(name, ast.Load())
+
+    def build(self, tree):
+        """returns the AST of a lambda taking one argument per key, and
+        returning the value of tree"""
+        values = [] # ASTs of the operands built so far, in postorder
+        todo = [tree] # MyOps still to build, last first. Explicit stack, so deep trees work
+        while todo:
+            item = todo.pop()
+            if item.__class__ is tuple:
+                # All operands have been built
+                item, n = item
+                operands = values[-n:]
+                del values[-n:]
+                values.append(self.spill(self.node(item, operands)))
+            elif not isinstance(item, MyOp):
+                values.append(self.leaf(Num(item)))
+            else:
+                operands = item.operands()
+                if operands:
+                    todo.append((item, len(operands)))
+                    todo.extend(reversed(operands))
+                else:
+                    values.append(self.leaf(item))
+        body = values[0]
+        if self.steps:
+            # Assign the variables in order, then take the last item
+            body = ast.Subscript(ast.Tuple(self.steps + [body], ast.Load()), ast.Constant(-1), ast.Load())
+        params = ast.arguments(posonlyargs=[], args=[ast.arg(self.params[key]) for key in self.keys],
+                               kwonlyargs=[], kw_defaults=[], defaults=[])
+        return ast.Expression(ast.Lambda(params, body))
+
+def _depth(expr):
+    """returns how deeply the generated expression expr nests, counting only
+    the operations built from the tree. Cached on each node"""
+    depth = getattr(expr, '_depth', None)
+    if depth is None:
+        if isinstance(expr, ast.BinOp):
+            depth = max(_depth(expr.left), _depth(expr.right)) + 1
+        elif isinstance(expr, ast.UnaryOp):
+            depth = _depth(expr.operand) + 1
+        elif isinstance(expr, ast.Call):
+            depth = max(map(_depth, expr.args), default=0) + 1
+        else:
+            depth = 0
+        expr._depth = depth
+    return depth
+
+def compile_function(expr):
+    """Compile an expression to a Python function
+    expr - an Expression (from operators.compile), the root MyOp of a syntax
+    tree, or the text of an expression
+    returns a Function, which gives the same values as Expression.evaluate"""
+    if isinstance(expr, str):
+        expr = compile_expression(expr)
+    tree = expr.tree if isinstance(expr, Expression) else expr
+    builder = _Builder()
+    module = ast.fix_missing_locations(builder.build(tree))
+    code = compile(module, '<expression>', 'eval')
+    # Only ever code generated above, with no builtins
+    func = eval(code, builder.namespace)
+    return Function(func, tuple(builder.keys), ast.unparse(module))
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of compiled expressions in a local file, so short-lived
+processes can load the expressions they've seen before instead of parsing
+them and building their trees again
+
+File format (all integers little-endian), version 1:
+    header - magic b'OPXC', format version (u16), 0 (u16), fingerprint of the
+             operator set (16 bytes), number of entries (u32)
+    index - per entry, sorted by key hash: key hash (u64), offset (u64),
+            length (u32) of its record
+    records - per entry: normalized text, placeholder keys, and the syntax
+              tree in postorder, each node a class number (u8, its place in
+              the operator table) followed by its data (Num value,
+              Placeholder key, or number of terms of an n-ary node)
+Values are tagged: b'i' int (u32 length, signed bytes), b'f' float (f64),
+b'd' Decimal and b'q' Fraction (as text), b's' str, b'n' None
+Nothing is pickled, so a cache file can't run code when it's loaded
+
+The fingerprint covers each operator's class, token, operands, function, and
+precedence. A file written with a different operator set (ex. after
+register_operator) is ignored, and replaced on the next save. Files are only
+ever replaced whole (written to a temporary file and renamed over the old
+one), so any number of processes can read one while another saves it
+"""
+
+from decimal import Decimal
+from fractions import Fraction
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+import operators
+from operators import MyOp, MyEnclosingOp, Expression, Num, Placeholder, normalize
+from operators import compile as compile_expression
+
+_magic = b'OPXC'
+format_version = 1
+
+_header = struct.Struct('<4sHH16sI') # magic, version, 0, fingerprint, number of entries
+_index_entry = struct.Struct('<QQI') # key hash, offset, length
+_u32 = struct.Struct('<I')
+_f64 = struct.Struct('<d')
+
+class _Unstorable(Exception):
+    """Raised encoding a tree that the format can't hold (ex. an unregistered
+    operator, or a value of another type)"""
+
+def _operator_table():
+    """returns the classes that trees can be made of, in a fixed order, and
+    the fingerprint of the operator set"""
+    classes = list(operators.parse_order) + [nary for nary in operators._nary_classes.values()
+                                             if nary not in operators.parse_order]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{format_version}".encode())
+    for cls in classes:
+        rank = operators._precedence.get(cls)
+        func = cls.__dict__.get('func', cls.func)
+        func = getattr(func, '__func__', func) # Unwrap staticmethods
+        digest.update(repr((cls.__module__, cls.__qualname__,
+                            None if cls.token is None else cls.token.pattern,
+                            cls.nleft, cls.nright, cls.nary, rank,
+                            getattr(func, '__module__', None), getattr(func, '__qualname__', repr(func)),
+                            )).encode())
+    return classes, digest.digest()
+
+def _key_hash(key):
+    """returns the 64-bit hash of a normalized text that entries are found by"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+def _pack_value(value, out):
+    """Append the tagged encoding of value to the bytearray out"""
+    cls = value.__class__
+    if cls is int:
+        raw = value.to_bytes(value.bit_length() // 8 + 1, 'little', signed=True)
+        out += b'i' + _u32.pack(len(raw)) + raw
+    elif cls is float:
+        out += b'f' + _f64.pack(value)
+    elif value is None:
+        out += b'n'
+    elif cls in (str, Decimal, Fraction):
+        raw = str(value).encode()
+        out += {str: b's', Decimal: b'd', Fraction: b'q'}[cls] + _u32.pack(len(raw)) + raw
+    else:
+        raise _Unstorable(f"Can't store a {cls.__name__}")
+
+def _unpack_value(data, pos):
+    """Read a tagged value from data at pos
+    returns the value and the position after it"""
+    tag = data[pos:pos+1]
+    pos += 1
+    if tag == b'f':
+        return _f64.unpack_from(data, pos)[0], pos + 8
+    if tag == b'n':
+        return None, pos
+    length = _u32.unpack_from(data, pos)[0]
+    raw = data[pos+4:pos+4+length]
+    pos += 4 + length
+    if tag == b'i':
+        return int.from_bytes(raw, 'little', signed=True), pos
+    text = bytes(raw).decode()
+    if tag == b's':
+        return text, pos
+    if tag == b'd':
+        return Decimal(text), pos
+    if tag == b'q':
+        return Fraction(text), pos
+    raise ValueError(f"Corrupt cache record, unknown value tag {tag!r}")
+
+def _pack_record(key, expr, tags):
+    """Encode one entry
+    key - normalized text of the expression
+    expr - its Expression
+    tags - {MyOp class: class number}
+    returns the record as bytes. Raises _Unstorable if it can't be stored"""
+    out = bytearray()
+    _pack_value(key, out)
+    out += _u32.pack(len(expr.keys))
+    for placeholder_key in expr.keys:
+        _pack_value(placeholder_key, out)
+    todo = [expr.tree] # Nodes still to write, last first. Operators come after their operands
+    while todo:
+        item = todo.pop()
+        if item.__class__ is tuple:
+            # Operands written, write the operator
+            item = item[0]
+            out.append(tags[item.__class__])
+            if item.nary:
+                out += _u32.pack(len(item.terms))
+            continue
+        if not isinstance(item, MyOp):
+            # Plain value as an operand (ex. from simplify), stored as a Num
+            out.append(tags[Num])
+            _pack_value(item, out)
+            continue
+        if item.__class__ not in tags:
+            raise _Unstorable(f"Can't store {item!r}")
+        operands = item.operands()
+        if operands:
+            todo.append((item,))
+            todo.extend(reversed(operands))
+            continue
+        out.append(tags[item.__class__])
+        if item.__class__ is Num:
+            _pack_value(item.value, out)
+        elif isinstance(item, Placeholder):
+            _pack_value(item.key, out)
+    return bytes(out)
+
+# How _unpack_record builds each kind of node
+_NUM, _PLACEHOLDER, _NARY, _ENCLOSING, _OPERATOR = range(5)
+
+def _node_kinds(classes):
+    """returns the kind of node (_NUM, ...) for each class in an operator table"""
+    kinds = []
+    for cls in classes:
+        if cls is Num:
+            kinds.append(_NUM)
+        elif issubclass(cls, Placeholder):
+            kinds.append(_PLACEHOLDER)
+        elif cls.nary:
+            kinds.append(_NARY)
+        elif issubclass(cls, MyEnclosingOp):
+            kinds.append(_ENCLOSING)
+        else:
+            kinds.append(_OPERATOR)
+    return kinds
+
+def _unpack_record(data, pos, end, classes, kinds):
+    """Decode one entry from data[pos:end]
+    classes - the operator table it was written with
+    kinds - _node_kinds(classes)
+    returns the normalized text and the Expression"""
+    key, pos = _unpack_value(data, pos)
+    count = _u32.unpack_from(data, pos)[0]
+    pos += 4
+    keys = []
+    for _ in range(count):
+        placeholder_key, pos = _unpack_value(data, pos)
+        keys.append(placeholder_key)
+    stack = [] # Subtrees decoded so far
+    while pos < end:
+        tag = data[pos]
+        cls = classes[tag]
+        kind = kinds[tag]
+        pos += 1
+        if kind == _OPERATOR:
+            right = stack.pop() if cls.nright else None
+            left = stack.pop() if cls.nleft else None
+            stack.append(cls(left, right))
+        elif kind == _NUM:
+            value, pos = _unpack_value(data, pos)
+            stack.append(Num.of(value))
+        elif kind == _PLACEHOLDER:
+            placeholder_key, pos = _unpack_value(data, pos)
+            stack.append(cls(placeholder_key))
+        elif kind == _NARY:
+            n = _u32.unpack_from(data, pos)[0]
+            pos += 4
+            terms = stack[-n:]
+            del stack[-n:]
+            stack.append(cls(*terms))
+        else:
+            stack[-1] = cls(stack[-1])
+    if len(stack) != 1:
+        raise ValueError("Corrupt cache record, tree didn't come out to one node")
+    return key, Expression(stack[0], keys)
+
+class DiskCache:
+    """Compiled expressions (see operators.compile) stored in a file by their
+    normalized text. Lookups read the memory-mapped file, and only decode the
+    entry asked for, so opening even a large cache is nearly instant
+    New expressions are kept in memory until save (or the end of a with block)
+    Usage:
+        with DiskCache('expressions.cache') as cache:
+            expr = cache.compile('{rate} * ({base} + 2)') # From the file if it's there
+            expr.evaluate({'rate': 1.5, 'base': 4})"""
+    def __init__(self, path):
+        """path - the cache file. It doesn't have to exist yet"""
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._new = {} # {normalized text: Expression} not in the file yet
+        self._file = None
+        self._map = None
+        self._count = 0 # Entries in the file
+        self._classes = None # Operator table the file was written with, if it matches the current one
+        self._kinds = None # _node_kinds(self._classes)
+        self._fingerprint = None # Fingerprint of the operator set the file was written with
+        self._table = None # (parse_order, prec_order, classes, fingerprint) of the current registry
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.save()
+        self.close()
+
+    def __len__(self):
+        """Number of entries in the file, plus new ones not saved yet"""
+        return self._count + len(self._new)
+
+    def __contains__(self, text):
+        return self.get(text) is not None
+
+    def _current_table(self):
+        """returns the operator table and fingerprint for the operators
+        registered now, only recomputed when the registry changes"""
+        table = self._table
+        if table is None or table[0] is not operators.parse_order or table[1] is not operators.prec_order:
+            table = self._table = (operators.parse_order, operators.prec_order, *_operator_table())
+        return table[2], table[3]
+
+    def _open(self):
+        """Map the file, if it exists and was written with the current operators"""
+        self._count = 0
+        self._classes = None
+        try:
+            self._file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self.close()
+            return
+        classes, fingerprint = self._current_table()
+        if self._map.size() < _header.size:
+            return
+        magic, version, _, file_fingerprint, count = _header.unpack_from(self._map, 0)
+        if magic == _magic and version == format_version and file_fingerprint == fingerprint:
+            self._classes = classes
+            self._kinds = _node_kinds(classes)
+            self._count = count
+            self._fingerprint = fingerprint
+
+    def close(self):
+        """Unmap and close the file. New entries that weren't saved are kept,
+        and get saved by a later save"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._count = 0
+        self._classes = None
+
+    def _find(self, key):
+        """returns (offset, length) of the record for key in the file, or None"""
+        if not self._count or self._current_table()[1] != self._fingerprint:
+            # Empty, or the operators changed since the file was written
+            return None
+        target = _key_hash(key)
+        data = self._map
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if _index_entry.unpack_from(data, _header.size + middle*_index_entry.size)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        # Check every entry with the same hash (a collision is very unlikely)
+        while low < self._count:
+            key_hash, offset, length = _index_entry.unpack_from(data, _header.size + low*_index_entry.size)
+            if key_hash != target:
+                break
+            stored_key, _ = _unpack_value(data, offset)
+            if stored_key == key:
+                return offset, length
+            low += 1
+        return None
+
+    def get(self, text):
+        """Look up the compiled expression for text
+        text - string representing an arithmetic expression
+        returns an Expression, or None if text isn't cached"""
+        key = normalize(text)
+        expr = self._new.get(key)
+        if expr is None:
+            found = self._find(key)
+            if found is not None:
+                offset, length = found
+                expr = _unpack_record(self._map, offset, offset + length, self._classes, self._kinds)[1]
+        if expr is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return expr
+
+    def compile(self, text):
+        """Equivalent to operators.compile(text), but loaded from the cache if
+        it's there, and added to it (when saved) if it isn't
+        Invalid text raises a ValueError, as with compile, and isn't cached"""
+        expr = self.get(text)
+        if expr is None:
+            key = normalize(text)
+            expr = self._new[key] = compile_expression(text)
+        return expr
+
+    def add(self, text, expr=None):
+        """Add the compiled expression for text, to be written on the next save
+        expr - its Expression. None to compile text"""
+        key = normalize(text)
+        self._new[key] = compile_expression(text) if expr is None else expr
+
+    def save(self):
+        """Write the file with every entry, old and new, replacing it in one
+        step. Entries that can't be stored (ex. with unregistered operators)
+        are left out. Does nothing if there is nothing new"""
+        if not self._new:
+            return
+        classes, fingerprint = self._current_table()
+        tags = {cls: tag for tag, cls in enumerate(classes)}
+        if len(classes) > 256:
+            raise ValueError("Too many operators registered to store, the limit is 256")
+
+        records = {} # {key hash: [(key, record bytes)]}
+        if self._count and self._fingerprint == fingerprint:
+            # Old entries are copied over without decoding them
+            data = self._map
+            for i in range(self._count):
+                key_hash, offset, length = _index_entry.unpack_from(data, _header.size + i*_index_entry.size)
+                key, _ = _unpack_value(data, offset)
+                if key not in self._new:
+                    records.setdefault(key_hash, []).append((key, data[offset:offset+length]))
+        for key, expr in self._new.items():
+            try:
+                records.setdefault(_key_hash(key), []).append((key, _pack_record(key, expr, tags)))
+            except _Unstorable:
+                continue
+
+        entries = sorted((key_hash, record) for key_hash, group in records.items() for _, record in group)
+        offset = _header.size + len(entries)*_index_entry.size
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.cache-')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(_header.pack(_magic, format_version, 0, fingerprint, len(entries)))
+                for key_hash, record in entries:
+                    f.write(_index_entry.pack(key_hash, offset, len(record)))
+                    offset += len(record)
+                for _, record in entries:
+                    f.write(record)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.close()
+        self._new = {}
+        self._open()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental re-evaluation of an expression as its text is edited (ex. in an
+editor, on every keystroke)
+The text is split into parenthesized groups. Each group keeps its own tokens,
+syntax tree, and value, with its child groups standing in as single operands.
+An edit only re-lexes the text around it, rebuilds the tree of the smallest
+group containing it, and re-applies the groups from there up to the outermost
+"""
+
+import re
+
+from operators import MyOp, Neg, Sub, parse, make_tree, make_group_tree
+
+# Parentheses are the only tokens that change the group structure
+_parens = re.compile(r'[()]')
+
+class _GroupValue(MyOp):
+    """Operand standing in for a child group in its parent's syntax tree.
+    Applying it gives the child's value without applying the child again"""
+    __slots__ = ('group',)
+    _fields = ('group',)
+
+    def __init__(self, group):
+        self.group = group
+
+    @classmethod
+    def _find_operand_names(cls):
+        """Child groups are already applied, so this has no operands"""
+        return ()
+
+    def apply(self, bindings=None, depth=0):
+        """Returns the value of the child group, or raises its error"""
+        group = self.group
+        if group.error is not None:
+            raise group.error
+        return group.value
+
+class _Group:
+    """The text between a pair of parentheses (or the whole text, for the
+    outermost group), with its tokens, tree, and value"""
+    __slots__ = ('segments', 'length', 'tokens', 'tree', 'value', 'error', 'dirty', 'parent')
+
+    def __init__(self, segments):
+        """segments - the text of this group, split into child groups. Text
+        and child groups alternate, starting and ending with text (which can
+        be empty)"""
+        self.segments = segments
+        self.length = 0 # Length of the text, not counting this group's own parentheses
+        for k, segment in enumerate(segments):
+            if k % 2:
+                segment.parent = self
+                self.length += segment.length + 2
+            else:
+                self.length += len(segment)
+        self.tokens = None # MyOps from each piece of text (or the error lexing it). None to lex all
+        self.tree = None # Syntax tree of this group. None to rebuild
+        self.value = None
+        self.error = None # Exception raised building or applying the tree
+        self.dirty = True # Whether value is out of date
+        self.parent = None
+
+    def children(self):
+        """returns the child groups"""
+        return self.segments[1::2]
+
+    def refresh(self):
+        """Update value, assuming every child's value is up to date"""
+        self.dirty = False
+        try:
+            if self.tree is None:
+                if self.tokens is None:
+                    self.tokens = [_lex(text, k > 0) for k, text in enumerate(self.segments[::2])]
+                eqn = [] # Tokens of this group, with children as single operands
+                for k, tokens in enumerate(self.tokens):
+                    if isinstance(tokens, Exception):
+                        raise tokens
+                    if k:
+                        eqn.append(_GroupValue(self.segments[2*k-1]))
+                    eqn.extend(tokens)
+                self.tree = make_group_tree(eqn)
+            self.value = self.tree.apply()
+            self.error = None
+        except (ValueError, ArithmeticError) as e:
+            self.value = None
+            self.error = e
+
+def _lex(text, after_group):
+    """Parse one piece of a group's text
+    after_group - whether the piece comes right after a child group, so a "-"
+    at its start is a Sub instead of a Neg
+    returns a list of MyOps, or the ValueError if the text is invalid"""
+    try:
+        tokens = parse(text)
+    except ValueError as e:
+        return e
+    if after_group and tokens and isinstance(tokens[0], Neg):
+        tokens[0] = Sub()
+    return tokens
+
+def _split(text):
+    """Split text into segments of text and child groups (see _Group)
+    returns the list of segments, or None if the parentheses are unbalanced"""
+    levels = [[]] # Segments of each group still open, outermost first
+    last_end = 0 # Where the last parenthesis ended
+    for match in _parens.finditer(text):
+        levels[-1].append(text[last_end:match.start()])
+        last_end = match.end()
+        if match.group() == '(':
+            levels.append([])
+        elif len(levels) > 1:
+            group = _Group(levels.pop())
+            levels[-1].append(group)
+        else:
+            # Close with nothing open
+            return None
+    if len(levels) > 1:
+        # Open never closed
+        return None
+    levels[0].append(text[last_end:])
+    return levels[0]
+
+def _outermost(text):
+    """returns the outermost _Group of text, or None if its parentheses are
+    unbalanced"""
+    segments = _split(text)
+    return None if segments is None else _Group(segments)
+
+class Document:
+    """An expression that is kept evaluated as its text is edited
+    Edits that leave the parentheses balanced only redo the work around the
+    edit. Edits that unbalance them make the next evaluate (and the edit after
+    that) process the whole text, until they're balanced again
+    Usage:
+        doc = Document('(1+2)*3')
+        doc.edit(3, 4, '20') # '(1+20)*3'
+        doc.evaluate() # 63"""
+    def __init__(self, text=''):
+        """text - string representing an arithmetic expression"""
+        self.text = text
+        self._root = _outermost(text) # None if unbalanced
+
+    def evaluate(self):
+        """Evaluate the current text, applying only the groups changed by edits
+        since the last call
+        returns the value of the text, like process. Raises the same kinds of
+        errors as process, but for text with more than one error, it can be a
+        different one of them"""
+        root = self._root
+        if root is None:
+            # Unbalanced, so no groups
+            return make_tree(parse(self.text)).apply()
+
+        # Refresh changed groups, children first. Explicit stack, so deep nesting works
+        todo = [root]
+        while todo:
+            group = todo[-1]
+            if not group.dirty:
+                todo.pop()
+                continue
+            changed = [child for child in group.children() if child.dirty]
+            if changed:
+                todo.extend(changed)
+                continue
+            todo.pop()
+            group.refresh()
+        if root.error is not None:
+            raise root.error
+        return root.value
+
+    def edit(self, start, end, text):
+        """Replace self.text[start:end] with text
+        start, end - positions in the current text, like slice indexes
+        text - the new text"""
+        if not 0 <= start <= end <= len(self.text):
+            raise ValueError(f"Edit span {start}:{end} is outside the text (length {len(self.text)})")
+        new_text = self.text[:start] + text + self.text[end:]
+        self.text = new_text
+        delta = len(text) - (end - start) # Change in length
+        if self._root is None:
+            # Unbalanced before the edit, so start over
+            self._root = _outermost(new_text)
+            return
+
+        # Find the innermost group whose text holds the whole edit
+        path = [] # (group, where its text starts) from the outermost group in
+        group, offset = self._root, 0
+        while group is not None:
+            path.append((group, offset))
+            child_offset = offset # Where the current segment starts
+            inner = None
+            for k, segment in enumerate(group.segments):
+                if k % 2:
+                    if child_offset + 1 <= start and end <= child_offset + 1 + segment.length:
+                        inner = (segment, child_offset + 1)
+                        break
+                    child_offset += segment.length + 2
+                else:
+                    child_offset += len(segment)
+            group, offset = inner if inner is not None else (None, None)
+
+        # Split the edited text in that group into new segments. If its
+        # parentheses don't balance, use the whole group in its parent instead
+        first, last = start, end # Span (in the old text) that has to be re-split
+        while path:
+            group, offset = path.pop()
+            i, j, region_start, region_end = _segment_span(group, offset, first, last)
+            segments = _split(new_text[region_start:region_end + delta])
+            if segments is not None:
+                break
+            # Whole group, with its parentheses
+            first, last = offset - 1, offset + group.length + 1
+        else:
+            # Unbalanced
+            self._root = None
+            return
+
+        # Replace the segments, and re-lex only the new pieces of text
+        group.segments[i:j+1] = segments
+        for child in segments[1::2]:
+            child.parent = group
+        if group.tokens is not None:
+            group.tokens[i//2:j//2+1] = [_lex(piece, i//2 + k > 0) for k, piece in enumerate(segments[::2])]
+        group.tree = None
+        # The group and everything outside it have to be applied again
+        while group is not None:
+            group.length += delta
+            group.dirty = True
+            group = group.parent
+
+def _segment_span(group, offset, start, end):
+    """Find the segments of group that the span start:end touches, widened to
+    start and end with text segments
+    offset - where the text of group starts
+    returns (first segment index, last segment index, where the first starts,
+    where the last ends)"""
+    i = j = None
+    position = offset # Where the current segment starts
+    for k, segment in enumerate(group.segments):
+        segment_end = position + (segment.length + 2 if k % 2 else len(segment))
+        if i is None and (start < segment_end or start == segment_end and not k % 2):
+            i, region_start = k, position
+        if i is not None and end <= segment_end:
+            j, region_end = k, segment_end
+            break
+        position = segment_end
+    if i % 2:
+        # Include the text before the child group
+        i -= 1
+        region_start -= len(group.segments[i])
+    if j % 2:
+        # Include the text after the child group
+        j += 1
+        region_end += len(group.segments[j])
+    return i, j, region_start, region_end
@@ -10,10 +10,27 @@ Created on Wed Nov  4 09:38:00 2020
 Class definitions for the base MyOp and MyEnclosingOp class, specific operators, and wrapper functions
 """
 
-from copy import deepcopy
 import re
 from abc import ABC
+from collections import Counter
+import contextlib
+import contextvars
+import copy
+from functools import partial, reduce
+import math
+import numbers
 import operator # allows accessing functions for normal operators (ex. +, -, *, /)
+import threading
+import time
+
+# How deep apply recurses into a tree before switching to an explicit stack.
+# Well under Python's default recursion limit of 1000
+max_recursion = 200
+
+# Nodes are immutable (see MyOp.__setattr__), so attributes are set through
+# object's methods instead. Also faster than going through MyOp.__setattr__
+_set = object.__setattr__
+_delete = object.__delattr__
 
 class MyOp(ABC):
     """Abstract base class representing a generalized operator"""
@@ -24,50 +41,228 @@ class MyOp(ABC):
     # Number of operands used (i.e. '+' has 1 left, 1 right)
     nleft = 0
     nright = 0
+    # Whether the operands are a sequence of any length instead (see MyNaryOp)
+    nary = False
 
     # What function to apply to the operands
     func = None
 
+    # Names of the attributes holding the operands, for repr and equality checks
+    _fields = ('left', 'right')
+
+    # Class that instances are hashed as. An instance of a subclass can be
+    # equal to an instance of its parent class, so they have to hash the same.
+    # Set for each subclass, None in base classes
+    _hash_class = None
+
+    # Instance attributes are stored in slots instead of a __dict__, so large
+    # trees take much less memory. Every subclass should define __slots__ too
+    # (empty if it adds no attributes), or its instances get a __dict__ again
+    # _hash caches __hash__, and is unset until it's first computed
+    __slots__ = ('left', 'right', '_hash')
+
     def __init__(self, left=None, right=None):
         """Generic init implementation, setting left and right operands"""
         # Operand contents
-        self.left = left
-        self.right = right
+        _set(self, 'left', left)
+        _set(self, 'right', right)
+
+    def __setattr__(self, name, value):
+        """Nodes are immutable, so one tree can be shared between threads (ex.
+        a compiled Expression evaluated from a thread pool) with no locking.
+        Each attribute can only be set once, when the node is made"""
+        if hasattr(self, name):
+            raise AttributeError(f"Can't set {name} of {self.__class__.__name__}, nodes are immutable")
+        _set(self, name, value)
+
+    def __delattr__(self, name):
+        """Nodes are immutable (see __setattr__)"""
+        raise AttributeError(f"Can't delete {name} of {self.__class__.__name__}, nodes are immutable")
 
     def __repr__(self):
         """For readable output, use the class name followed by operands
         If operands are none, print blanks
         Add with no operands --> Add(,)
-        Add with left=1, right=2 --> Add(1,2)"""
-        name = self.__class__.__name__
-        left = self.left
-        right = self.right
-        left = '' if left is None else left
-        right = '' if right is None else right
-        return f"{name}({left},{right})"
+        Add with left=1, right=2 --> Add(1,2)
+        Uses an explicit stack instead of recursion, so deep trees can't hit
+        the recursion limit"""
+        out = [] # Pieces of the output string
+        todo = [self] # Pieces still to output, last first. MyOps are expanded when reached
+        while todo:
+            item = todo.pop()
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            # Expand the MyOp into its name and operands, pushing in reverse order
+            todo.append(')')
+            values = item.terms if item.nary else [getattr(item, field) for field in item._fields]
+            for i in range(len(values)-1, -1, -1):
+                value = values[i]
+                if isinstance(value, MyOp):
+                    todo.append(value)
+                else:
+                    todo.append('' if value is None else str(value))
+                if i:
+                    todo.append(',')
+            todo.append(f"{item.__class__.__name__}(")
+        return ''.join(out)
 
     def __eq__(self, other):
-        """Generic equality check. Checks class type and operands"""
-        return (isinstance(other, self.__class__)
-                and other.left == self.left
-                and other.right == self.right)
+        """Generic equality check. Checks class type and operands
+        Subtrees that are the same object (see share_subtrees) aren't compared
+        any further, and neither are subtrees whose hashes have already been
+        computed and differ
+        Uses an explicit stack instead of recursion, so deep trees can't hit
+        the recursion limit"""
+        todo = [(self, other)] # Pairs still to compare
+        while todo:
+            mine, theirs = todo.pop()
+            if isinstance(mine, MyOp):
+                if mine is theirs:
+                    continue
+                if not isinstance(theirs, mine.__class__):
+                    return False
+                mine_hash = getattr(mine, '_hash', None)
+                if mine_hash is not None and getattr(theirs, '_hash', mine_hash) != mine_hash:
+                    return False
+                if mine.nary:
+                    if len(mine.terms) != len(theirs.terms):
+                        return False
+                    todo.extend(zip(mine.terms, theirs.terms))
+                    continue
+                for field in mine._fields:
+                    todo.append((getattr(mine, field), getattr(theirs, field)))
+            elif mine != theirs:
+                return False
+        return True
+
+    def __hash__(self):
+        """Structural hash, so that equal trees hash the same. Computed once
+        for each node and then cached, since trees are never modified once built
+        Threads hashing the same node at once all cache the same value, so the
+        cache needs no lock
+        Uses an explicit stack instead of recursion, so deep trees can't hit
+        the recursion limit"""
+        todo = [self] # MyOps to hash, last first. Operands are hashed before their MyOp
+        while todo:
+            item = todo[-1]
+            if getattr(item, '_hash', None) is not None:
+                # Already hashed (ex. shared with another part of the tree)
+                todo.pop()
+                continue
+            values = item.terms if item.nary else [getattr(item, field) for field in item._fields]
+            unhashed = [value for value in values
+                        if isinstance(value, MyOp) and getattr(value, '_hash', None) is None]
+            if unhashed:
+                todo.extend(unhashed)
+                continue
+            todo.pop()
+            _set(item, '_hash', hash((item._hash_class,
+                                      *[value._hash if isinstance(value, MyOp) else value for value in values])))
+        return self._hash
+
+    def __init_subclass__(cls, **kwargs):
+        """Record which attributes hold the operands of each subclass, and the
+        class to hash it as"""
+        super().__init_subclass__(**kwargs)
+        cls._operand_names = cls._find_operand_names()
+        if '_hash_class' not in cls.__dict__:
+            cls._hash_class = cls.__mro__[1]._hash_class or cls
+
+    @classmethod
+    def _find_operand_names(cls):
+        """Returns a tuple of the names of the attributes holding the operands
+        that are passed to func, in order"""
+        return ('left',)*bool(cls.nleft) + ('right',)*bool(cls.nright)
 
-    def apply(self):
+    def operands(self):
+        """Returns a tuple of the operands used, in the order they're passed to func"""
+        return tuple(getattr(self, name) for name in self._operand_names)
+
+    def apply(self, bindings=None, depth=0):
         """Apply the operator to the operands. If operands are MyOps, they are
-        applied using postorder traversal"""
-        # Apply each operand (if used)
-        if self.nleft and isinstance(self.left, MyOp):
-            self.left = deepcopy(self.left).apply()
-        if self.nright and isinstance(self.right, MyOp):
-            self.right = deepcopy(self.right).apply()
-
-        # Apply the function
-        args = []
+        applied using postorder traversal
+        The tree is not modified, so it can be applied any number of times
+        bindings - values for any Placeholders in the tree (see Placeholder)
+        depth - how deep self is in the tree being applied. Past max_recursion,
+        the rest of the tree is applied with an explicit stack instead"""
+        if depth > max_recursion:
+            return self._apply_iterative(bindings)
+        depth += 1
+
+        # Apply each operand (if used), then the function. Called directly for
+        # each number of operands, instead of building a list of arguments
+        if self.nleft:
+            left = self.left
+            if isinstance(left, MyOp):
+                left = left.apply(bindings, depth)
+            if not self.nright:
+                return self.func(left)
+        elif not self.nright:
+            return self.func()
+        right = self.right
+        if isinstance(right, MyOp):
+            right = right.apply(bindings, depth)
         if self.nleft:
-            args.append(self.left)
-        if self.nright:
-            args.append(self.right)
-        return self.func(*args)
+            return self.func(left, right)
+        return self.func(right)
+
+    def apply_shared(self, bindings=None):
+        """Equivalent to apply, but subtrees shared by more than one MyOp (see
+        share_subtrees) are only applied once
+        bindings - values for any Placeholders in the tree (see Placeholder)"""
+        return self._apply_iterative(bindings, {})
+
+    def _apply_iterative(self, bindings=None, memo=None):
+        """Equivalent to apply, but using an explicit stack instead of recursion
+        so the depth of the tree is only limited by memory
+        Avoids calling Python functions for each node where possible, since
+        this runs with the stack already deep
+        memo - dict to keep the value of each MyOp with operands in, by id, so
+        that shared subtrees are only applied once. None to not keep them"""
+        values = [] # Results of applying each operand, in postorder
+        todo = [self] # MyOps still to apply, last first
+        while todo:
+            item = todo.pop()
+            cls = item.__class__
+            if cls is tuple:
+                # All operands of this MyOp have been applied, apply it
+                item, n = item
+                value = item.func(*values[-n:])
+                values[-n:] = [value]
+                if memo is not None:
+                    memo[id(item)] = value
+                continue
+
+            names = getattr(cls, '_operand_names', None)
+            if names is None:
+                # Not a MyOp, so already a value
+                values.append(item)
+            elif names:
+                if memo is not None and id(item) in memo:
+                    # Shared subtree that has already been applied
+                    values.append(memo[id(item)])
+                    continue
+                # Apply the operands first, leftmost first
+                if cls.nary:
+                    terms = item.terms
+                    todo.append((item, len(terms)))
+                    todo.extend(reversed(terms))
+                    continue
+                todo.append((item, len(names)))
+                for name in reversed(names):
+                    todo.append(getattr(item, name))
+            elif cls is Num:
+                values.append(item.value)
+            else:
+                # MyOp with no operands
+                values.append(item.apply(bindings))
+        return values[0]
+
+    @classmethod
+    def from_token(cls, text):
+        """Create a MyOp from the text that matched token"""
+        return cls()
 
     @classmethod
     def tokenize(cls, eqn):
@@ -88,7 +283,7 @@ class MyOp(ABC):
                     if start > last_end:
                         # Save substring before token, if there is any
                         out.append(item[last_end:start])
-                    out.append(cls()) # Convert token to MyOp and append
+                    out.append(cls.from_token(match.group())) # Convert token to MyOp and append
                     last_end = match.end() # Update the pointer to avoid duplication
                 if last_end < len(item):
                     out.append(item[last_end:]) # Save any leftovers
@@ -98,26 +293,14 @@ class MyOp(ABC):
             else: raise ValueError("eqn contained something neither string nor MyOp")
         return out
 
-    def consume(self, eqn, i):
-        """Consumes MyOp's operands, modifying eqn inplace
-        eqn - the equation to operate on, a list of MyOp objects
-        i - index of this operator in eqn
-        returns the index after consumption
-        (to account for consumption of left operands)"""
-        # Consume operands (start from right to preserve index)
-        if self.nright:
-            # Consume the right operand, don't change i
-            try:
-                self.right = eqn.pop(i+1)
-            except IndexError:
-                raise ValueError(f"Operator at end of eqn that needs right operand: {eqn}")
-        if self.nleft:
-            # Consume the left operand, reduce i by 1
-            if i == 0: # list.pop(-1) won't error, so can't use try/except
-                raise ValueError(f"Operator at start of eqn that needs left operand: {eqn}")
-            self.left = eqn.pop(i-1)
-            i -= 1
-        return i
+    def consume(self, operands):
+        """Consumes MyOp's operands from the end of operands, replacing them
+        with a new MyOp that holds them. self is not modified
+        operands - list of the subtrees built so far, modified inplace"""
+        # Consume operands (right first, since it was added last)
+        right = operands.pop() if self.nright else None
+        left = operands.pop() if self.nleft else None
+        operands.append(self.__class__(left, right))
 
 class MyEnclosingOp(MyOp):
     """Base class for a  two-part operator (open and close) that operates on
@@ -125,124 +308,114 @@ class MyEnclosingOp(MyOp):
     Children should be in pairs, an Open and Close (ex. OpenParen, CloseParen)
     The Open class does the processing, Close class is just a marker for parsing"""
 
+    # Names of the attributes holding the operands, for repr and equality checks
+    _fields = ('enclosed',)
+
+    # Base class, not hashed as itself
+    _hash_class = None
+
     # Enclosed operands
-    enclosed = None
+    __slots__ = ('enclosed',)
 
     # Reference to the Closing operator class. None in closing operators themselves
     close = None
 
     def __init__(self, enclosed=None):
         """Generic enclosing init implementation, setting enclosed"""
-        self.enclosed = enclosed
+        _set(self, 'enclosed', enclosed)
 
-    def __repr__(self):
-        """For readable output, use the class name followed by operands
-        If operands are none, print blanks
-        OpenParen with no enclosed operands --> OpenParen()
-        OpenParen enclosing 1+2 --> OpenParen(1,Add(),2) or OpenParen(Add(1,2))"""
-        name = self.__class__.__name__
-        enclosed = self.enclosed
-        enclosed = '' if enclosed is None else enclosed
-        return f"{name}({enclosed})"
-
-    def __eq__(self, other):
-        """Generic equality check. Checks class type and contents"""
-        return (isinstance(other, self.__class__)
-                and other.enclosed == self.enclosed)
+    @classmethod
+    def _find_operand_names(cls):
+        """The only operand is the enclosed syntax tree"""
+        return ('enclosed',)
 
-    def apply(self):
+    def apply(self, bindings=None, depth=0):
         """Apply the operator to the operands. If operands are MyOps, they are
-        applied using postorder traversal"""
-        # Apply each operand (if used)
-        if self.enclosed and isinstance(self.enclosed, MyOp):
-            self.enclosed = deepcopy(self.enclosed).apply()
-
-        # Apply the function
-        args = []
-        if self.enclosed:
-            args.append(self.enclosed)
-        return self.func(*args)
-
-    def consume(self, eqn, i):
-        """Consumes all operands between this operator and the matching closing
-        operator, modifying eqn inplace
-        eqn - the equation to operate on, a list of MyOp objects
-        i - index of this operator in eqn
-        returns the resulting index after consumption
-        (to account for consumption of left operands)"""
+        applied using postorder traversal
+        The tree is not modified, so it can be applied any number of times
+        bindings - values for any Placeholders in the tree (see Placeholder)
+        depth - how deep self is in the tree being applied. Past max_recursion,
+        the rest of the tree is applied with an explicit stack instead"""
+        if depth > max_recursion:
+            return self._apply_iterative(bindings)
+
+        # Apply the enclosed operands (if any), then the function
+        enclosed = self.enclosed
+        if enclosed is None:
+            return self.func()
+        if isinstance(enclosed, MyOp):
+            enclosed = enclosed.apply(bindings, depth+1)
+        return self.func(enclosed)
+
+    def consume(self, enclosed):
+        """Consumes the syntax tree of everything between this operator and the
+        matching closing operator. self is not modified
+        enclosed - a single MyOp, the root of the enclosed syntax tree
+        returns a new MyOp enclosing it"""
         if self.close is None:
             # self is a closing operator
-            raise ValueError(f"Unmatched or out-of-order closing operator found {eqn}")
-
-        # Iterate over eqn to find the matching Close operator, consuming
-        # along the way
-        self.enclosed = [] # Part of eqn enclosed by this operator
-        count = 1 # Number of Open operators minus number of Close operators seen
-        while count != 0:
-            if i == len(eqn)-1:
-                # Nothing after self, but still have unmatched Opens
-                raise ValueError(f"{count} too many opening operators")
-            op = eqn.pop(i+1) # Consume the next operator (right of self)
-            if isinstance(op, self.__class__):
-                # Open, increase count
-                count += 1
-            elif isinstance(op, self.close):
-                # Close, decrease count
-                count -= 1
-                if count == 0:
-                    # All Start/Stop operators matched
-                    break # Exit the loop without appending the closeing operator
-            self.enclosed.append(op) # Save the operator
-        # Re-tokenize Neg to catch Sub instances adjacent to parentheses
-        self.enclosed = Neg.tokenize(self.enclosed)
-        # Convert contents to syntax tree
-        self.enclosed = make_tree(self.enclosed)
-        # All consumption is at or right of i, so no change needed
-        return i
+            raise ValueError(f"Unmatched or out-of-order closing operator found {self}")
+        return self.__class__(enclosed)
 
 # Define close before open so that open can reference close
 class CloseParen(MyEnclosingOp):
     token = re.compile('\)') # ")"
+    __slots__ = ()
     close = None
 
 class OpenParen(MyEnclosingOp):
     token = re.compile('\(') # "("
+    __slots__ = ()
     close = CloseParen
 
     func = lambda self, enclosed: enclosed # Return operands unchanged
 
 class Pow(MyOp):
     token = re.compile('\^|\*\*') # Allow "^" or "**"
+    __slots__ = ()
     nleft = 1
     nright = 1
-    func = operator.pow
+
+    @staticmethod
+    def func(base, exponent):
+        """operator.pow, but first checks the size of the result against the
+        Limits in use, if any (see use_limits)"""
+        limits = _active_limits.get()
+        if limits is not None:
+            limits.check_pow(base, exponent)
+        return base ** exponent
 
 class Mul(MyOp):
     token = re.compile('\*|x|X') # Allow "x" and "X" since no symbolic input allowed
+    __slots__ = ()
     nleft = 1
     nright = 1
     func = operator.mul
 
 class Div(MyOp):
     token = re.compile('/')
+    __slots__ = ()
     nleft = 1
     nright = 1
     func = operator.truediv
 
 class Add(MyOp):
     token = re.compile('\+') # "+"
+    __slots__ = ()
     nleft = 1
     nright = 1
     func = operator.add
 
 class Sub(MyOp):
     token = re.compile('-')
+    __slots__ = ()
     nleft = 1
     nright = 1
     func = operator.sub
 
 class Neg(MyOp):
     token = re.compile('-')
+    __slots__ = ()
     nright = 1
     func = operator.neg
 
@@ -272,24 +445,66 @@ class Neg(MyOp):
 class Num(MyOp):
     """Special case of MyOp to allow numbers to be handled the same way as
     other MyOps"""
-    def __init__(self, value=None):
-        self.value = value
+    # Numbers are the text between tokens, but the sign of an exponent (ex.
+    # "e-" in "1e-3") would be taken for a Sub or Add. So it's matched as the
+    # token of Num, which parse leaves in the text around it
+    # Starts with the "e", so the regex can rule it out from the first character
+    token = re.compile(r'[eE](?<=[\d.][eE])[+-](?=[\d.])')
 
-    def __repr__(self):
-        name = self.__class__.__name__
-        value = self.value
-        value = '' if value is None else value
-        return f"{name}({value})"
+    # Names of the attributes holding the operands, for repr and equality checks
+    _fields = ('value',)
 
-    def __eq__(self, other):
-        """Num equality check. Checks class type and value"""
-        return (isinstance(other, self.__class__)
-                and other.value == self.value)
+    __slots__ = ('value',)
+
+    def __init__(self, value=None):
+        _set(self, 'value', value)
+
+    @classmethod
+    def _find_operand_names(cls):
+        """Numbers have no operands"""
+        return ()
 
-    def apply(self):
+    def apply(self, bindings=None, depth=0):
         """Evaluates the number, returning the value"""
         return self.value
 
+    @classmethod
+    def from_text(cls, text, number_type=None):
+        """Convert a string of numeric text to a Num
+        Integer literals become ints directly (of any size, exactly, even past
+        the limit on digits int converts), and anything else float accepts
+        (decimals, scientific notation, "inf") becomes a float
+        text - the string to convert, with no operators or whitespace
+        number_type - function to convert every literal with instead (ex.
+        decimal.Decimal or fractions.Fraction, for exact results). None for
+        int or float
+        returns a Num"""
+        if number_type is None:
+            if cls is Num:
+                num = _shared_literals.get(text)
+                if num is not None:
+                    # Small int, skip converting it
+                    return num
+            if text.isdecimal() or '_' in text and _int_literal.fullmatch(text):
+                # Anything int accepts (ex. "1_000"). Nothing else can be in
+                # the text between tokens
+                return cls.of(_int_from_text(text))
+        try:
+            return cls((float if number_type is None else number_type)(text))
+        except (ValueError, ArithmeticError):
+            # ArithmeticError from Decimal
+            raise ValueError(f"Unknown operator or bad input: '{_shorten(text)}'") from None
+
+    @classmethod
+    def of(cls, value):
+        """Returns a Num with value. Small ints share one Num per value (like
+        Python's own small ints), so they only take memory once however often
+        they appear. Safe because trees are never modified once built
+        value - int or float"""
+        if cls is Num and value.__class__ is int and 0 <= value < _n_shared_nums:
+            return _shared_nums[value]
+        return cls(value)
+
     @classmethod
     def tokenize(cls, eqn):
         """Overload of the tokenize method to convert all remaining strings to
@@ -302,19 +517,132 @@ class Num(MyOp):
         for i, item in enumerate(eqn):
             if isinstance(item, str):
                 # String operator found, convert to Number
-                try:
-                    temp = float(item)
-                except ValueError:
-                    raise ValueError(f"Unknown operator or bad input: '{item}'")
-                if temp.is_integer():
-                    out[i] = cls(int(temp))
-                else:
-                    out[i] = cls(temp)
+                out[i] = cls.from_text(item)
 
         return out
 
+# Number of small ints (starting at 0) that Num.of returns a shared Num for
+_n_shared_nums = 1024
+_shared_nums = [Num(value) for value in range(_n_shared_nums)]
+# The shared Nums by their text, so parsing them needs no conversion
+_shared_literals = {str(num.value): num for num in _shared_nums}
+
+# Integer literals, as int accepts them (\d is any Unicode decimal digit)
+_int_literal = re.compile(r'\d+(?:_\d+)*')
+# Digits that int always converts. Python can limit how many digits it converts
+# at once, but never to fewer than this (see sys.set_int_max_str_digits)
+_int_chunk_digits = 640
+
+def _int_from_text(text):
+    """int(text), for a string that matches _int_literal, but with no limit on
+    the number of digits. Longer text is converted in halves and combined
+    returns an int"""
+    if len(text) <= _int_chunk_digits:
+        return int(text)
+    digits = text.replace('_', '')
+    if len(digits) <= _int_chunk_digits:
+        return int(digits)
+    half = len(digits) // 2
+    return _int_from_text(digits[:half]) * 10**(len(digits) - half) + _int_from_text(digits[half:])
+
+class Placeholder(MyOp):
+    """Operand standing in for a number that is only given when the tree is
+    applied, so one tree can be applied to many different numbers
+    "{name}" is looked up by name and "{0}" by position. "{}" is numbered
+    automatically by compile, in order
+    Values are looked up in the bindings given to apply, so bindings can be a
+    dict (named and/or positional) or a list (positional only)"""
+    token = re.compile(r'\{\w*\}') # "{}", "{0}", "{name}"
+
+    # Names of the attributes holding the operands, for repr and equality checks
+    _fields = ('key',)
+
+    __slots__ = ('key',)
+
+    def __init__(self, key=None):
+        """key - name (str) or position (int) of the value to use"""
+        _set(self, 'key', key)
+
+    @classmethod
+    def _find_operand_names(cls):
+        """Placeholders have no operands"""
+        return ()
+
+    @classmethod
+    def from_token(cls, text):
+        """Overload of from_token to read the key from between the braces"""
+        key = text[1:-1]
+        if not key:
+            # Numbered later, by compile
+            return cls()
+        return cls(int(key) if key.isdecimal() else key)
+
+    def apply(self, bindings=None, depth=0):
+        """Look up the value of the placeholder in bindings"""
+        try:
+            return bindings[self.key]
+        except (KeyError, IndexError, TypeError):
+            key = '' if self.key is None else self.key
+            raise ValueError(f"No value given for placeholder {{{key}}}")
+
+class MyNaryOp(MyOp):
+    """Base class for a chain of one binary operator applied left to right to
+    any number of operands (ex. 1+2+3+4 as one node instead of three)
+    Never parsed from text, only made by simplify_tree"""
+    nary = True
+
+    # The binary MyOp class that this replaces chains of
+    binary = None
+
+    # Base class, not hashed as itself
+    _hash_class = None
+
+    # Names of the attributes holding the operands, for repr and equality checks
+    _fields = ('terms',)
+
+    __slots__ = ('terms',)
+
+    def __init__(self, *terms):
+        """terms - the operands, in order"""
+        _set(self, 'terms', terms)
+
+    @classmethod
+    def _find_operand_names(cls):
+        """The operands are all held in terms"""
+        return ('terms',)
+
+    def operands(self):
+        """Returns a tuple of the operands used, in the order they're passed to func"""
+        return self.terms
+
+    def func(self, *terms):
+        """Apply the binary operator to the terms left to right, exactly as the
+        chain of binary MyOps would"""
+        return reduce(self.binary.func, terms)
+
+    def apply(self, bindings=None, depth=0):
+        """Apply the operator to the operands. If operands are MyOps, they are
+        applied using postorder traversal
+        bindings - values for any Placeholders in the tree (see Placeholder)
+        depth - how deep self is in the tree being applied. Past max_recursion,
+        the rest of the tree is applied with an explicit stack instead"""
+        if depth > max_recursion:
+            return self._apply_iterative(bindings)
+        depth += 1
+        return self.func(*[term.apply(bindings, depth) if isinstance(term, MyOp) else term
+                           for term in self.terms])
+
+class NaryAdd(MyNaryOp):
+    __slots__ = ()
+    binary = Add
+
+class NaryMul(MyNaryOp):
+    __slots__ = ()
+    binary = Mul
+
 # Convert operators in parse order (needed for unary "-" vs binary "-")
-parse_order = [OpenParen,
+parse_order = [Placeholder,
+               OpenParen,
                CloseParen,
                Pow,
                Mul,
@@ -325,7 +653,7 @@ parse_order = [OpenParen,
                Num, # Num has to be last, since it collects any remaining strings
                ]
 # Apply operators in precedence order (levels must be tuples for isinstance checks)
-prec_order = [(Num,),
+prec_order = [(Num, Placeholder),
               (OpenParen,CloseParen), # CloseParen just used for error-checking
               (Neg,),
               (Pow,),
@@ -333,48 +661,868 @@ prec_order = [(Num,),
               (Add, Sub),
               ]
 
-def parse(text):
+def _make_lexer(order):
+    """Combine the tokens of every operator in order into a single regex, so
+    that text can be tokenized in one left-to-right scan
+    Each token is followed by an empty named group marking which operator
+    matched, instead of being wrapped in one. That way each alternative starts
+    with the token itself, and the regex engine can rule out most of them from
+    the first character alone, so adding operators barely slows scanning down
+    order - list of MyOp classes, in parse order
+    returns the compiled regex and a dict of {group name: MyOp class}"""
+    patterns = [r'\s\s*(?P<space>)'] # Whitespace is matched, but not converted
+    classes = {}
+    seen = set() # Patterns already used. Neg shares its token with Sub
+    for i, op in enumerate(order):
+        if op.token is None or op.token.pattern in seen:
+            # Duplicates would never match
+            continue
+        seen.add(op.token.pattern)
+        name = f"op{i}"
+        patterns.append(f"(?:{op.token.pattern})(?P<{name}>)")
+        classes[name] = op
+    return re.compile('|'.join(patterns)), classes
+
+def _make_precedence(levels):
+    """Look up the precedence of each operator (lower is applied first)
+    levels - list of tuples of MyOp classes, in precedence order
+    returns a dict of {MyOp class: index of its level}"""
+    return {op: rank for rank, level in enumerate(levels) for op in level}
+
+# Single-pass lexer equivalent to tokenizing with each operator in parse_order,
+# as (regex, {group name: MyOp class}). Kept as one tuple, so that parse always
+# gets a regex and classes from the same version of the registry
+_lexer = _make_lexer(parse_order)
+
+# Precedence of each operator in prec_order (see _make_precedence)
+_precedence = _make_precedence(prec_order)
+
+# Serializes changes to the registry. Reading it (parse, make_tree) needs no lock
+_registry_lock = threading.Lock()
+
+def _rebuild(new_parse_order, new_prec_order):
+    """Replace the registry and recompile the lexer and precedence table from it
+    The lists are replaced rather than modified, so a parse running at the same
+    time keeps using the old ones"""
+    global parse_order, prec_order, _lexer, _precedence
+    lexer = _make_lexer(new_parse_order)
+    precedence = _make_precedence(new_prec_order)
+    parse_order, prec_order = new_parse_order, new_prec_order
+    _lexer, _precedence = lexer, precedence
+
+def register_operator(op, precedence):
+    """Add an operator to the ones parse and make_tree recognize
+    Its token is tried before the tokens of operators already registered, so a
+    longer token that starts with an existing one (ex. "//" with "/") wins.
+    The lexer and precedence table are recompiled once per change, not per parse
+    op - MyOp subclass with a token, nleft/nright, and func (see define_operator)
+    precedence - a registered MyOp class, to apply op at the same level as it;
+    or an index into prec_order to insert a new level for op at (ex.
+    len(prec_order) to apply it after everything else)
+    returns op
+    Results already cached (ex. by caching.ProcessCache) are not cleared"""
+    if not (isinstance(op, type) and issubclass(op, MyOp)) or op.token is None:
+        raise ValueError(f"Operator must be a MyOp subclass with a token, not {op!r}")
+    with _registry_lock:
+        if op in parse_order:
+            raise ValueError(f"{op.__name__} is already registered")
+        levels = list(prec_order)
+        if isinstance(precedence, int):
+            if not 0 <= precedence <= len(levels):
+                raise ValueError(f"Precedence index must be from 0 to {len(levels)}, not {precedence}")
+            levels.insert(precedence, (op,))
+        else:
+            rank = _precedence.get(precedence)
+            if rank is None:
+                raise ValueError(f"Can't share the precedence of {precedence!r}, it isn't registered")
+            levels[rank] += (op,)
+        _rebuild([op] + parse_order, levels)
+    return op
+
+def unregister_operator(op):
+    """Remove an operator added with register_operator (or a built in one)
+    Its precedence level is removed too, if nothing else is left in it"""
+    with _registry_lock:
+        if op not in parse_order:
+            raise ValueError(f"{op!r} is not registered")
+        levels = [tuple(other for other in level if other is not op) for level in prec_order]
+        _rebuild([other for other in parse_order if other is not op], [level for level in levels if level])
+
+def define_operator(name, token, func, precedence, nleft=1, nright=1):
+    """Create a new operator class and register it (see register_operator)
+    Examples:
+        define_operator('Mod', '%', operator.mod, Mul) # "7 % 4", applied like "*"
+        define_operator('Rad2Deg', 'rad2deg', math.degrees, Neg, nleft=0) # "rad2deg 3.14"
+    name - name of the new class
+    token - regex (string or compiled) of the text that represents it
+    func - function applied to the operands, left first
+    precedence - see register_operator
+    nleft, nright - number of operands on each side (0 or 1)
+    returns the new MyOp subclass"""
+    if isinstance(token, str):
+        token = re.compile(token)
+    op = type(name, (MyOp,), {'__slots__': (),
+                              'token': token,
+                              'nleft': nleft,
+                              'nright': nright,
+                              'func': staticmethod(func),
+                              })
+    return register_operator(op, precedence)
+
+def _expects_operand(eqn):
+    """Check whether the next token in eqn has to be an operand (i.e. a "-"
+    there would be a Neg rather than a Sub)
+    eqn - a list of the MyOp objects parsed so far"""
+    if not eqn:
+        # Nothing on the left, so nothing to subtract from
+        return True
+    prev = eqn[-1]
+    return (prev.nright # Previous operator still needs a right operand
+            or isinstance(prev, MyEnclosingOp) and prev.close is not None # Start of an enclosed group
+            )
+
+def parse(text, number_type=None):
     """Parse text, converting operator tokens into MyOp instances
     Does no evaluation, and does not set operands
+    The text is scanned once, left to right. Whitespace separates tokens but is
+    otherwise skipped, and any text between tokens is converted to a Num
     text - string to be converted
+    number_type - function to convert numbers with (see Num.from_text)
     returns a list of MyOp objects"""
     assert isinstance(text, str)
 
-    # Convert all operator tokens to MyOp instances, obeying parse order
-    eqn = [text]
-    for op in parse_order:
-        eqn = op.tokenize(eqn)
+    eqn = [] # Running list of MyOps so far
+    last_end = 0 # Where the last match ended
+    lexer, classes = _lexer # Same version of both, even if the registry changes
+    for match in lexer.finditer(text):
+        op = classes.get(match.lastgroup)
+        if op is Num:
+            # Sign of an exponent, part of the number text around it
+            continue
+        start = match.start()
+        if start > last_end:
+            # Text between tokens must be a number
+            eqn.append(Num.from_text(text[last_end:start], number_type))
+        last_end = match.end() # Update the pointer to avoid duplication
+
+        if op is None:
+            # Whitespace, skip
+            continue
+        if op is Sub and _expects_operand(eqn):
+            # Sub and Neg share a token, decide which one this is
+            op = Neg
+        eqn.append(op.from_token(match.group()))
+    if last_end < len(text):
+        # Save any leftovers
+        eqn.append(Num.from_text(text[last_end:], number_type))
     return eqn
 
+# Most items of eqn (or characters of text) to show in an error message, so
+# huge input doesn't make a huge message
+max_error_items = 20
+
+def _shorten(eqn):
+    """Format eqn for an error message, cut down to max_error_items
+    eqn - a list of MyOps, or a string
+    returns a string. Items that are whole subtrees (ex. enclosed groups) are
+    shown without their operands"""
+    if isinstance(eqn, str):
+        if len(eqn) <= max_error_items:
+            return eqn
+        return f"{eqn[:max_error_items]}... ({len(eqn)} characters)"
+    items = []
+    for item in eqn[:max_error_items]:
+        if isinstance(item, MyOp) and any(isinstance(operand, MyOp) for operand in item.operands()):
+            items.append(f"{item.__class__.__name__}(...)")
+        else:
+            items.append(repr(item))
+    if len(eqn) > max_error_items:
+        items.append(f"... {len(eqn) - max_error_items} more")
+    return f"[{', '.join(items)}]"
+
+def _rank(op):
+    """Returns the precedence of op (its index in prec_order), or None if op
+    isn't in prec_order"""
+    rank = _precedence.get(op.__class__)
+    if rank is None:
+        # Not listed directly, but could be a subclass of something that is
+        for rank, level in enumerate(prec_order):
+            if isinstance(op, level):
+                return rank
+    return rank
+
+class _Malformed(ValueError):
+    """Raised by make_group_tree for a group that applying one level of
+    prec_order at a time would still build a tree from, with operators as
+    operands of other operators. That isn't an error for the groups around it"""
+
+def _first_error(eqn):
+    """Find the error to raise for a group that can't be built into a tree
+    Operators were originally applied one level of prec_order at a time, each
+    level left to right, consuming whatever is next to them (even another
+    operator). Input with more than one error raises the first one found that
+    way, so this follows the same steps, but only keeps track of which items
+    are operators still to apply, so no MyOps are made
+    eqn - a list of MyOp objects with no enclosing operators left in it
+    returns a ValueError (a _Malformed if no level raises)"""
+    units = [] # (rank, nleft, nright) of each operator still to apply, None for operands
+    for i, item in enumerate(eqn):
+        if isinstance(item, Sub) and (i == 0 or eqn[i-1].nright):
+            # Sub with nothing to subtract from is actually a Neg
+            item = Neg
+        if item.nleft or item.nright:
+            units.append((_rank(item), item.nleft, item.nright))
+        else:
+            units.append(None)
+
+    for rank in sorted({unit[0] for unit in units if unit is not None and unit[0] is not None}):
+        out = [] # Units before index k, with this level applied
+        k = 0
+        while k < len(units):
+            unit = units[k]
+            k += 1
+            if unit is None or unit[0] != rank:
+                out.append(unit)
+                continue
+            # Consume the right operand first, then the left
+            if unit[2]:
+                if k == len(units):
+                    return ValueError(f"Operator at end of eqn that needs right operand: {_shorten(eqn)}")
+                k += 1
+            if unit[1]:
+                if not out:
+                    return ValueError(f"Operator at start of eqn that needs left operand: {_shorten(eqn)}")
+                out.pop()
+            out.append(None)
+        units = out
+    if len(units) == 1:
+        return _Malformed("Tree did not fully collapse. Invalid input")
+    return ValueError("Tree did not fully collapse. Invalid input")
+
+def make_group_tree(eqn):
+    """Convert eqn into a syntax tree in a single left-to-right pass, like
+    make_tree but for one group whose enclosed groups are already operands
+    (ex. built separately, as incremental.Document does)
+    eqn - a list of MyOp objects with no enclosing operators left in it
+    returns a single MyOp that is the root of the syntax tree
+    Operators wait on a stack until an operator that is applied at the same or
+    a later level of prec_order comes along. This applies operators in the same
+    order as going over eqn once per level of prec_order (i.e. left to right
+    within each level), so "1/2+3" is still "(1/2)+3" and Neg still binds
+    tighter than Pow. Invalid input raises the same error as that would too
+    (see _first_error)"""
+    operands = [] # Subtrees built so far
+    waiting = [] # Operators that haven't consumed their operands yet
+    ranks = [] # Precedence of each waiting operator
+    need_operand = True # Whether the next item has to be an operand or prefix operator
+    for item in eqn:
+        if need_operand and isinstance(item, Sub):
+            # Sub with nothing to subtract from is actually a Neg
+            item = Neg()
+
+        if not (item.nleft or item.nright):
+            # Operand (Num or enclosed group), nothing to consume
+            if not need_operand:
+                # Two operands in a row
+                raise _first_error(eqn)
+            operands.append(item)
+            need_operand = False
+            continue
+
+        rank = _rank(item)
+        if rank is None:
+            # Not in prec_order, so it would never be applied
+            raise _first_error(eqn)
+
+        if item.nleft:
+            # Needs the operand to its left
+            if need_operand:
+                raise _first_error(eqn)
+            # Apply waiting operators from earlier (or the same) levels first
+            while ranks and ranks[-1] <= rank:
+                ranks.pop()
+                waiting.pop().consume(operands)
+        elif not need_operand:
+            # Prefix operator right after an operand (ex. "2 rad2deg 3")
+            raise _first_error(eqn)
+        elif waiting and not waiting[-1].nleft and ranks[-1] <= rank:
+            # Prefix operator applied to a prefix operator from the same or a
+            # later level (ex. "--5")
+            raise _first_error(eqn)
+
+        if item.nright:
+            # Wait for the right operand
+            waiting.append(item)
+            ranks.append(rank)
+            need_operand = True
+        else:
+            # Left operand only, apply right away
+            item.consume(operands)
+
+    if need_operand:
+        # Missing the last operand, or nothing to build a tree from (ex. "()")
+        raise _first_error(eqn)
+    # Apply everything left over, latest first
+    while waiting:
+        waiting.pop().consume(operands)
+    return operands[0]
+
 def make_tree(eqn):
     """Convert eqn into a syntax tree
     eqn - a list of MyOp objects
-    returns a single MyOp that is the root of the sytax tree"""
-    out = deepcopy(eqn) # Copy to preserve input
-    for level in prec_order:
-        # Iterate over the list, consuming items as appropriate
-        i = 0
-        while i < len(out): # Use while instead of for because i changes mid-loop
-            item = out[i]
-            if isinstance(item, level):
-                # MyOp found, incorporate the operands
-                i = item.consume(out, i)
-            # Advance i for the next item
-            i += 1
-    if len(out) != 1:
-        raise ValueError("Tree did not fully collapse. Invalid input")
-    return out[0]
-
-def process(text):
+    returns a single MyOp that is the root of the sytax tree
+    eqn is not modified. Each enclosed group is built into a tree as soon as its
+    closing operator is reached, so the whole conversion is one pass over eqn
+    Errors are raised in the order they were when groups were converted (contents
+    first) as their opening operator was reached, before applying the
+    operators around them: the first unmatched closing operator, unclosed
+    opening operator, or invalid group, then the rest of the outermost group"""
+    groups = [[]] # Contents of each group that is still open, outermost first
+    errors = [None] # First error in a group inside each group that is still open
+    malformed = None # First _Malformed group, raised if nothing else is
+    opens = [] # The opening operator of each group, except the outermost
+    for item in eqn:
+        if isinstance(item, MyEnclosingOp):
+            if item.close is not None:
+                # Open, start a new group
+                opens.append(item)
+                groups.append([])
+                errors.append(None)
+            elif opens and isinstance(item, opens[-1].close):
+                # Close, convert the group to a tree and add it to the group outside
+                contents = groups.pop()
+                error = errors.pop()
+                opener = opens.pop()
+                if error is None:
+                    try:
+                        groups[-1].append(opener.consume(make_group_tree(contents)))
+                        continue
+                    except _Malformed as e:
+                        # Not an error yet, stands in for an operand
+                        malformed = malformed or e
+                        groups[-1].append(opener)
+                        continue
+                    except ValueError as e:
+                        error = e
+                if not opens:
+                    # Nothing before it in the outermost group raised
+                    raise error
+                # Raised only if every group around it turns out to be closed
+                if errors[-1] is None:
+                    errors[-1] = error
+                groups[-1].append(opener)
+            else:
+                # Close, but not for the most recent Open
+                raise ValueError(f"Unmatched or out-of-order closing operator found {_shorten(eqn)}")
+        else:
+            groups[-1].append(item)
+    if opens:
+        raise ValueError(f"{len(opens)} too many opening operators")
+    tree = make_group_tree(groups[0])
+    if malformed is not None:
+        raise malformed
+    return tree
+
+# N-ary class to replace chains of each binary operator with (see simplify_tree)
+_nary_classes = {NaryAdd.binary: NaryAdd,
+                 NaryMul.binary: NaryMul,
+                 }
+
+def _with_operands(op, operands):
+    """Returns a copy of op with its operands replaced, in _operand_names order"""
+    new = copy.copy(op)
+    # new isn't in any tree yet, so it's safe to change
+    if op.nary:
+        _set(new, 'terms', tuple(operands))
+    else:
+        for name, value in zip(op._operand_names, operands):
+            _set(new, name, value)
+    if getattr(new, '_hash', None) is not None:
+        # Copied from op, but no longer right
+        _delete(new, '_hash')
+    return new
+
+def simplify_tree(tree):
+    """Make an equivalent syntax tree that is smaller and faster to apply
+    Parentheses are removed, since the shape of the tree already gives the
+    order of operations. Chains of three or more Adds or Muls down the left
+    side of the tree (ex. "1+2+3+4" or "((1+2)+3)+4") become a single NaryAdd
+    or NaryMul, applied left to right in one loop. Only left chains are joined,
+    since "1+(2+3)" can give a different float than "(1+2)+3", so the new tree
+    always gives exactly the same value as the original
+    tree - root MyOp of a syntax tree (see make_tree). It is not modified
+    returns the root MyOp of the new tree"""
+    done = [] # Simplified subtrees, in postorder
+    todo = [tree] # Subtrees still to simplify, last first. Explicit stack, so deep trees work
+    while todo:
+        item = todo.pop()
+        if item.__class__ is tuple:
+            # All operands of this MyOp have been simplified, rebuild it
+            build, n = item
+            done[-n:] = [build(done[-n:])]
+            continue
+        cls = item.__class__
+        if not getattr(cls, '_operand_names', None):
+            # Value or MyOp with no operands, nothing to simplify. Can be
+            # shared with the original tree
+            done.append(item)
+            continue
+
+        if cls is OpenParen:
+            # Replace with the enclosed tree
+            todo.append(item.enclosed)
+            continue
+
+        nary = _nary_classes.get(cls)
+        if nary is None:
+            operands = item.operands()
+            todo.append((partial(_with_operands, item), len(operands)))
+            todo.extend(reversed(operands))
+            continue
+
+        # Collect the chain from the bottom of the left side, looking through
+        # parentheses
+        terms = [item.right]
+        left = item.left
+        while True:
+            if left.__class__ is OpenParen:
+                left = left.enclosed
+            elif left.__class__ is cls:
+                terms.append(left.right)
+                left = left.left
+            else:
+                break
+        terms.append(left)
+        terms.reverse()
+        if len(terms) > 2:
+            todo.append((lambda terms, nary=nary: nary(*terms), len(terms)))
+        else:
+            todo.append((partial(_with_operands, item), 2))
+        todo.extend(reversed(terms))
+    return done[0]
+
+def _share_key(op):
+    """Returns a key that is the same for two MyOps only if they're the same
+    class with the same values and the same (already shared) operands
+    Values are compared by type and repr, so that ex. 1 and 1.0, or 0.0 and
+    -0.0, are never shared"""
+    values = op.terms if op.nary else [getattr(op, field) for field in op._fields]
+    return (op.__class__, *[id(value) if isinstance(value, MyOp) else (value.__class__, repr(value))
+                            for value in values])
+
+def share_subtrees(tree):
+    """Make an equivalent syntax tree where identical subtrees are a single
+    shared object (hash-consing), ex. every copy of a repeated "(a*b+c)".
+    Apply the result with apply_shared to apply each shared subtree only once
+    tree - root MyOp of a syntax tree. It is not modified
+    returns the root MyOp of the new tree, with its hash already computed"""
+    shared = {} # {_share_key: the one MyOp with that key}
+    done = [] # Shared subtrees, in postorder
+    todo = [tree] # Subtrees still to share, last first. Explicit stack, so deep trees work
+    while todo:
+        item = todo.pop()
+        if item.__class__ is tuple:
+            # All operands of this MyOp have been shared, share it
+            item, n = item
+            operands = done[-n:]
+            del done[-n:]
+            if any(new is not old for new, old in zip(operands, item.operands())):
+                item = _with_operands(item, operands)
+        elif not isinstance(item, MyOp):
+            done.append(item)
+            continue
+        else:
+            operands = item.operands()
+            if operands:
+                # Share the operands first
+                todo.append((item, len(operands)))
+                todo.extend(reversed(operands))
+                continue
+        done.append(shared.setdefault(_share_key(item), item))
+
+    root = done[0]
+    if isinstance(root, MyOp):
+        try:
+            hash(root)
+        except TypeError:
+            # Values that can't be hashed, only equality checks are slower
+            pass
+    return root
+
+_any_space = re.compile(r'\s').search
+
+def _pieces(text):
+    """returns the text of each token and number in text, in order, as parse
+    would find them (whitespace is left out)"""
+    pieces = []
+    last_end = 0 # Where the last match ended
+    lexer, classes = _lexer
+    for match in lexer.finditer(text):
+        op = classes.get(match.lastgroup)
+        if op is Num:
+            # Sign of an exponent, part of the number text around it
+            continue
+        start = match.start()
+        if start > last_end:
+            pieces.append(text[last_end:start])
+        last_end = match.end()
+        if op is not None:
+            pieces.append(match.group())
+    if last_end < len(text):
+        pieces.append(text[last_end:])
+    return pieces
+
+def normalize(text):
+    """Remove whitespace from text, so that texts that parse the same have the
+    same text (ex. for cache keys), however they're spaced. If removing it
+    would join two tokens into one (ex. "2 * * 3" into "2**3") or two numbers
+    into one (ex. "1 2"), there's exactly one space between each token and
+    number instead, so it never changes how the text parses
+    text - string representing an arithmetic expression
+    returns the normalized string"""
+    if not _any_space(text):
+        # Already normalized, skip lexing
+        return text
+    pieces = _pieces(text)
+    joined = ''.join(pieces)
+    if _pieces(joined) == pieces:
+        return joined
+    return ' '.join(pieces)
+
+def process(text, number_type=None, limits=None):
     """Evaluate the string given in text. Equivalent to Python's eval function
     text - string representing an arithmetic expression to evaluate
+    number_type - function to convert numbers with, ex. decimal.Decimal or
+    fractions.Fraction for exact results (see Num.from_text). None for int or
+    float
+    limits - Limits to check text against at each stage, raising
+    LimitExceeded instead of going on. None for no limits
     returns the value of text"""
-    # Remove whitespace
-    text = ''.join(text.split())
-    # Convert string to list of MyOps
-    parsed = parse(text)
+    if _hooks:
+        # Instrumentation is on (see add_hook). Checked first, so that it costs
+        # nothing when off
+        return _process_instrumented(text, number_type, limits)
+    if limits is not None:
+        limits.check_text(text)
+    # Convert string to list of MyOps (whitespace is skipped while parsing)
+    parsed = parse(text, number_type)
+    if limits is not None:
+        limits.check_tokens(parsed)
     # Convert list to syntax tree
     treed = make_tree(parsed)
     # Evaluate the tree
+    if limits is not None:
+        with use_limits(limits):
+            return treed.apply()
     val = treed.apply()
     return val
+
+def process_many(texts, limits=None):
+    """Evaluate every string in texts, like calling process on each one
+    Each distinct expression (after normalizing) is only evaluated once
+    texts - iterable of strings representing arithmetic expressions
+    limits - Limits for each string (see process)
+    returns a list of the value of each string, in order. Where process would
+    raise a ValueError or ArithmeticError (ex. ZeroDivisionError), the entry is
+    the exception instead, so one bad string doesn't stop the rest"""
+    results = {} # {normalized text: value or exception}
+    out = []
+    for text in texts:
+        if limits is not None and limits.max_length is not None and len(text) > limits.max_length:
+            # Too long to even normalize
+            try:
+                limits.check_text(text)
+            except LimitExceeded as e:
+                out.append(e)
+                continue
+        key = normalize(text)
+        try:
+            result = results[key]
+        except KeyError:
+            # First time seeing this expression
+            try:
+                # Texts with the same key parse the same, so the first one stands for all
+                result = process(text) if limits is None else process(text, limits=limits)
+            except (ValueError, ArithmeticError) as e:
+                result = e
+            results[key] = result
+        out.append(result)
+    return out
+
+class LimitExceeded(ValueError):
+    """Raised instead of evaluating input that goes over one of its Limits"""
+
+class Limits:
+    """Limits on how much work one expression can take, for evaluating
+    untrusted input on shared workers. Each limit is None for no limit
+    Usage:
+        limits = Limits(max_length=1000, max_pow_bits=10000)
+        process('9^999999999', limits=limits) # Raises LimitExceeded right away"""
+    def __init__(self, max_length=None, max_tokens=None, max_depth=None, max_pow_bits=None):
+        """max_length - most characters in the text
+        max_tokens - most MyOps parsed from the text (numbers and operators)
+        max_depth - most enclosing operators (ex. parentheses) open at once
+        max_pow_bits - most bits in the result of each Pow of whole numbers
+        (ints, or Fractions), checked before it's calculated. Other Pows
+        can't get big, since floats overflow"""
+        self.max_length = max_length
+        self.max_tokens = max_tokens
+        self.max_depth = max_depth
+        self.max_pow_bits = max_pow_bits
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(max_length={self.max_length}, max_tokens={self.max_tokens}, "
+                f"max_depth={self.max_depth}, max_pow_bits={self.max_pow_bits})")
+
+    def check_text(self, text):
+        """Raise LimitExceeded if text is too long"""
+        if self.max_length is not None and len(text) > self.max_length:
+            raise LimitExceeded(f"Input is {len(text)} characters, over the limit of {self.max_length}")
+
+    def check_tokens(self, eqn):
+        """Raise LimitExceeded if the parsed eqn has too many MyOps or is
+        nested too deeply"""
+        if self.max_tokens is not None and len(eqn) > self.max_tokens:
+            raise LimitExceeded(f"Input has {len(eqn)} tokens, over the limit of {self.max_tokens}")
+        if self.max_depth is not None:
+            depth = 0
+            for item in eqn:
+                if isinstance(item, MyEnclosingOp):
+                    depth += 1 if item.close is not None else -1
+                    if depth > self.max_depth:
+                        raise LimitExceeded(f"Input is nested more than the limit of {self.max_depth} deep")
+
+    def check_pow(self, base, exponent):
+        """Raise LimitExceeded if base ** exponent would have too many bits"""
+        if (self.max_pow_bits is None
+            or not isinstance(base, numbers.Rational)
+            or not isinstance(exponent, numbers.Rational)
+            or exponent.denominator != 1 # Not whole, so the result is a float
+            ):
+            return
+        exponent = exponent.numerator
+        if exponent < 0 and isinstance(base, int):
+            # Result is a float
+            return
+        size = max(abs(base.numerator), base.denominator)
+        if size > 1:
+            bits = abs(exponent) * math.log2(size)
+            if bits > self.max_pow_bits:
+                raise LimitExceeded(f"Power would have about {bits:.0f} bits, over the limit of {self.max_pow_bits}")
+
+# Limits that Pow checks against (see use_limits). A context variable, so each
+# thread (and asyncio task) has its own
+_active_limits = contextvars.ContextVar('limits', default=None)
+
+@contextlib.contextmanager
+def use_limits(limits):
+    """Check every Pow applied in the with block, in this thread, against
+    limits (ex. when evaluating an Expression from compile). process does
+    this itself when given limits
+    limits - Limits, or None for none"""
+    token = _active_limits.set(limits)
+    try:
+        yield limits
+    finally:
+        _active_limits.reset(token)
+
+# Callbacks given a ProcessStats after every process call (see add_hook)
+_hooks = []
+
+def add_hook(callback):
+    """Turn on instrumentation of process, calling callback with a
+    ProcessStats after every call (including calls that raise). Exceptions
+    from callback are raised from process
+    When no hooks are added, process isn't slowed down at all
+    callback - function taking a ProcessStats, ex. a StatsCollector
+    returns callback, so this can be used as a decorator"""
+    _hooks.append(callback)
+    return callback
+
+def remove_hook(callback):
+    """Stop calling callback (see add_hook). Instrumentation turns off once
+    every hook has been removed"""
+    _hooks.remove(callback)
+
+class ProcessStats:
+    """Measurements from one process call
+    text_length - length of the input text
+    times - {stage: seconds} for each of 'parse', 'make_tree', and 'apply'
+    that ran, plus 'total'
+    token_counts - {MyOp class: number of tokens} from parsing
+    node_counts - {MyOp class: number of nodes} in the syntax tree
+    nesting - deepest nesting of enclosing operators (ex. parentheses)
+    tree_depth - number of levels in the syntax tree
+    error - the exception raised, or None
+    Counts and depths are None for stages that didn't finish"""
+    def __init__(self, text_length):
+        self.text_length = text_length
+        self.times = {}
+        self.token_counts = None
+        self.node_counts = None
+        self.nesting = None
+        self.tree_depth = None
+        self.error = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.__dict__})"
+
+def _count_tokens(eqn):
+    """returns the number of each class of MyOp in eqn and the deepest nesting
+    of enclosing operators"""
+    nesting = depth = 0
+    for item in eqn:
+        if isinstance(item, MyEnclosingOp):
+            depth += 1 if item.close is not None else -1
+            nesting = max(nesting, depth)
+    return Counter(item.__class__ for item in eqn), nesting
+
+def _count_nodes(tree):
+    """returns the number of each class of MyOp in the syntax tree and its
+    number of levels"""
+    counts = Counter()
+    deepest = 0
+    todo = [(tree, 1)] # Explicit stack, so deep trees work
+    while todo:
+        item, depth = todo.pop()
+        counts[item.__class__] += 1
+        deepest = max(deepest, depth)
+        todo.extend((operand, depth + 1) for operand in item.operands() if isinstance(operand, MyOp))
+    return counts, deepest
+
+def _process_instrumented(text, number_type=None, limits=None):
+    """process, measuring each stage and passing the results to every hook"""
+    stats = ProcessStats(len(text))
+    times = stats.times
+    clock = time.perf_counter
+    start = clock()
+    try:
+        if limits is not None:
+            limits.check_text(text)
+        parsed = parse(text, number_type)
+        times['parse'] = clock() - start
+        stats.token_counts, stats.nesting = _count_tokens(parsed)
+        if limits is not None:
+            limits.check_tokens(parsed)
+
+        mark = clock()
+        treed = make_tree(parsed)
+        times['make_tree'] = clock() - mark
+        stats.node_counts, stats.tree_depth = _count_nodes(treed)
+
+        mark = clock()
+        if limits is not None:
+            with use_limits(limits):
+                val = treed.apply()
+        else:
+            val = treed.apply()
+        times['apply'] = clock() - mark
+        return val
+    except Exception as e:
+        stats.error = e
+        raise
+    finally:
+        # Counting isn't included in total, only in the time between stages
+        times['total'] = sum(times.values())
+        for hook in list(_hooks):
+            hook(stats)
+
+class StatsCollector:
+    """Hook that adds up the ProcessStats of many process calls, ex. for
+    reporting on real traffic. Safe to share between threads
+    Usage:
+        stats = add_hook(StatsCollector())
+        ... process calls ...
+        remove_hook(stats)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear everything collected so far"""
+        with self._lock:
+            self.calls = 0
+            self.errors = 0
+            self.text_length = 0 # Total over all calls
+            self.times = Counter() # {stage: total seconds}
+            self.token_counts = Counter() # {MyOp class: total}
+            self.node_counts = Counter() # {MyOp class: total}
+            self.max_nesting = 0
+            self.max_tree_depth = 0
+
+    def __call__(self, stats):
+        """Add the ProcessStats of one call"""
+        with self._lock:
+            self.calls += 1
+            self.errors += stats.error is not None
+            self.text_length += stats.text_length
+            self.times.update(stats.times)
+            if stats.token_counts is not None:
+                self.token_counts.update(stats.token_counts)
+                self.max_nesting = max(self.max_nesting, stats.nesting)
+            if stats.node_counts is not None:
+                self.node_counts.update(stats.node_counts)
+                self.max_tree_depth = max(self.max_tree_depth, stats.tree_depth)
+
+    def mean_times(self):
+        """returns {stage: average seconds per call}"""
+        return {stage: seconds / self.calls for stage, seconds in self.times.items()} if self.calls else {}
+
+class Expression:
+    """A parsed expression, ready to be evaluated any number of times without
+    parsing or building the tree again (like a prepared statement)
+    Create with compile"""
+    def __init__(self, tree, keys=(), shared=False):
+        """tree - root MyOp of the syntax tree
+        keys - keys of the Placeholders in tree, in order of first appearance
+        shared - whether tree has shared subtrees to apply only once (see
+        share_subtrees)"""
+        self.tree = tree
+        self.keys = tuple(keys)
+        self.shared = shared
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.tree})"
+
+    def evaluate(self, values=()):
+        """Evaluate the expression
+        values - the numbers to use for the placeholders. A list for positional
+        placeholders, or a dict for named (and/or positional) ones
+        returns the value of the expression"""
+        if self.shared:
+            return self.tree.apply_shared(values)
+        return self.tree.apply(values)
+
+def compile(text, simplify=False, share=False, number_type=None):
+    """Parse and build the syntax tree for text once, so that it can be
+    evaluated many times with different numbers for its placeholders
+    text - string representing an arithmetic expression, where "{name}",
+    "{0}", or "{}" can be used in place of numbers (see Placeholder)
+    simplify - whether to simplify the tree (see simplify_tree). Takes longer
+    to compile, but evaluates faster
+    share - whether to share repeated subexpressions, so each is only
+    evaluated once per evaluation (see share_subtrees). Only faster for
+    expressions with a lot of repetition
+    number_type - function to convert numbers with (see process)
+    returns an Expression"""
+    parsed = parse(text, number_type)
+    keys = {} # Keys of the placeholders, in order of first appearance
+    position = 0 # Position to give the next "{}"
+    numbered = False # Whether any placeholder was numbered by hand
+    for i, item in enumerate(parsed):
+        if isinstance(item, Placeholder):
+            if item.key is None:
+                # Number automatically
+                item = parsed[i] = Placeholder(position)
+                position += 1
+            elif item.key.__class__ is int:
+                numbered = True
+            keys[item.key] = None
+    if position and numbered:
+        raise ValueError("Can't mix automatic ({}) and manual ({0}) placeholder numbering")
+    tree = make_tree(parsed)
+    if simplify:
+        tree = simplify_tree(tree)
+    if share:
+        tree = share_subtrees(tree)
+    return Expression(tree, keys, share)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluate large batches of expressions in parallel across a process pool
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from operators import LimitExceeded, normalize, process, process_many
+
+def _warm_up():
+    """Pool initializer, run once in each worker process so that the first
+    chunk doesn't pay for importing and warming up operators"""
+    process_many(['-(1+2)*3/4^5'])
+
+def _process_each(texts, limits=None):
+    """Evaluate each of texts, which are already distinct, with no normalizing
+    limits - Limits for each string (see process)
+    returns a list of the value (or exception) for each string, as
+    operators.process_many does"""
+    results = []
+    for text in texts:
+        try:
+            results.append(process(text) if limits is None else process(text, limits=limits))
+        except (ValueError, ArithmeticError) as e:
+            results.append(e)
+    return results
+
+class ParallelEvaluator:
+    """Evaluates batches of expressions across a pool of worker processes
+    Results and errors are the same as operators.process_many, in input order.
+    Batches smaller than min_batch are evaluated inline, since starting the
+    pool and sending chunks to it would take longer than evaluating them
+    The pool is started on the first large batch and reused until close (or
+    the end of a with block)"""
+    def __init__(self, max_workers=None, chunksize=2000, min_batch=5000):
+        """max_workers - number of worker processes. None for one per CPU
+        chunksize - number of expressions sent to a worker at a time
+        min_batch - batches smaller than this are evaluated inline"""
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+        self.max_workers = max_workers
+        self.chunksize = chunksize
+        self.min_batch = min_batch
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down the worker processes (if started)"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def process_many(self, texts, limits=None):
+        """Evaluate every string in texts, like operators.process_many
+        texts - iterable of strings representing arithmetic expressions
+        limits - Limits for each string (see operators.process)
+        returns a list of the value (or exception) for each string, in order"""
+        # Normalize here so that duplicates are only evaluated once, whether
+        # inline or by the workers
+        keys = [] # Normalized text of each string, or its LimitExceeded if it's too long
+        distinct = {} # {normalized text: first text with it}. Texts with the same key parse the same
+        for text in texts:
+            if limits is not None and limits.max_length is not None and len(text) > limits.max_length:
+                # Too long to even normalize
+                try:
+                    limits.check_text(text)
+                except LimitExceeded as e:
+                    keys.append(e)
+                    continue
+            key = normalize(text)
+            keys.append(key)
+            distinct.setdefault(key, text)
+        distinct = list(distinct.items())
+        evaluate = _process_each if limits is None else partial(_process_each, limits=limits)
+
+        results = {} # {normalized text: value or exception}
+        if len(distinct) < self.min_batch:
+            results.update(zip([key for key, _ in distinct], evaluate([text for _, text in distinct])))
+        else:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.max_workers, initializer=_warm_up)
+            chunks = [distinct[i:i+self.chunksize] for i in range(0, len(distinct), self.chunksize)]
+            chunk_texts = ([text for _, text in chunk] for chunk in chunks)
+            for chunk, chunk_results in zip(chunks, self._pool.map(evaluate, chunk_texts)):
+                results.update(zip([key for key, _ in chunk], chunk_results))
+        return [key if isinstance(key, LimitExceeded) else results[key] for key in keys]
+
+def process_parallel(texts, max_workers=None, chunksize=2000, min_batch=5000, limits=None):
+    """Evaluate every string in texts across a process pool that only lasts
+    for this call. See ParallelEvaluator to reuse the pool between batches
+    limits - Limits for each string (see operators.process)
+    returns a list of the value (or exception) for each string, in order"""
+    with ParallelEvaluator(max_workers, chunksize, min_batch) as evaluator:
+        return evaluator.process_many(texts, limits)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio server that evaluates expressions sent over a Unix socket or a
+localhost TCP port
+Concurrent requests (from any number of connections) are collected into
+micro-batches and evaluated with process_many in an executor, so the event
+loop stays responsive and per-request overhead is shared across the batch
+
+Protocols, one request per line and one response per line, in request order:
+    'line' - request is the expression. Response is the value, or
+             "error: message"
+    'json' - request is {"id": ..., "expr": "..."}. Response is
+             {"id": ..., "result": ...} or {"id": ..., "error": "...", "type": "..."}
+
+Command line usage:
+    python server.py (--port PORT | --unix PATH) [--protocol line|json]
+        [--max-length N] [--max-tokens N] [--max-depth N] [--max-pow-bits N]
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+
+from operators import Limits, process_many
+
+# Longest request line read, in bytes. Longer requests get an error response
+max_request_bytes = 2**20
+
+class EvaluationServer:
+    """Evaluates expressions from socket connections in micro-batches
+    A batch is sent off once it has batch_size requests, or batch_window
+    seconds after its first request arrived, whichever comes first
+    At most max_queue requests wait for a batch. When the queue is full,
+    connections stop being read until there's room (backpressure)"""
+
+    protocols = ('line', 'json')
+
+    def __init__(self, protocol='line', batch_size=256, batch_window=0.001,
+                 max_queue=4096, executor=None, concurrency=1, limits=None):
+        """protocol - 'line' or 'json' (see module docstring)
+        batch_size - maximum number of requests in a batch
+        batch_window - maximum time in seconds to wait for a batch to fill
+        max_queue - maximum number of requests waiting for a batch
+        executor - concurrent.futures executor to evaluate batches in. None to
+        use (and own) a single thread
+        concurrency - maximum number of batches being evaluated at once. Only
+        useful above 1 if the executor has more than one worker
+        limits - operators.Limits for each request, so one expensive request
+        can't hold up a worker. Requests over them get a LimitExceeded error.
+        None for no limits"""
+        if protocol not in self.protocols:
+            raise ValueError(f"protocol must be one of {self.protocols}, not {protocol!r}")
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.limits = limits
+        self._own_executor = executor is None
+        self._executor = ThreadPoolExecutor(1) if executor is None else executor
+        self._queue = None # Requests waiting for a batch, as (text, future). Made in start
+        self._batcher = None
+        self._in_flight = set() # Tasks evaluating batches
+        self._servers = []
+        self._connections = {} # {task serving a connection: its StreamWriter}
+
+        # Counters
+        self.requests = 0
+        self.batches = 0
+
+    async def start_tcp(self, host='127.0.0.1', port=0):
+        """Start listening on a TCP port (0 to pick a free one)
+        returns the asyncio.Server"""
+        self._start()
+        server = await asyncio.start_server(self._handle, host, port, limit=max_request_bytes)
+        self._servers.append(server)
+        return server
+
+    async def start_unix(self, path):
+        """Start listening on a Unix socket at path
+        returns the asyncio.Server"""
+        self._start()
+        server = await asyncio.start_unix_server(self._handle, path, limit=max_request_bytes)
+        self._servers.append(server)
+        return server
+
+    def _start(self):
+        """Start the batching task, if it isn't running yet"""
+        if self._batcher is None:
+            self._queue = asyncio.Queue(self.max_queue)
+            self._batcher = asyncio.create_task(self._run_batches())
+
+    async def close(self):
+        """Stop listening, close open connections (dropping responses not sent
+        yet), stop batching, and shut down the executor (if owned)"""
+        for server in self._servers:
+            server.close()
+        # wait_closed waits for open connections (from Python 3.12), so close them first
+        connections = list(self._connections.items())
+        for task, writer in connections:
+            writer.close()
+            task.cancel()
+        await asyncio.gather(*[task for task, _ in connections], return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+        if self._own_executor:
+            self._executor.shutdown()
+
+    async def evaluate(self, text):
+        """Queue text for the next batch and wait for its result
+        returns the value, or the exception process would have raised (as with
+        process_many)"""
+        return await (await self._submit(text))
+
+    async def _submit(self, text):
+        """Queue text for the next batch, waiting while the queue is full
+        returns a future for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        self.requests += 1
+        return future
+
+    async def _run_batches(self):
+        """Collect queued requests into batches and evaluate them, forever"""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency) # Batches allowed in flight
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await slots.acquire()
+            self.batches += 1
+            task = asyncio.create_task(self._evaluate_batch(batch))
+            self._in_flight.add(task) # Keep a reference until it's done
+            task.add_done_callback(self._in_flight.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _evaluate_batch(self, batch):
+        """Evaluate a batch in the executor, and give each request its result"""
+        loop = asyncio.get_running_loop()
+        try:
+            texts = [text for text, _ in batch]
+            if self.limits is None:
+                results = await loop.run_in_executor(self._executor, process_many, texts)
+            else:
+                results = await loop.run_in_executor(self._executor, partial(process_many, limits=self.limits), texts)
+        except Exception as e:
+            # Not a per-item error, so the whole batch failed
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done(): # Could have been cancelled
+                future.set_result(result)
+
+    async def _handle(self, reader, writer):
+        """Serve one connection. Requests are read and queued as they arrive, so
+        a client can send many before reading any responses"""
+        loop = asyncio.get_running_loop()
+        self._connections[asyncio.current_task()] = writer
+        pending = asyncio.Queue(self.max_queue) # (request id, future) in request order
+        responder = asyncio.create_task(self._respond(pending, writer))
+        closing = False # Whether the server is closing
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    # End of the stream, after any last line with no newline
+                    line = e.partial
+                    if not line:
+                        break
+                except asyncio.LimitOverrunError:
+                    await _skip_line(reader)
+                    request_id, text = None, ValueError(f"Request is over the limit of {max_request_bytes} bytes")
+                else:
+                    request_id, text = self._read_request(line)
+                if isinstance(text, Exception):
+                    # Bad request, respond with the error without evaluating
+                    future = loop.create_future()
+                    future.set_result(text)
+                else:
+                    # Stops reading from this connection while the queue is full
+                    future = await self._submit(text)
+                await pending.put((request_id, future))
+        except asyncio.CancelledError:
+            closing = True
+            raise
+        finally:
+            del self._connections[asyncio.current_task()]
+            if closing:
+                responder.cancel()
+            else:
+                await pending.put(None) # No more requests
+                await responder
+            writer.close()
+
+    async def _respond(self, pending, writer):
+        """Write each response once it's ready, in request order"""
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            request_id, future = item
+            try:
+                result = await future
+            except Exception as e:
+                result = e
+            try:
+                response = self._format_response(request_id, result)
+            except Exception as e:
+                # Ex. an int with more digits than str converts. Only this
+                # response fails, the rest are still sent
+                response = self._format_response(request_id, e)
+            writer.write(response.encode() + b'\n')
+            if pending.empty():
+                # Flush once nothing else is ready to write
+                await writer.drain()
+        await writer.drain()
+
+    def _read_request(self, line):
+        """returns (request id, expression text), with an exception in place of
+        the text if the request is malformed"""
+        # Without the newline, so it isn't counted in Limits.max_length
+        line = line.rstrip(b'\r\n').decode(errors='replace')
+        if self.protocol == 'line':
+            return None, line
+        try:
+            request = json.loads(line)
+            return request.get('id'), str(request['expr'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None, ValueError(f"Bad request, expected {{\"id\": ..., \"expr\": \"...\"}}: {line.strip()[:100]}")
+
+    def _format_response(self, request_id, result):
+        """returns the response line for result (a value or an exception)"""
+        if self.protocol == 'line':
+            if isinstance(result, Exception):
+                return f"error: {result}"
+            return str(result)
+        if isinstance(result, Exception):
+            return json.dumps({'id': request_id, 'error': str(result), 'type': result.__class__.__name__})
+        if not isinstance(result, (int, float)):
+            # Ex. complex results from fractional powers of negative numbers
+            result = str(result)
+        return json.dumps({'id': request_id, 'result': result})
+
+async def _skip_line(reader):
+    """Discard the rest of a line that is over the stream's limit, up to and
+    including its newline"""
+    while True:
+        try:
+            await reader.readuntil(b'\n')
+            return
+        except asyncio.LimitOverrunError as e:
+            # Drop what's buffered so far (up to the newline, if it's there)
+            await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            # End of the stream
+            return
+
+async def _serve(args):
+    """Run a server from command line arguments until cancelled"""
+    limits = Limits(args.max_length, args.max_tokens, args.max_depth, args.max_pow_bits)
+    server = EvaluationServer(args.protocol, args.batch_size, args.batch_window, args.max_queue, limits=limits)
+    if args.unix:
+        await server.start_unix(args.unix)
+    else:
+        await server.start_tcp('127.0.0.1', args.port)
+    try:
+        await asyncio.Event().wait() # Forever
+    finally:
+        await server.close()
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Serve arithmetic expression evaluation")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--port', type=int, help='localhost TCP port to listen on')
+    where.add_argument('--unix', help='path of a Unix socket to listen on')
+    parser.add_argument('--protocol', choices=EvaluationServer.protocols, default='line')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--batch-window', type=float, default=0.001, help='seconds')
+    parser.add_argument('--max-queue', type=int, default=4096)
+    parser.add_argument('--max-length', type=int, help='most characters in an expression')
+    parser.add_argument('--max-tokens', type=int, help='most numbers and operators in an expression')
+    parser.add_argument('--max-depth', type=int, help='most levels of nested parentheses')
+    parser.add_argument('--max-pow-bits', type=int, help='most bits in the result of a power of integers')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluate newline-delimited expressions from a file or stdin, one line at a
+time, so memory use doesn't grow with the size of the input
+
+Command line usage:
+    python streaming.py [FILE] [--format text|jsonl]
+Reads stdin if FILE is missing or "-"
+"""
+
+import argparse
+import json
+import mmap
+import os
+import stat
+import sys
+
+from operators import process
+
+def _lines(source):
+    """Yields each line of source, without its line ending. Lines from files
+    are bytes, so they can be decoded one at a time (see evaluate_lines)
+    source - path of a file, "-" for stdin, or an open file object
+    Regular files are memory-mapped instead of read. Anything else (ex. a
+    pipe) is read a line at a time"""
+    if not isinstance(source, str):
+        for line in source:
+            yield line
+        return
+    if source == '-':
+        # Bytes, if stdin has them
+        yield from _lines(getattr(sys.stdin, 'buffer', sys.stdin))
+        return
+
+    with open(source, 'rb') as f:
+        status = os.fstat(f.fileno())
+        if not stat.S_ISREG(status.st_mode):
+            # Pipe, socket, or device, which can't be memory-mapped
+            for line in f:
+                yield line[:-1] if line.endswith(b'\n') else line
+            return
+        if status.st_size == 0:
+            # Empty files can't be memory-mapped
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = 0 # Where the next line starts
+            end = len(mapped)
+            while start < end:
+                stop = mapped.find(b'\n', start)
+                if stop == -1:
+                    # Last line, with no newline
+                    stop = end
+                yield mapped[start:stop]
+                start = stop + 1
+
+def evaluate_lines(source):
+    """Evaluate each line of source lazily, one at a time
+    source - path of a file, "-" for stdin, or an iterable of lines (str or
+    UTF-8 bytes)
+    Yields (line_number, value, None) for each valid line and
+    (line_number, None, error) where process raised a ValueError or
+    ArithmeticError, or the line isn't valid UTF-8. Line numbers start at 1.
+    Blank lines are skipped"""
+    for line_number, line in enumerate(_lines(source), 1):
+        try:
+            if isinstance(line, bytes):
+                line = line.decode()
+            if not line.strip():
+                continue
+            value = process(line)
+        except (ValueError, ArithmeticError) as e:
+            # UnicodeDecodeError is a ValueError
+            yield line_number, None, e
+        else:
+            yield line_number, value, None
+
+def _format_value(line_number, value, fmt):
+    """Format a record with a value (see format_record). Raises ValueError for
+    a value that can't be converted to text, ex. an int with more digits
+    than Python converts (see sys.set_int_max_str_digits)"""
+    if fmt == 'jsonl':
+        if not isinstance(value, (int, float)):
+            # Ex. complex results from fractional powers of negative numbers
+            value = str(value)
+        return json.dumps({'line': line_number, 'result': value})
+    return f"{line_number}: {value}"
+
+def format_record(line_number, value, error, fmt='text'):
+    """Format one record from evaluate_lines as a line of output (without a
+    line ending). A value that can't be converted to text is formatted as
+    that line's error instead
+    fmt - 'text' for "line_number: value" / "line_number: error: message", or
+    'jsonl' for one JSON object per line"""
+    if error is None:
+        try:
+            return _format_value(line_number, value, fmt)
+        except ValueError as e:
+            error = e
+    if fmt == 'jsonl':
+        return json.dumps({'line': line_number, 'error': str(error), 'type': error.__class__.__name__})
+    return f"{line_number}: error: {error}"
+
+def main(argv=None):
+    """Command line entry point. Returns the exit status: 0 if every line was
+    valid, 1 otherwise"""
+    parser = argparse.ArgumentParser(description="Evaluate one arithmetic expression per line")
+    parser.add_argument('file', nargs='?', default='-', help='input file, or "-" for stdin (default)')
+    parser.add_argument('--format', choices=['text', 'jsonl'], default='text', help='output format')
+    args = parser.parse_args(argv)
+
+    status = 0
+    write = sys.stdout.write
+    for line_number, value, error in evaluate_lines(args.file):
+        if error is None:
+            try:
+                write(_format_value(line_number, value, args.format) + '\n')
+                continue
+            except ValueError as e:
+                error = e
+        status = 1
+        write(format_record(line_number, None, error, args.format) + '\n')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
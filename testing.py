@@ -90,7 +90,7 @@ class TestTokenizer(unittest.TestCase):
 
 class TestParse(unittest.TestCase):
     """Test the parse top-level function
-    parse assumes that input is a string with no whitespace"""
+    parse skips whitespace itself, but it still separates numbers"""
 
     def test_parse_noParen(self):
         """Test without parentheses"""
@@ -110,6 +110,106 @@ class TestParse(unittest.TestCase):
                   Num(5), Add(), Neg(), Num(6)]
         self.assertEqual(ex_out, parse(ex_in))
 
+    def test_parse_whitespace(self):
+        """Test that whitespace is skipped, but still separates numbers"""
+        from operators import Num, Mul, Add, Sub
+        from operators import parse
+        ex_in = ' 1 +\t2\n* 3 -4 '
+        ex_out = [Num(1), Add(), Num(2), Mul(), Num(3), Sub(), Num(4)]
+        self.assertEqual(ex_out, parse(ex_in))
+        self.assertEqual([Num(1), Num(2)], parse('1 2'))
+
+    def test_parse_neg(self):
+        """Test that "-" is converted to Neg or Sub depending on its left neighbor"""
+        from operators import Num, Neg, OpenParen, CloseParen, Mul, Sub
+        from operators import parse
+        examples = [# Input and output are grouped together
+                    ('-1', [Neg(), Num(1)]),
+                    ('1-1', [Num(1), Sub(), Num(1)]),
+                    ('1*-1', [Num(1), Mul(), Neg(), Num(1)]),
+                    ('(-1)', [OpenParen(), Neg(), Num(1), CloseParen()]),
+                    ('(1)-1', [OpenParen(), Num(1), CloseParen(), Sub(), Num(1)]),
+                    ('--1', [Neg(), Neg(), Num(1)]),
+                    ]
+        for ex_in, ex_out in examples:
+            self.assertEqual(ex_out, parse(ex_in), ex_in)
+
+    def test_parse_shared_nums(self):
+        """Small ints share a Num, other numbers get their own"""
+        from operators import Num
+        from operators import parse
+        eqn = parse('7+7+7.5+7.5+100000+100000')
+        self.assertIs(eqn[0], eqn[2])
+        self.assertIsNot(eqn[4], eqn[6])
+        self.assertIsNot(eqn[8], eqn[10])
+        self.assertEqual([Num(7), Num(7.5), Num(100000)], eqn[2:11:4])
+        self.assertIsNot(Num(7), Num(7)) # Constructor always makes a new Num
+
+    def test_parse_literals(self):
+        """Integer literals are exact ints of any size, other literals floats"""
+        from operators import Num
+        from operators import parse, process, normalize
+        from validation import validate
+        big = 2**64 + 1 # More digits than a float holds
+        self.assertEqual([Num(big)], parse(str(big)))
+        self.assertIs(int, parse(str(big))[0].value.__class__)
+        self.assertEqual(big*3, process(f"{big} * 3"))
+        for text, value in [('1_000', 1000), # Anything int accepts
+                            ('1' * 5000, (10**5000 - 1) // 9), # Past the limit on digits int converts
+                            ('1_' * 3000 + '1', (10**3001 - 1) // 9),
+                            ]:
+            [num] = parse(text)
+            self.assertEqual(value, num.value, text[:20])
+            self.assertIs(int, num.value.__class__, text[:20])
+        self.assertEqual(1001, process('1_000+1'))
+        self.assertEqual([], validate('1' * 5000))
+        for text, value in [('1e3', 1000.0),
+                            ('1E3', 1000.0),
+                            ('2.5e+2', 250.0),
+                            ('1e-3', 0.001),
+                            ('.5', 0.5),
+                            ('3.', 3.0),
+                            ('3.0', 3.0),
+                            ]:
+            [num] = parse(text)
+            self.assertEqual(value, num.value, text)
+            self.assertIs(float, num.value.__class__, text)
+        self.assertEqual(2 - 0.001, process('2-1e-3'))
+        self.assertEqual(1e-3 - 2, process('1e-3-2'))
+        self.assertEqual(float('inf'), process('inf')) # Anything else float accepts still works
+        for text in ['1.2.3', '.', '1e', '1e - 3', '1ee3']:
+            self.assertRaisesRegex(ValueError, "Unknown operator or bad input:", process, text)
+        self.assertRaisesRegex(ValueError, "'1.2.3'", process, '1.2.3')
+        self.assertEqual('1e - 3', normalize('1e - 3')) # Spaces kept, or it would become a number
+
+    def test_parse_exact(self):
+        """Numbers can be converted with Decimal or Fraction instead"""
+        from decimal import Decimal
+        from fractions import Fraction
+        from operators import parse, process, compile
+        self.assertEqual([Decimal('0.1'), 3], [num.value for num in parse("0.1 3", Decimal)])
+        self.assertEqual(Decimal('0.3'), process('0.1 + 0.2', Decimal))
+        self.assertNotEqual(0.3, process('0.1 + 0.2'))
+        self.assertEqual(Decimal('1E+3'), process('1e3', Decimal))
+        self.assertEqual(Fraction(1, 3), process('1/3', Fraction))
+        self.assertEqual(Fraction(1, 1000) - 2, process('1e-3-2', Fraction))
+        self.assertEqual(Fraction(7, 2), compile('{} * 0.5', number_type=Fraction).evaluate([7]))
+        self.assertRaisesRegex(ValueError, "Unknown operator or bad input: '1.2.3'", process, '1.2.3', Decimal)
+        self.assertRaisesRegex(ValueError, "Unknown operator or bad input: '1.2.3'", process, '1.2.3', Fraction)
+
+    def test_slots(self):
+        """Nodes have no per-instance __dict__"""
+        import operators
+        from operators import parse, make_tree, simplify_tree
+        tree = make_tree(parse('-(1+{a}*2.5)^2/3-4'))
+        nodes = [tree, simplify_tree(tree), operators.NaryAdd()]
+        while nodes:
+            node = nodes.pop()
+            self.assertFalse(hasattr(node, '__dict__'), node.__class__.__name__)
+            nodes.extend(value for value in node.operands() if isinstance(value, operators.MyOp))
+        for op in operators.parse_order:
+            self.assertFalse(hasattr(op(), '__dict__'), op.__name__)
+
 class TestTree(unittest.TestCase):
     def test_tree_noParen(self):
         from operators import Num, Neg, Mul, Div, Add, Sub
@@ -161,6 +261,58 @@ class TestTree(unittest.TestCase):
                      )
         self.assertEqual(ex_out, make_tree(ex_in))
 
+    def test_tree_precedence(self):
+        """Test that each level of prec_order is applied in order, left to right"""
+        from operators import Num, Neg, Pow, Mul, Div, Add, Sub
+        from operators import make_tree
+        examples = [# Input and output are grouped together
+                    ([Num(1), Div(), Num(2), Add(), Num(3)], # 1/2+3
+                     Add(Div(Num(1), Num(2)), Num(3))),
+                    ([Num(1), Sub(), Num(2), Sub(), Num(3)], # 1-2-3
+                     Sub(Sub(Num(1), Num(2)), Num(3))),
+                    ([Num(2), Pow(), Num(3), Pow(), Num(2)], # 2^3^2
+                     Pow(Pow(Num(2), Num(3)), Num(2))),
+                    ([Neg(), Num(2), Pow(), Num(2)], # -2^2
+                     Pow(Neg(None, Num(2)), Num(2))),
+                    ([Num(3), Mul(), Neg(), Num(2), Pow(), Num(2)], # 3*-2^2
+                     Mul(Num(3), Pow(Neg(None, Num(2)), Num(2)))),
+                    ]
+        for ex_in, ex_out in examples:
+            self.assertEqual(ex_out, make_tree(ex_in), ex_in)
+
+    def test_group_tree(self):
+        """make_group_tree builds one group, with enclosed groups already operands"""
+        from operators import Num, OpenParen, Mul, Add
+        from operators import make_group_tree
+        group = OpenParen(Add(Num(1), Num(2)))
+        self.assertEqual(Mul(Num(3), group), make_group_tree([Num(3), Mul(), group]))
+        self.assertRaisesRegex(ValueError, "Operator at end of eqn", make_group_tree, [Num(3), Mul()])
+
+    def test_tree_preserves_input(self):
+        """Test that make_tree doesn't modify its input"""
+        from operators import Num, OpenParen, CloseParen, Mul, Add
+        from operators import make_tree
+        ex_in = [OpenParen(), Num(1), Add(), Num(2), CloseParen(), Mul(), Num(3)]
+        expected = [OpenParen(), Num(1), Add(), Num(2), CloseParen(), Mul(), Num(3)]
+        make_tree(ex_in)
+        self.assertEqual(expected, ex_in)
+
+    def test_tree_long_chain(self):
+        """Test a long flat chain, which used to be quadratic"""
+        from operators import Num, Add
+        from operators import make_tree
+        n = 50000
+        ex_in = [Num(1)]
+        for _ in range(n-1):
+            ex_in.extend([Add(), Num(1)])
+        tree = make_tree(ex_in)
+        # Left-associative, so the deepest Add is on the far left
+        depth = 0
+        while isinstance(tree, Add):
+            tree = tree.left
+            depth += 1
+        self.assertEqual(n-1, depth)
+
 class TestApply(unittest.TestCase):
     """Test the apply function, starting from a valid tree"""
     def test_apply_num(self):
@@ -215,6 +367,22 @@ class TestApply(unittest.TestCase):
         ex_out = 1+2*3.4-5/6+-7
         self.assertEqual(ex_out, ex_in.apply(), 'Complex Apply')
 
+        for ex_in in [OpenParen(0), OpenParen(Num(0)), Add(OpenParen(0), Num(0))]:
+            # Falsy values are still enclosed, with or without recursion
+            self.assertEqual(0, ex_in.apply(), ex_in)
+            self.assertEqual(0, ex_in.apply_shared(), ex_in)
+
+    def test_apply_repeated(self):
+        """Test that apply doesn't modify the tree, so it can be applied again"""
+        from operators import Num, Neg, OpenParen, Mul, Add
+
+        ex_in = Mul(OpenParen(Add(Num(1),Neg(None,Num(2)))),Num(3.2))
+        expected = Mul(OpenParen(Add(Num(1),Neg(None,Num(2)))),Num(3.2))
+        ex_out = (1+-2)*3.2
+        for _ in range(3):
+            self.assertEqual(ex_out, ex_in.apply())
+        self.assertEqual(expected, ex_in)
+
 
 class TestFull(unittest.TestCase):
     """Test the full functionality, from string to value. Equivalent to eval"""
@@ -284,6 +452,1133 @@ class TestFull(unittest.TestCase):
             my_answer = process(text)
             self.assertEqual(my_answer, python_answer, text)
 
+class TestCompile(unittest.TestCase):
+    """Test compiling expressions with placeholders, then evaluating them"""
+    def test_named(self):
+        from operators import compile
+        expr = compile('{a} * ({b} + 2) ^ {a} - {max}') # "x" in max isn't Mul
+        self.assertEqual(('a', 'b', 'max'), expr.keys)
+        for a, b, m in [(2, 1, 3), (1.5, -4, 0), (0, 0, 0)]:
+            self.assertEqual(a * (b + 2) ** a - m, expr.evaluate({'a': a, 'b': b, 'max': m}))
+
+    def test_positional(self):
+        from operators import compile
+        expr = compile('{} + {}*{}')
+        self.assertEqual((0, 1, 2), expr.keys)
+        self.assertEqual(1 + 2*3, expr.evaluate([1, 2, 3]))
+        expr = compile('{1} - {0}/{1}')
+        self.assertEqual((1, 0), expr.keys)
+        self.assertEqual(4 - 2/4, expr.evaluate([2, 4]))
+        self.assertEqual(4 - 2/4, expr.evaluate({0: 2, 1: 4}))
+
+    def test_no_reparse(self):
+        """Test that evaluating doesn't parse or build the tree again"""
+        import operators
+        expr = operators.compile('-{x} + 1')
+        parse, make_tree = operators.parse, operators.make_tree
+        def fail(*args):
+            raise AssertionError("Should not be called")
+        try:
+            operators.parse = operators.make_tree = fail
+            self.assertEqual([0, -1, 1.5], [expr.evaluate({'x': x}) for x in (1, 2, -0.5)])
+        finally:
+            operators.parse, operators.make_tree = parse, make_tree
+
+    def test_missing_values(self):
+        from operators import compile, process
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {b}",
+                               compile('{a}+{b}').evaluate, {'a': 1})
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {1}",
+                               compile('{}+{}').evaluate, [1])
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {a}",
+                               compile('{a}+1').evaluate, [1])
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {}",
+                               process, '{}+1')
+        self.assertRaisesRegex(ValueError, "Can't mix automatic",
+                               compile, '{}+{0}')
+
+class TestSimplify(unittest.TestCase):
+    """Test removing parentheses and joining chains of Add/Mul"""
+    def test_simplify(self):
+        from operators import Num, Placeholder, Add, Sub, NaryAdd, NaryMul
+        from operators import parse, make_tree, simplify_tree
+        examples = [# Input and output are grouped together
+                    ('(1)', Num(1)),
+                    ('1+2', Add(Num(1), Num(2))), # Too short to join
+                    ('1+2+3+4', NaryAdd(Num(1), Num(2), Num(3), Num(4))),
+                    ('((1+2)+3)*4*(5)', NaryMul(NaryAdd(Num(1), Num(2), Num(3)), Num(4), Num(5))),
+                    ('1+(2+3)+4', NaryAdd(Num(1), Add(Num(2), Num(3)), Num(4))), # Right side isn't joined
+                    ('1+2-3+4', Add(Sub(Add(Num(1), Num(2)), Num(3)), Num(4))),
+                    ('{a}*{a}*2', NaryMul(Placeholder('a'), Placeholder('a'), Num(2))),
+                    ]
+        for ex_in, ex_out in examples:
+            tree = make_tree(parse(ex_in))
+            original = repr(tree)
+            self.assertEqual(ex_out, simplify_tree(tree), ex_in)
+            self.assertEqual(original, repr(tree), ex_in) # Not modified
+
+    def test_same_values(self):
+        """Test that simplified trees give exactly the same values, even for floats"""
+        from operators import compile
+        texts = ['0.1+0.2+0.3', '(0.1+0.2)+0.3', '0.1+(0.2+0.3)', '1e300*10*0.1',
+                 '-(0.1*3)^2*0.7*{x}/3+{x}+{x}+0.1', '2^-1*{x}*{x}*{x}']
+        for text in texts:
+            expr, simplified = compile(text), compile(text, simplify=True)
+            for x in (0.1, -3, 1.5):
+                self.assertEqual(repr(expr.evaluate({'x': x})), repr(simplified.evaluate({'x': x})), text)
+
+    def test_deep(self):
+        from operators import compile, NaryAdd
+        n = 5000
+        text = '('*n + '1' + '+0.1)'*n
+        expr = compile(text, simplify=True)
+        self.assertIsInstance(expr.tree, NaryAdd)
+        self.assertEqual(n+1, len(expr.tree.terms))
+        self.assertEqual(compile(text).evaluate(), expr.evaluate())
+        text = '1+(0.1*'*n + '2' + ')'*n
+        self.assertEqual(compile(text).evaluate(), compile(text, simplify=True).evaluate())
+
+class TestShare(unittest.TestCase):
+    """Test structural hashing and sharing identical subtrees"""
+    def test_hash(self):
+        from operators import Num, Add, Neg, parse, make_tree
+        trees = {make_tree(parse(text)): text for text in ['1+2*3', '(1+2)*3', '1+2*3.5', '1 + 2*3']}
+        self.assertEqual(3, len(trees))
+        self.assertEqual('1 + 2*3', trees[make_tree(parse('1+2*3'))])
+        self.assertEqual(hash(Num(1)), hash(Num(1.0))) # Equal, so they hash the same
+        self.assertNotEqual(hash(Add(Num(1), Num(2))), hash(Add(Num(2), Num(1))))
+        self.assertEqual(hash(Neg(None, Num(5))), hash(make_tree(parse('-5'))))
+
+    def test_share_subtrees(self):
+        from operators import parse, make_tree, share_subtrees, simplify_tree
+        tree = make_tree(parse('(1+2*3)*(1+2*3) - (1+2*3.5)'))
+        shared = share_subtrees(tree)
+        self.assertEqual(tree, shared)
+        self.assertEqual(repr(tree), repr(shared))
+        self.assertIs(shared.left.left, shared.left.right)
+        self.assertIsNot(tree.left.left, tree.left.right) # Original not modified
+        self.assertIsNot(shared.left.left.enclosed, shared.right.enclosed) # Not the same value
+        self.assertEqual(tree.apply(), shared.apply_shared())
+
+        simplified = share_subtrees(simplify_tree(make_tree(parse('{a}*{a}*{a} + {a}*{a}*{a} + 1'))))
+        self.assertIs(simplified.terms[0], simplified.terms[1])
+
+    def test_evaluated_once(self):
+        from operators import compile
+        class CountingDict(dict):
+            lookups = 0
+            def __getitem__(self, key):
+                CountingDict.lookups += 1
+                return dict.__getitem__(self, key)
+        text = '({a}+1)*({a}+1)/({a}+1)'
+        self.assertEqual(2.5, compile(text).evaluate(CountingDict(a=1.5)))
+        self.assertEqual(3, CountingDict.lookups)
+        CountingDict.lookups = 0
+        self.assertEqual(2.5, compile(text, share=True).evaluate(CountingDict(a=1.5)))
+        self.assertEqual(1, CountingDict.lookups)
+
+class TestProcessMany(unittest.TestCase):
+    """Test evaluating a batch of expressions"""
+    def test_matches_process(self):
+        """Each result is what process gives for that text, however it's spaced"""
+        from operators import process, process_many
+        texts = ['2 * * 3', '2**3', '2 ** 3', '1e - 3', '1e-3', '3 - - 2', '3--2', '1 2', '12']
+        for text, result in zip(texts, process_many(texts)):
+            try:
+                expected = process(text)
+            except ValueError as e:
+                self.assertEqual((type(e), str(e)), (type(result), str(result)), text)
+            else:
+                self.assertEqual(expected, result, text)
+
+    def test_results_in_order(self):
+        from operators import process_many
+        texts = ['1+1', '(3 + 4) * 6', '1 + 1', '2^3', ' 1+1 ']
+        self.assertEqual([2, 42, 2, 8, 2], process_many(texts))
+        self.assertEqual([], process_many([]))
+        self.assertEqual([3, 4], process_many(iter(['1+2', '2*2']))) # Any iterable
+
+    def test_errors(self):
+        """Bad items are returned as exceptions without stopping the batch"""
+        from operators import process_many
+        results = process_many(['1+', '2*3', '4%3', '1/0', '(1'])
+        self.assertEqual(6, results[1])
+        for i, pattern in [(0, "Operator at end of eqn"),
+                           (2, "Unknown operator or bad input"),
+                           (4, "1 too many opening operators")]:
+            self.assertIsInstance(results[i], ValueError)
+            self.assertRegex(str(results[i]), pattern)
+        self.assertIsInstance(results[3], ZeroDivisionError)
+
+    def test_duplicates_evaluated_once(self):
+        import operators
+        calls = []
+        process = operators.process
+        def counting_process(text):
+            calls.append(text)
+            return process(text)
+        try:
+            operators.process = counting_process
+            operators.process_many(['1 + 2', '1+2', '3', '1+ 2', '3'])
+        finally:
+            operators.process = process
+        self.assertEqual(['1 + 2', '3'], calls)
+
+class TestInstrumentation(unittest.TestCase):
+    """Test the hooks called with measurements of each process call"""
+    def test_stats(self):
+        from operators import Num, Add, Mul, OpenParen, CloseParen
+        from operators import add_hook, remove_hook, process
+        calls = []
+        add_hook(calls.append)
+        try:
+            self.assertEqual(9, process('(1 + 2) * (3)'))
+        finally:
+            remove_hook(calls.append)
+        process('1+1') # Not recorded
+        self.assertEqual(1, len(calls))
+        stats = calls[0]
+        self.assertEqual(13, stats.text_length)
+        self.assertEqual({'parse', 'make_tree', 'apply', 'total'}, set(stats.times))
+        self.assertAlmostEqual(stats.times['total'], sum(stats.times.values()) - stats.times['total'])
+        self.assertEqual({Num: 3, Add: 1, Mul: 1, OpenParen: 2, CloseParen: 2}, stats.token_counts)
+        self.assertEqual({Num: 3, Add: 1, Mul: 1, OpenParen: 2}, stats.node_counts)
+        self.assertEqual(1, stats.nesting)
+        self.assertEqual(4, stats.tree_depth) # Mul, OpenParen, Add, Num
+        self.assertIsNone(stats.error)
+
+    def test_collector(self):
+        from operators import add_hook, remove_hook, process, StatsCollector, Num
+        collector = add_hook(StatsCollector())
+        try:
+            process('((1))')
+            self.assertRaises(ValueError, process, '1+')
+            self.assertRaises(ZeroDivisionError, process, '1/0')
+        finally:
+            remove_hook(collector)
+        self.assertEqual(3, collector.calls)
+        self.assertEqual(2, collector.errors)
+        self.assertEqual(10, collector.text_length)
+        self.assertEqual(2, collector.max_nesting)
+        self.assertEqual(3, collector.node_counts[Num]) # '1+' never made a tree
+        self.assertEqual({'parse', 'make_tree', 'apply', 'total'}, set(collector.mean_times()))
+        collector.reset()
+        self.assertEqual(0, collector.calls)
+        self.assertEqual({}, collector.mean_times())
+
+class TestParallel(unittest.TestCase):
+    """Test evaluating batches across a process pool"""
+    def test_matches_serial(self):
+        from operators import process_many
+        from parallel import ParallelEvaluator
+        texts = [f"{i} * (2 + {i % 7}) - 3^2" for i in range(200)]
+        texts += ['1+', '1/0', '4 % 3'] + texts[:50] # Errors and duplicates
+        texts += ['2 * * 3', '2**3', '2 ** 3'] # Same spacing as each other apart from joining tokens
+        expected = process_many(texts)
+        self.assertIsInstance(expected[-3], ValueError)
+        self.assertEqual([8, 8], expected[-2:])
+        with ParallelEvaluator(max_workers=2, chunksize=16, min_batch=0) as evaluator:
+            for _ in range(2): # Reuses the pool
+                actual = evaluator.process_many(texts)
+                self.assertIsNotNone(evaluator._pool)
+                self.assertEqual(len(expected), len(actual))
+                for exp, act in zip(expected, actual):
+                    if isinstance(exp, Exception):
+                        self.assertEqual((type(exp), str(exp)), (type(act), str(act)))
+                    else:
+                        self.assertEqual(exp, act)
+        self.assertIsNone(evaluator._pool)
+
+    def test_small_batch_inline(self):
+        from parallel import ParallelEvaluator, process_parallel
+        evaluator = ParallelEvaluator(min_batch=100)
+        self.assertEqual([2, 6], evaluator.process_many(['1+1', '2*3']))
+        self.assertIsNone(evaluator._pool) # Never started
+        self.assertEqual([2, 6], process_parallel(['1+1', '2*3']))
+
+    def test_limits(self):
+        """Limits apply to each string, whether evaluated inline or by the workers"""
+        from operators import Limits, LimitExceeded, process_many
+        from parallel import ParallelEvaluator
+        limits = Limits(max_length=20, max_pow_bits=1000)
+        texts = ['2^10', '9^999999999', '1+' * 20 + '1', '2^10', '3*3']
+        expected = process_many(texts, limits)
+        for min_batch in [0, 100]:
+            with ParallelEvaluator(max_workers=2, chunksize=2, min_batch=min_batch) as evaluator:
+                actual = evaluator.process_many(texts, limits)
+            self.assertEqual([1024, 1024, 9], [actual[0], actual[3], actual[4]])
+            for i in [1, 2]:
+                self.assertIsInstance(actual[i], LimitExceeded)
+                self.assertEqual(str(expected[i]), str(actual[i]))
+
+class TestStreaming(unittest.TestCase):
+    """Test evaluating newline-delimited expressions from a file"""
+    def setUp(self):
+        import tempfile, os
+        fd, self.path = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'1 + 1\r\n(3 + 4) * 6\n\n1+\n2^3') # Mixed line endings, no final newline
+
+    def tearDown(self):
+        import os
+        os.remove(self.path)
+
+    def test_evaluate_lines(self):
+        from streaming import evaluate_lines
+        for source in [self.path, ['1 + 1\n', '(3 + 4) * 6\n', '\n', '1+\n', '2^3']]:
+            records = list(evaluate_lines(source))
+            self.assertEqual([(1, 2, None), (2, 42, None), (5, 8, None)],
+                             [r for r in records if r[2] is None])
+            self.assertEqual(4, records[2][0])
+            self.assertIsInstance(records[2][2], ValueError)
+
+    def test_main(self):
+        import contextlib, io, json
+        from streaming import main
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            status = main([self.path, '--format', 'jsonl'])
+        self.assertEqual(1, status) # Line 4 is invalid
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([1, 2, 4, 5], [r['line'] for r in records])
+        self.assertEqual(42, records[1]['result'])
+        self.assertEqual('ValueError', records[2]['type'])
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            main([self.path])
+        self.assertEqual('1: 2', out.getvalue().splitlines()[0])
+        self.assertTrue(out.getvalue().splitlines()[2].startswith('4: error: '))
+
+    def test_bad_encoding(self):
+        """A line that isn't UTF-8 is an error for that line only"""
+        from streaming import evaluate_lines
+        with open(self.path, 'wb') as f:
+            f.write(b'1 + 1\n\xff\xfe\n2^3\n')
+        records = list(evaluate_lines(self.path))
+        self.assertEqual([(1, 2, None), (3, 8, None)], [r for r in records if r[2] is None])
+        self.assertEqual(2, records[1][0])
+        self.assertIsInstance(records[1][2], UnicodeDecodeError)
+
+    @unittest.skipUnless(hasattr(__import__('sys'), 'get_int_max_str_digits'), "No limit on digits converted")
+    def test_unformattable_result(self):
+        """A result that can't be converted to text (an int over Python's limit
+        on digits) is an error for that line, and later lines are still written"""
+        import contextlib, io, json
+        from streaming import main, format_record
+        with open(self.path, 'w') as f:
+            f.write('10^5000\n1+1\n')
+        for fmt in ['text', 'jsonl']:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = main([self.path, '--format', fmt])
+            self.assertEqual(1, status)
+            lines = out.getvalue().splitlines()
+            self.assertEqual(2, len(lines))
+            if fmt == 'text':
+                self.assertTrue(lines[0].startswith('1: error: '))
+                self.assertEqual('2: 2', lines[1])
+            else:
+                self.assertEqual('ValueError', json.loads(lines[0])['type'])
+                self.assertEqual({'line': 2, 'result': 2}, json.loads(lines[1]))
+        self.assertTrue(format_record(1, 10**5000, None).startswith('1: error: '))
+
+    @unittest.skipUnless(hasattr(__import__('os'), 'mkfifo'), "Needs named pipes")
+    def test_pipe(self):
+        """Pipes aren't regular files, but are still read"""
+        import os, tempfile, threading
+        from streaming import evaluate_lines
+        path = os.path.join(tempfile.mkdtemp(), 'pipe')
+        os.mkfifo(path)
+        def write():
+            with open(path, 'wb') as f:
+                f.write(b'1 + 1\n2^3')
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.assertEqual([(1, 2, None), (2, 8, None)], list(evaluate_lines(path)))
+        writer.join()
+        os.remove(path)
+
+class TestServer(unittest.TestCase):
+    """Test the asyncio evaluation server"""
+    def run_client(self, protocol, lines, unix=False, **kwargs):
+        """Start a server, send all of lines over one connection before reading
+        any responses, and return the responses and the server"""
+        import asyncio, os, tempfile
+        from server import EvaluationServer
+
+        async def client():
+            server = EvaluationServer(protocol, **kwargs)
+            try:
+                if unix:
+                    path = os.path.join(tempfile.mkdtemp(), 'eval.sock')
+                    await server.start_unix(path)
+                    reader, writer = await asyncio.open_unix_connection(path)
+                else:
+                    listening = await server.start_tcp()
+                    port = listening.sockets[0].getsockname()[1]
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(''.join(line + '\n' for line in lines).encode())
+                await writer.drain()
+                responses = [(await reader.readline()).decode().rstrip('\n') for _ in lines]
+                writer.close()
+                return responses, server
+            finally:
+                await server.close()
+        return asyncio.run(client())
+
+    def test_line_protocol(self):
+        lines = ['1 + 1', '(3 + 4) * 6', '3*', '1/0', '2^3']
+        responses, server = self.run_client('line', lines, batch_window=0.05)
+        self.assertEqual(['2', '42'], responses[:2])
+        self.assertTrue(responses[2].startswith('error: Operator at end of eqn'))
+        self.assertEqual('error: division by zero', responses[3])
+        self.assertEqual('8', responses[4])
+        self.assertEqual(5, server.requests)
+        self.assertLess(server.batches, 5) # Pipelined requests share batches
+
+    def test_json_protocol(self):
+        import json
+        lines = [json.dumps({'id': i, 'expr': f"{i}*2"}) for i in range(100)] + ['not json']
+        responses, server = self.run_client('json', lines, unix=True, batch_size=10)
+        responses = [json.loads(r) for r in responses]
+        self.assertEqual([{'id': i, 'result': i*2} for i in range(100)], responses[:100])
+        self.assertEqual('ValueError', responses[100]['type'])
+        self.assertGreaterEqual(server.batches, 10) # Limited by batch_size
+
+    def test_backpressure(self):
+        """A queue smaller than the number of requests still serves everything"""
+        lines = [f"{i}+1" for i in range(200)]
+        responses, _ = self.run_client('line', lines, max_queue=4, batch_size=2)
+        self.assertEqual([str(i+1) for i in range(200)], responses)
+
+    def test_limits(self):
+        from operators import Limits
+        lines = ['2^10', '9^999999999', '1' * 100]
+        responses, _ = self.run_client('line', lines, limits=Limits(max_length=50, max_pow_bits=1000))
+        self.assertEqual('1024', responses[0])
+        self.assertTrue(responses[1].startswith('error: Power would have about'))
+        self.assertTrue(responses[2].startswith('error: Input is 100 characters')) # Without the newline
+
+    def test_long_request(self):
+        """A request over the stream limit gets an error, and the connection keeps going"""
+        from server import max_request_bytes
+        lines = ['2+2', '1+' * max_request_bytes + '1', '3+3']
+        responses, server = self.run_client('line', lines)
+        self.assertEqual('4', responses[0])
+        self.assertTrue(responses[1].startswith('error: Request is over the limit'))
+        self.assertEqual('6', responses[2])
+        self.assertEqual(2, server.requests)
+
+    def test_unformattable_result(self):
+        """A result that can't be formatted (an int over Python's limit on
+        digits converted to text) gets an error, and later responses are still sent"""
+        import json
+        big = '1' + '0' * 5000
+        responses, _ = self.run_client('line', ['10^5000', '1+1', '2^3'])
+        self.assertEqual(['2', '8'], responses[1:])
+        self.assertTrue(responses[0].startswith('error: ') or responses[0] == big, responses[0][:50])
+        lines = [json.dumps({'id': i, 'expr': expr}) for i, expr in enumerate(['10^5000', '1+1'])]
+        responses, _ = self.run_client('json', lines)
+        responses = [json.loads(r) for r in responses]
+        self.assertEqual({'id': 1, 'result': 2}, responses[1])
+        self.assertEqual(0, responses[0]['id'])
+        self.assertTrue('error' in responses[0] or responses[0]['result'] == int(big))
+
+    def test_close_with_clients(self):
+        """Closing doesn't wait for connected clients to disconnect"""
+        import asyncio
+        from server import EvaluationServer
+
+        async def client():
+            server = EvaluationServer()
+            listening = await server.start_tcp()
+            port = listening.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'1+1\n')
+            self.assertEqual(b'2\n', await reader.readline())
+            await asyncio.wait_for(server.close(), 5)
+            self.assertEqual(b'', await asyncio.wait_for(reader.read(), 5)) # Closed by the server
+            writer.close()
+        asyncio.run(client())
+
+def _has_numpy():
+    """Whether the optional NumPy dependency is installed"""
+    import importlib.util
+    return importlib.util.find_spec('numpy') is not None
+
+@unittest.skipUnless(_has_numpy(), "NumPy not installed")
+class TestVectorized(unittest.TestCase):
+    """Test evaluating one expression over whole arrays"""
+    def test_matches_process(self):
+        import numpy as np
+        from operators import process
+        from vectorized import evaluate_arrays
+        a = np.array([1, 2, -3, 4, 0])
+        b = np.array([0.5, -1.5, 2.0, 3.25, 7.0])
+        c = np.array([2, -1, 3, -2, 1])
+        for text in ['{a} + {b}*2 - -{a}',
+                     '({a} - {b}) / 4 x {b}',
+                     '{a}^{c} + 2^{c}', # Negative integer powers
+                     '-{b}^2',
+                     '7',
+                     ]:
+            actual = evaluate_arrays(text, {'a': a, 'b': b, 'c': c})
+            for i in range(len(a)):
+                row = text.replace('{a}', f"({a[i]})").replace('{b}', f"({b[i]})").replace('{c}', f"({c[i]})")
+                self.assertEqual(process(row), np.broadcast_to(actual, a.shape)[i], row)
+
+    def test_positional_and_compiled(self):
+        import numpy as np
+        from operators import compile
+        from vectorized import evaluate_arrays
+        expr = compile('{} * ({} + 1)')
+        actual = evaluate_arrays(expr, [np.arange(3), [[1], [2]]]) # Broadcasts to 2x3
+        np.testing.assert_array_equal([[0, 2, 4], [0, 3, 6]], actual)
+        # Rows that would raise are inf or nan instead
+        np.testing.assert_array_equal([np.inf, 1.0], evaluate_arrays(compile('1/{}').tree, [[0, 1]]))
+
+    def test_no_wraparound(self):
+        """Integers that don't fit in the arrays' dtype aren't wrapped around"""
+        import numpy as np
+        from operators import process
+        from vectorized import evaluate_arrays
+        self.assertEqual(process('10^20'), evaluate_arrays('10^20', {})) # No placeholders
+        self.assertEqual(process('3^40+0.5'), evaluate_arrays('3^40 + {a}', {'a': [0.5]})[0])
+        a = np.array([2**62, 5])
+        b = np.array([70, 2])
+        for text in ['{a} * 3', '3^40 + {a}', '2^{b} + 1', '-{a} - {a} - {a}']:
+            actual = evaluate_arrays(text, {'a': a, 'b': b})
+            for i in range(len(a)):
+                row = text.replace('{a}', f"({a[i]})").replace('{b}', f"({b[i]})")
+                self.assertEqual(process(row), actual[i], row)
+        self.assertEqual(np.int64, evaluate_arrays('{a} * 2', {'a': np.array([2**61, 5])}).dtype) # Still fits
+        np.testing.assert_array_equal([-2, 2], evaluate_arrays('{} - 3', [np.array([1, 5], dtype=np.uint8)]))
+
+class TestIncremental(unittest.TestCase):
+    """Test keeping a document evaluated as it is edited"""
+    def test_edits(self):
+        from operators import process
+        from incremental import Document
+        doc = Document('(1+2)*3')
+        self.assertEqual(9, doc.evaluate())
+        edits = [(3, 4, '20'), # '(1+20)*3'
+                 (0, 0, '-'), # '-(1+20)*3'
+                 (8, 9, '(4-(1))'), # '-(1+20)*(4-(1))'
+                 (7, 8, ''), # '-(1+20)(4-(1))'
+                 (7, 7, '/'), # '-(1+20)/(4-(1))'
+                 (11, 11, '(2'), # '-(1+20)/(4-(2(1))', unbalanced
+                 (13, 13, ')-'), # '-(1+20)/(4-(2)-(1))'
+                 (9, 10, ' 4 '), # '-(1+20)/( 4 -(2)-(1))'
+                 ]
+        for start, end, text in edits:
+            doc.edit(start, end, text)
+            try:
+                expected = process(doc.text)
+            except ValueError:
+                self.assertRaises(ValueError, doc.evaluate)
+            else:
+                self.assertEqual(expected, doc.evaluate(), doc.text)
+        self.assertEqual('-(1+20)/( 4 -(2)-(1))', doc.text)
+        self.assertEqual(-21, doc.evaluate())
+        doc.edit(0, len(doc.text), '1/(1-1)')
+        self.assertRaises(ZeroDivisionError, doc.evaluate)
+        self.assertRaises(ValueError, doc.edit, 5, 100, '')
+
+    def test_only_edit_relexed(self):
+        import incremental
+        terms = ['(1+2*3)']*200
+        doc = incremental.Document('+'.join(terms))
+        self.assertEqual(1400, doc.evaluate())
+        lexed = []
+        parse = incremental.parse
+        def recording_parse(text):
+            lexed.append(text)
+            return parse(text)
+        try:
+            incremental.parse = recording_parse
+            doc.edit(801, 802, '5') # First number of the 101st term
+            self.assertEqual(1404, doc.evaluate())
+        finally:
+            incremental.parse = parse
+        self.assertEqual(['5+2*3'], lexed)
+
+    def test_deep(self):
+        from incremental import Document
+        n = 5000
+        doc = Document('('*n + '1' + ')'*n)
+        self.assertEqual(1, doc.evaluate())
+        doc.edit(n, n+1, '2+3')
+        self.assertEqual(5, doc.evaluate())
+
+class TestBytecode(unittest.TestCase):
+    """Test lowering trees to bytecode and running it"""
+    def test_matches_process(self):
+        from operators import process, compile
+        from bytecode import compile_program
+        from benchmarks import generate
+        for seed in range(20):
+            text = generate(30, depth=seed % 5, ops='+-*/x^', negate=0.2, seed=seed)
+            expected = process(text)
+            for expr in [text, compile(text), compile(text, simplify=True), compile(text, share=True)]:
+                self.assertEqual(expected, compile_program(expr).run(), text)
+
+    def test_placeholders(self):
+        from operators import compile
+        from bytecode import compile_program, LOAD
+        expr = compile('{rate} * ({base} + 2) - {base}^2')
+        program = compile_program(expr)
+        self.assertEqual(3, sum(op == LOAD for op in program.ops)) # {base} loaded twice, from one key slot
+        self.assertEqual(['rate', 'base'], program.keys)
+        for values in [{'rate': 1.5, 'base': 4}, {'rate': -2, 'base': 0.5}]:
+            self.assertEqual(expr.evaluate(values), program.run(values))
+        self.assertEqual(7, compile_program('{} + {}*2').run([1, 3]))
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {base}", program.run, {'rate': 1})
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {rate}", program.run)
+
+    def test_constants(self):
+        from operators import Num, Add
+        from bytecode import compile_program, CONST
+        program = compile_program('2*3 + 2*3')
+        self.assertEqual([2, 3], program.constants) # Repeats share a slot
+        self.assertEqual(4, sum(op == CONST for op in program.ops))
+        self.assertIn('CONST 2', program.disassemble())
+        program = compile_program(Add(Num(-0.0), Num(0.0)))
+        self.assertEqual(['-0.0', '0.0'], [repr(value) for value in program.constants]) # Equal, but not the same
+
+    def test_errors(self):
+        from operators import use_limits, Limits, LimitExceeded
+        from bytecode import compile_program
+        self.assertRaises(ZeroDivisionError, compile_program('1/(2-2)').run)
+        program = compile_program('2^{}')
+        self.assertEqual(2**200, program.run([200]))
+        with use_limits(Limits(max_pow_bits=100)):
+            self.assertRaises(LimitExceeded, program.run, [200])
+
+    def test_other_operators(self):
+        """Registered operators, with any number of operands, are called"""
+        import operator
+        from operators import process, define_operator, unregister_operator, Mul, Neg
+        from bytecode import compile_program, CALL
+        Mod = define_operator('Mod', '%', operator.mod, Mul)
+        self.addCleanup(unregister_operator, Mod)
+        Fact = define_operator('Fact', '!', lambda x: x * (x-1), 0, nright=0)
+        self.addCleanup(unregister_operator, Fact)
+        Half = define_operator('Half', 'half', lambda x: x / 2, Neg, nleft=0)
+        self.addCleanup(unregister_operator, Half)
+        text = '7 % 4 + 5! * half 3'
+        program = compile_program(text)
+        self.assertEqual(process(text), program.run())
+        self.assertEqual(3, sum(op == CALL for op in program.ops))
+
+    def test_deep(self):
+        """Deep trees are lowered and run without recursion"""
+        from operators import compile
+        from bytecode import compile_program
+        n = 5000
+        text = '(' * n + '1' + '+1)' * n
+        self.assertEqual(n + 1, compile_program(compile(text)).run())
+        self.assertEqual(3 - n, compile_program('-'.join(['1'] * n) + '+1').run())
+
+class TestCodegen(unittest.TestCase):
+    """Test compiling trees to Python functions"""
+    def test_matches_process(self):
+        from operators import process, compile
+        from codegen import compile_function
+        from benchmarks import generate
+        for seed in range(20):
+            text = generate(30, depth=seed % 5, ops='+-*/x^', negate=0.2, seed=seed)
+            expected = process(text)
+            for expr in [text, compile(text), compile(text, simplify=True), compile(text, share=True)]:
+                self.assertEqual(expected, compile_function(expr)(), text)
+        self.assertEqual(process('-2^2'), compile_function('-2^2')()) # Neg binds tighter than Pow, unlike Python
+        self.assertEqual(12, compile_function('3x4')())
+
+    def test_placeholders(self):
+        from operators import compile
+        from codegen import compile_function
+        expr = compile('{rate} * ({base} + 2) - {base}^2')
+        function = compile_function(expr)
+        self.assertEqual(('rate', 'base'), function.keys)
+        for values in [{'rate': 1.5, 'base': 4}, {'rate': -2, 'base': 0.5}]:
+            self.assertEqual(expr.evaluate(values), function(values))
+            self.assertEqual(expr.evaluate(values), function.func(values['rate'], values['base']))
+        self.assertEqual(7, compile_function('{} + {}*2')([1, 3]))
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {base}", function, {'rate': 1})
+        self.assertRaisesRegex(ValueError, "No value given for placeholder {rate}", function)
+
+    def test_constants(self):
+        """Values that can't be written as literals are passed in by name"""
+        import ast
+        from decimal import Decimal
+        from fractions import Fraction
+        from operators import Num, Add, Mul
+        from codegen import compile_function
+        def names(function):
+            return {node.id for node in ast.walk(ast.parse(function.source)) if isinstance(node, ast.Name)}
+        function = compile_function(Add(Num(-0.0), Mul(Num(Fraction(3, 2)), Num(float('inf')))))
+        self.assertEqual(float('inf'), function())
+        self.assertEqual({'_c0', '_c1', '_c2'}, names(function))
+        function = compile_function(Add(Num(Decimal('-0.5')), Mul(Num(Decimal('1.5')), Num(2))))
+        self.assertEqual(Decimal('2.5'), function())
+        self.assertEqual({'_c0', '_c1'}, names(function)) # 2 is written as a literal
+        self.assertEqual(float('inf'), compile_function(Add(Num(-0.0), Num(float('inf'))))())
+        self.assertEqual('-0.0', repr(compile_function(Add(Num(-0.0), Num(-0.0)))()))
+
+    def test_errors(self):
+        from operators import use_limits, Limits, LimitExceeded
+        from codegen import compile_function
+        self.assertRaises(ZeroDivisionError, compile_function('1/(2-2)'))
+        self.assertRaises(ZeroDivisionError, compile_function('1/0'))
+        self.assertRaisesRegex(ValueError, "Unknown operator or bad input", compile_function, "__import__('os')")
+        function = compile_function('2^{}')
+        self.assertEqual(2**200, function([200]))
+        with use_limits(Limits(max_pow_bits=100)):
+            self.assertRaises(LimitExceeded, function, [200])
+
+    def test_other_operators(self):
+        import operator
+        from operators import process, define_operator, unregister_operator, Mul, Neg
+        from codegen import compile_function
+        Mod = define_operator('Mod', '%', operator.mod, Mul)
+        self.addCleanup(unregister_operator, Mod)
+        Half = define_operator('Half', 'half', lambda x: x / 2, Neg, nleft=0)
+        self.addCleanup(unregister_operator, Half)
+        text = '7 % 4 + 5 * half 3'
+        self.assertEqual(process(text), compile_function(text)())
+
+    def test_deep(self):
+        """Deep trees are split up, so CPython can compile them"""
+        from operators import compile
+        from codegen import compile_function
+        n = 5000
+        text = '(' * n + '1' + '+1)' * n
+        self.assertEqual(n + 1, compile_function(compile(text))())
+        self.assertEqual(3 - n, compile_function('-'.join(['1'] * n) + '+1')())
+        self.assertEqual(n, compile_function(compile('+'.join(['1'] * n), simplify=True))())
+
+class TestLimits(unittest.TestCase):
+    """Test limits on the work done for untrusted input"""
+    def test_limits(self):
+        from operators import process, Limits, LimitExceeded
+        limits = Limits(max_length=30, max_tokens=15, max_depth=2, max_pow_bits=1000)
+        self.assertEqual(2**999, process('2^999', limits=limits))
+        self.assertEqual(9, process('((1+2))*3', limits=limits))
+        self.assertEqual(8, process('1+' * 7 + '1', limits=limits)) # 15 tokens
+        for text, message in [('1' * 31, "31 characters"),
+                              ('1+' * 8 + '1', "17 tokens"),
+                              ('(((1)))', "nested more than the limit of 2"),
+                              ('2^1001', "1001 bits"),
+                              ('9^9^9^9^9', "bits"),
+                              ('(-3)^999', "bits"),
+                              ]:
+            with self.assertRaisesRegex(LimitExceeded, message, msg=text):
+                process(text, limits=limits)
+        self.assertTrue(issubclass(LimitExceeded, ValueError)) # Handled like any bad input
+        self.assertEqual(2**1001, process('2^1001')) # No limits by default
+
+    def test_pow_guard(self):
+        """Only powers that can make huge ints or Fractions are limited"""
+        from decimal import Decimal
+        from fractions import Fraction
+        from operators import process, Limits, LimitExceeded
+        limits = Limits(max_pow_bits=100)
+        self.assertEqual(1, process('1^999999999', limits=limits))
+        self.assertEqual(0, process('0^999999999', limits=limits))
+        self.assertEqual(0.0, process('2^-999999999', limits=limits)) # Float
+        self.assertEqual(2.0**0.5, process('2^0.5', limits=limits))
+        self.assertRaises(OverflowError, process, '2.5^999999999', limits=limits) # Floats overflow anyway
+        self.assertRaises(LimitExceeded, process, '(1/2)^999', Fraction, limits)
+        self.assertRaises(LimitExceeded, process, '2^-999', Fraction, limits)
+        self.assertEqual(Decimal(2)**999, process('2^999', Decimal, limits))
+
+    def test_use_limits(self):
+        """Compiled expressions and process_many use them too"""
+        from operators import compile, process_many, use_limits, Limits, LimitExceeded
+        expr = compile('{} ^ {}')
+        limits = Limits(max_length=10, max_pow_bits=100)
+        with use_limits(limits):
+            self.assertEqual(2**100, expr.evaluate([2, 100]))
+            self.assertRaises(LimitExceeded, expr.evaluate, [2, 101])
+        self.assertEqual(2**101, expr.evaluate([2, 101]))
+        results = process_many(['2^3', '2^200', '1+2+3+4+5+6', '2^3'], limits)
+        self.assertEqual(8, results[0])
+        self.assertIsInstance(results[1], LimitExceeded)
+        self.assertIsInstance(results[2], LimitExceeded)
+        self.assertEqual(8, results[3])
+
+class TestProcessCache(unittest.TestCase):
+    """Test the LRU cache in front of process"""
+    def test_hits(self):
+        from caching import ProcessCache
+        for store in ProcessCache.stores:
+            cache = ProcessCache(store=store)
+            for text in ['1 + 2*3', '1+2 * 3', ' 1+2*3\n']: # Same after normalizing
+                self.assertEqual(7, cache.process(text), store)
+            self.assertEqual(4, cache.process('2^2'), store)
+            info = cache.info()
+            self.assertEqual((2, 2, 0, 2), (info.hits, info.misses, info.evictions, info.entries), store)
+
+    def test_errors(self):
+        """ValueErrors are cached, and numbers separated by whitespace are not merged"""
+        from caching import ProcessCache
+        cache = ProcessCache()
+        for _ in range(2):
+            self.assertRaisesRegex(ValueError, "Tree did not fully collapse", cache.process, '1 2')
+        self.assertEqual(12, cache.process('12'))
+        self.assertEqual((1, 2), cache.info()[:2])
+
+    def test_keys(self):
+        """Normalizing never changes how text parses, and is the same however it's spaced"""
+        import operator
+        import re
+        from operators import process, normalize, define_operator, unregister_operator, Mul
+        from caching import ProcessCache
+        FloorDiv = define_operator('FloorDiv', '//', operator.floordiv, Mul)
+        self.addCleanup(unregister_operator, FloorDiv)
+        cache = ProcessCache()
+        for text in ['2 * * 3', '2 ** 3', '7 / / 2', '7 // 2', '1e - 3', '1e-3', '3 - - 2']:
+            try:
+                expected = process(text)
+            except ValueError as e:
+                self.assertRaisesRegex(ValueError, re.escape(str(e)), cache.process, text)
+            else:
+                self.assertEqual(expected, cache.process(text), text)
+        self.assertNotEqual(normalize('2 * * 3'), normalize('2**3'))
+        self.assertEqual(normalize('3 - - 2'), normalize('3--2'))
+        self.assertEqual(normalize(' 1+2 *3\n'), normalize('1 + 2*3'))
+        self.assertEqual('1+2*3', normalize('1 + 2*3')) # Same as the text with no whitespace
+        self.assertEqual(normalize('2* *3'), normalize('2 * * 3'))
+        text = '(1+2)*3'
+        self.assertIs(text, normalize(text)) # Nothing to remove, so not even lexed
+
+    def test_eviction(self):
+        from caching import ProcessCache
+        cache = ProcessCache(maxsize=2)
+        cache.process('1')
+        cache.process('2')
+        cache.process('1') # Now 2 is least recently used
+        cache.process('3')
+        self.assertEqual(1, cache.info().evictions)
+        cache.process('1') # Still cached
+        cache.process('2') # Evicted, and evicts 3
+        self.assertEqual((2, 4, 2, 2), cache.info()[:4])
+
+        cache.resize(maxsize=None, maxbytes=1)
+        self.assertEqual(0, len(cache))
+        cache.resize(maxsize=None, maxbytes=None)
+        for i in range(100):
+            cache.process(f"{i}+1")
+        self.assertEqual(100, len(cache))
+        self.assertGreater(cache.info().nbytes, 0)
+        cache.clear()
+        self.assertEqual((0, 0), cache.info()[3:])
+
+class TestDiskCache(unittest.TestCase):
+    """Test the persistent cache of compiled expressions"""
+    def setUp(self):
+        import os, tempfile
+        self.path = os.path.join(tempfile.mkdtemp(), 'expressions.cache')
+
+    def test_round_trip(self):
+        from decimal import Decimal
+        from fractions import Fraction
+        from operators import compile, simplify_tree, Expression, Num, Add, Mul
+        from diskcache import DiskCache
+        from benchmarks import generate
+        texts = [generate(30, depth=seed % 5, ops='+-*/x^', negate=0.2, seed=seed) for seed in range(20)]
+        texts += ['{rate} * ({base} + 2) - {base}^2', '{} + {}*2', '2^100 - 1e-3', '10**30']
+        with DiskCache(self.path) as cache:
+            for text in texts:
+                cache.compile(text)
+            cache.add('decimal', Expression(Add(Num(Decimal('1.5')), Num(Decimal('-0.25')))))
+            cache.add('fraction', Expression(Mul(Num(Fraction(1, 3)), Num(-0.0))))
+            cache.add('simplified', Expression(simplify_tree(compile('1+2+{x}+3').tree), ['x']))
+            self.assertRaises(ValueError, cache.compile, '1+') # Not cached
+            self.assertRaises(ValueError, cache.compile, '2 * * 3') # Not the same as "2**3"
+            self.assertEqual(8, cache.compile('2**3').evaluate())
+        cache = DiskCache(self.path)
+        self.addCleanup(cache.close)
+        self.assertEqual(len(texts) + 4, len(cache)) # And "2**3"
+        for text in texts:
+            expected = compile(text)
+            expr = cache.get(text)
+            self.assertEqual((expected.tree, expected.keys), (expr.tree, expr.keys), text)
+        self.assertEqual(3*(4+2) - 4**2, cache.get(' {rate}*( {base}+2 ) - {base} ^ 2').evaluate({'rate': 3, 'base': 4}))
+        self.assertEqual(Decimal('1.25'), cache.get('decimal').evaluate())
+        self.assertEqual(Fraction(1, 3), cache.get('fraction').tree.left.value)
+        self.assertEqual('-0.0', repr(cache.get('fraction').evaluate()))
+        self.assertEqual(16, cache.get('simplified').evaluate({'x': 10}))
+        self.assertIsNone(cache.get('1+'))
+        self.assertEqual((len(texts) + 5, 1), (cache.hits, cache.misses))
+
+    def test_invalidation(self):
+        import operator
+        from operators import define_operator, unregister_operator, Mul
+        from diskcache import DiskCache
+        with DiskCache(self.path) as cache:
+            cache.compile('1+2')
+        Mod = define_operator('Mod', '%', operator.mod, Mul)
+        cache = DiskCache(self.path)
+        self.assertIsNone(cache.get('1+2')) # Written with other operators
+        cache.compile('5%2')
+        cache.save()
+        self.assertEqual(1, len(cache))
+        self.assertEqual(1, DiskCache(self.path).compile('5%2').evaluate())
+        unregister_operator(Mod)
+        self.assertIsNone(cache.get('5%2')) # Noticed by an open cache too
+        cache.close()
+
+        with open(self.path, 'wb') as f:
+            f.write(b'not a cache file')
+        with DiskCache(self.path) as cache:
+            self.assertEqual(0, len(cache))
+            self.assertEqual(3, cache.compile('1+2').evaluate())
+        self.assertEqual(1, len(DiskCache(self.path)))
+
+    def test_concurrent_readers(self):
+        """A reader keeps its view of the file while another cache replaces it"""
+        from diskcache import DiskCache
+        with DiskCache(self.path) as cache:
+            cache.compile('1+2')
+        reader = DiskCache(self.path)
+        self.addCleanup(reader.close)
+        with DiskCache(self.path) as writer:
+            for i in range(100):
+                writer.compile(f"{i}*{{x}}")
+        self.assertEqual(101, len(DiskCache(self.path)))
+        self.assertEqual(1, len(reader))
+        self.assertEqual(3, reader.get('1+2').evaluate())
+        self.assertIsNone(reader.get('5*{x}'))
+
+class TestThreadSafety(unittest.TestCase):
+    """Test sharing one tree between threads"""
+    def test_immutable(self):
+        from operators import compile, simplify_tree, Num, Add
+        tree = compile('1 + 2*{x}').tree
+        hash(tree) # Caching the hash is still allowed, once
+        for name in ['left', 'right', 'value', '_hash']:
+            self.assertRaises(AttributeError, setattr, tree, name, Num(5))
+        self.assertRaises(AttributeError, delattr, tree, 'left')
+        self.assertRaises(AttributeError, setattr, Num(1), 'value', 2)
+        self.assertEqual(hash(compile('1 + 2*{x}').tree), hash(tree))
+        self.assertEqual(7, simplify_tree(Add(Num(1), Add(Num(2), Num(4)))).apply()) # Makes new nodes instead
+        self.assertEqual(7, tree.apply({'x': 3}))
+
+    def test_thread_pool(self):
+        """Evaluate the same trees from many threads at once"""
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from operators import compile, Limits, LimitExceeded, use_limits
+        from benchmarks import generate
+        text = (f"({generate(60, depth=4, ops='+-*/', negate=0.2, seed=1)}) * {{x}}"
+                f" - {{y}} / ({generate(60, depth=4, ops='+-*/', seed=2)}) + 2^{{p}}")
+        deep = compile('(' * 1000 + '{x}' + '+1)' * 1000)
+        exprs = [compile(text), compile(text, simplify=True), compile(text, share=True)]
+        bindings = [{'x': i / 7, 'y': -i, 'p': i % 50} for i in range(200)]
+        expected = [[expr.evaluate(values) for values in bindings] for expr in exprs]
+        barrier = threading.Barrier(8)
+
+        def work(i):
+            barrier.wait() # Start all threads together
+            values = bindings[i % len(bindings)]
+            results = [expr.evaluate(values) for expr in exprs]
+            self.assertEqual(1000 + i, deep.evaluate({'x': i}))
+            # Limits are per thread, so only every other thread is limited
+            if i % 2:
+                with use_limits(Limits(max_pow_bits=2)):
+                    self.assertRaises(LimitExceeded, exprs[0].evaluate, {'x': 1, 'y': 2, 'p': 40})
+            else:
+                exprs[0].evaluate({'x': 1, 'y': 2, 'p': 40})
+            # Hashing caches onto the shared nodes
+            return results, hash(compile(text).tree) == hash(exprs[0].tree)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            for i, (results, same_hash) in enumerate(pool.map(work, range(160))):
+                self.assertEqual([values[i % len(bindings)] for values in expected], results)
+                self.assertTrue(same_hash)
+
+class TestValidation(unittest.TestCase):
+    """Test rejecting invalid input before building anything"""
+    def test_matches_process(self):
+        """validate finds problems in exactly the text that parse or make_tree rejects"""
+        import random
+        from operators import parse, make_tree
+        from validation import validate
+        from benchmarks import generate
+        pieces = ['1', '2.5', '1e-3', '1e', '.', 'inf', '+', '-', '*', '/', '^', '**', 'x',
+                  '(', ')', ' ', '{x}', '{}', 'a']
+        rng = random.Random(0)
+        texts = [''.join(rng.choice(pieces) for _ in range(rng.randint(0, 8))) for _ in range(5000)]
+        texts += [generate(30, depth=seed % 5, ops='+-*/x^', negate=0.2, seed=seed) for seed in range(20)]
+        for text in texts:
+            try:
+                make_tree(parse(text))
+                valid = True
+            except ValueError:
+                valid = False
+            self.assertEqual(valid, not validate(text), text)
+
+    def test_problems(self):
+        from validation import validate
+        def found(text):
+            return [(problem.start, problem.end, problem.message) for problem in validate(text)]
+        self.assertEqual([], found(' -(1+{x}) * 2e-3 '))
+        self.assertEqual([(4, 5, "Operator needs a left operand"),
+                          (8, 9, "Two operands in a row"),
+                          (8, 9, "Opening operator never closed")], found('1 + * 2 (3'))
+        self.assertEqual([(5, 6, "Unmatched or out-of-order closing operator")], found('(1+2))*3'))
+        self.assertEqual([(1, 2, "Repeated prefix operator"),
+                          (7, 8, "Nothing between the enclosing operators")], found('--5 + ()'))
+        self.assertEqual([(0, 3, "Unknown operator or bad input")], found('abc + 1'))
+        self.assertEqual([(7, 9, "Unknown operator or bad input")], found('1e-3 + 1e'))
+        self.assertEqual([(2, 3, "Two operands in a row")], found('2 3'))
+        self.assertEqual([(3, 3, "Operator needs a right operand")], found('1 +'))
+        self.assertEqual([(0, 1, "Nothing to evaluate")], found(' '))
+        self.assertEqual('...1+1+1+1+1+', validate('1+'*1000)[0].excerpt)
+        self.assertEqual(1001, len(validate('a+'*1000))) # And the last "+" needs a right operand
+        self.assertEqual(3, len(validate('a+'*1000, limit=3)))
+
+    def test_check(self):
+        from operators import define_operator, unregister_operator, Neg
+        from validation import check, InvalidInput
+        check('1 + 2')
+        with self.assertRaisesRegex(InvalidInput, r"^Invalid input: Operator needs a left operand at 5 \('1 \*\* \*\* 2'\)$"):
+            check('1 ** ** 2')
+        try:
+            check('a+' * 100000)
+        except InvalidInput as e:
+            self.assertEqual(6, len(e.problems)) # Stops early
+            self.assertLess(len(str(e)), 500)
+            self.assertTrue(str(e).endswith('; and more'))
+        Rad2Deg = define_operator('Rad2Deg', 'rad2deg', lambda x: x, Neg, nleft=0)
+        self.addCleanup(unregister_operator, Rad2Deg)
+        check('rad2deg 3')
+        self.assertRaisesRegex(InvalidInput, "Two operands in a row at 2", check, '2 rad2deg 3')
+
+class TestDeepInput(unittest.TestCase):
+    """Test input nested far deeper than Python's recursion limit"""
+    def test_deep_parentheses(self):
+        from operators import process
+        n = 5000
+        self.assertEqual(7, process('('*n + '3+4' + ')'*n))
+        self.assertEqual(1, process('-('*n + '1' + ')'*n)) # Even number of negations
+
+    def test_long_chain(self):
+        """Long left-associative chains produce trees as deep as the chain"""
+        from operators import parse, make_tree
+        n = 5000
+        text = '-'.join(['1']*n)
+        tree = make_tree(parse(text))
+        self.assertEqual(2-n, tree.apply())
+        self.assertEqual(tree, make_tree(parse(text)))
+        self.assertNotEqual(tree, make_tree(parse(text + '-1')))
+        self.assertTrue(repr(tree).startswith('Sub(Sub('))
+
+class TestBenchmarks(unittest.TestCase):
+    """Test the benchmark expression generator and regression checks"""
+    def test_generate(self):
+        from operators import parse, Num, OpenParen, Pow
+        from benchmarks import generate
+        self.assertEqual(generate(50, seed=1), generate(50, seed=1))
+        for kwargs in [{'terms': 1}, {'terms': 40}, {'terms': 40, 'depth': 5},
+                       {'terms': 3, 'depth': 10}, {'terms': 40, 'depth': 3, 'ops': '+x^', 'negate': 0.5}]:
+            eqn = parse(generate(**kwargs))
+            exponents = sum(isinstance(item, Pow) for item in eqn)
+            self.assertEqual(kwargs['terms'], sum(isinstance(item, Num) for item in eqn) - exponents, kwargs)
+            self.assertEqual(kwargs.get('depth', 0), sum(isinstance(item, OpenParen) for item in eqn), kwargs)
+        self.assertRaises(ValueError, generate, 0)
+        self.assertRaises(ValueError, generate, 10, ops='^')
+        self.assertRaises(ValueError, generate, 10, ops='+%')
+
+    def test_fit_scaling(self):
+        from benchmarks import fit_scaling
+        self.assertAlmostEqual(1, fit_scaling([10, 100, 1000], [1, 10, 100]))
+        self.assertAlmostEqual(2, fit_scaling([10, 100, 1000], [1, 100, None]))
+        self.assertIsNone(fit_scaling([10, 100], [1, None]))
+
+    def test_compare(self):
+        import json
+        from benchmarks import run_benchmarks, compare
+        report = run_benchmarks([10, 20], ['flat'], min_time=0, repeat=1)
+        self.assertEqual({'10', '20'}, set(report['results']['flat']))
+        self.assertEqual([], compare(report, report))
+        slower = json.loads(json.dumps(report))
+        slower['results']['flat']['20']['parse'] = report['results']['flat']['20']['parse'] * 2
+        slower['scaling']['flat']['parse'] = report['scaling']['flat']['parse'] + 1
+        regressions = compare(slower, report)
+        self.assertEqual(2, len(regressions))
+        self.assertTrue(all('parse' in message for message in regressions))
+        self.assertEqual([], compare(report, slower)) # Faster isn't a regression
+
+class TestRegistry(unittest.TestCase):
+    """Test adding operators at runtime"""
+    def test_define_operator(self):
+        import math
+        import operator
+        import operators
+        from operators import process, define_operator, unregister_operator, Mul, Neg
+        Mod = define_operator('Mod', '%', operator.mod, Mul)
+        self.addCleanup(unregister_operator, Mod)
+        FloorDiv = define_operator('FloorDiv', '//', operator.floordiv, Mul)
+        self.addCleanup(unregister_operator, FloorDiv)
+        Rad2Deg = define_operator('Rad2Deg', 'rad2deg', math.degrees, Neg, nleft=0)
+        self.addCleanup(unregister_operator, Rad2Deg)
+        self.assertEqual(3, process('7 % 4'))
+        self.assertEqual(1+2*3 % 4, process('1+2*3%4')) # Same level as "*", left to right
+        self.assertEqual(3, process('7//2')) # Not two Divs
+        self.assertEqual(3.5, process('7/2'))
+        self.assertEqual(180, round(process('rad2deg 3.14159265')))
+        self.assertEqual(-90, round(process('2 - rad2deg(3.14159265/2) - 2')))
+        self.assertFalse(hasattr(Mod(), '__dict__'))
+        self.assertIn(Mod, operators.prec_order[operators._rank(Mul())])
+
+    def test_new_level(self):
+        import operators
+        from operators import process, define_operator, unregister_operator
+        levels = operators.prec_order
+        # Applied after everything else
+        Min = define_operator('Min', 'min', min, len(levels))
+        self.addCleanup(unregister_operator, Min)
+        self.assertEqual(len(levels) + 1, len(operators.prec_order))
+        self.assertEqual(3, process('1+2 min 3*4'))
+        # Postfix, applied before everything else
+        Inc = define_operator('Inc', r'\+\+', lambda x: x+1, 0, nright=0)
+        self.addCleanup(unregister_operator, Inc)
+        self.assertEqual(6, process('2++ * 2'))
+
+    def test_unregister(self):
+        import operator
+        import operators
+        from operators import process, define_operator, unregister_operator, register_operator, Mul
+        levels, lexer = operators.prec_order, operators._lexer
+        Mod = define_operator('Mod', '%', operator.mod, 2)
+        self.assertIsNot(lexer, operators._lexer)
+        self.assertEqual(1, process('5%2'))
+        self.assertRaises(ValueError, register_operator, Mod, Mul) # Already registered
+        unregister_operator(Mod)
+        self.assertEqual(levels, operators.prec_order)
+        self.assertRaisesRegex(ValueError, "Unknown operator or bad input:", process, '5%2')
+        self.assertRaises(ValueError, unregister_operator, Mod)
+        # Lexer only recompiled when the registry changes
+        lexer = operators._lexer
+        process('1+2')
+        self.assertIs(lexer, operators._lexer)
+
+    def test_bad_registration(self):
+        import re
+        from operators import register_operator, Num, MyOp, Mul
+        self.assertRaises(ValueError, register_operator, Num, Mul) # Already registered
+        class NoToken(MyOp):
+            __slots__ = ()
+        self.assertRaises(ValueError, register_operator, NoToken, Mul)
+        self.assertRaises(ValueError, register_operator, int, Mul)
+        class Mod(MyOp):
+            token = re.compile('%')
+            __slots__ = ()
+        self.assertRaises(ValueError, register_operator, Mod, Mod) # Precedence of something unregistered
+        self.assertRaises(ValueError, register_operator, Mod, 100)
+
 class TestBadInput(unittest.TestCase):
     """Test different kinds of bad input"""
     def test_unmatched_enclosing(self):
@@ -315,6 +1610,24 @@ class TestBadInput(unittest.TestCase):
                                process, '3*')
         self.assertRaisesRegex(ValueError, "Operator at start of eqn that needs left operand",
                                process, '*3')
+    def test_error_order(self):
+        """Input with more than one error raises the one found first when
+        applying prec_order one level at a time"""
+        from operators import process
+        for text, message in [('+x', "Operator at end of eqn"), # Mul is applied before Add
+                              ('^-', "Operator at end of eqn"), # Neg is applied before Pow
+                              ('1.5+^-+/-', "Operator at end of eqn"),
+                              ('(-3*+)(', "1 too many opening operators"), # Group is valid until applied
+                              ('*3+(', "1 too many opening operators"), # Groups before operators
+                              ('(1+)+)', "Operator at end of eqn"), # Inside the group first
+                              ('(1++)*(', "1 too many opening operators"), # Group was built, with Add as an operand
+                              ('(' * 5000 + '1' + ')' * 5000 + ')', "Unmatched or out-of-order closing operator"),
+                              ]:
+            with self.assertRaisesRegex(ValueError, message, msg=text[:20]):
+                process(text)
+        with self.assertRaises(ValueError) as caught:
+            process('+x')
+        self.assertIsNone(caught.exception.__context__) # Only the one error in the traceback
     def test_unknown_operator(self):
         """Input that Python can evaluate, but uses an operator that hasn't been implemented"""
         from operators import process
@@ -325,5 +1638,16 @@ class TestBadInput(unittest.TestCase):
             self.assertRaisesRegex(ValueError, "Unknown operator or bad input:",
                                    process, text)
 
+    def test_long_input(self):
+        """Error messages stay short however long the input is"""
+        from operators import process
+        for text in ['1+' * 20000, '(' + '1+' * 20000 + '1))', '(1+2)*' * 20000, 'a' * 20000]:
+            try:
+                process(text)
+            except ValueError as e:
+                self.assertLess(len(str(e)), 500)
+            else:
+                self.fail(text[:20])
+
 if __name__ == '__main__':
     unittest.main()
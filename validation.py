@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Fast rejection of invalid input, before any tokens or trees are made
+One left-to-right pass over the tokens of the text checks that everything in
+it is an operator or a number, that parentheses balance, and that operators
+and operands alternate (no two operators or operands in a row, and no
+operator missing an operand at either end). No MyOps are created, so invalid
+input costs much less to reject than valid input costs to process, and every
+problem is found, with where it is, instead of only the first
+"""
+
+from collections import namedtuple
+from itertools import chain
+import re
+
+import operators
+from operators import MyEnclosingOp, Num, Sub, Neg
+
+# One problem found in the text
+# start, end - character offsets of the text at fault, like slice indexes
+# message - what's wrong
+# excerpt - the text around it, cut down to at most about 2*excerpt_context
+# characters plus the text at fault (itself cut to max_excerpt)
+Problem = namedtuple('Problem', ['start', 'end', 'message', 'excerpt'])
+
+# Characters of text to show on each side of a problem
+excerpt_context = 10
+# Most characters of the text at fault to show
+max_excerpt = 20
+# Most problems to list in an InvalidInput message. All are in its problems
+max_reported = 5
+
+# Numbers that float accepts, checked first so most need no conversion
+_number = re.compile(r'(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+
+class InvalidInput(ValueError):
+    """Raised by check for text with problems"""
+    def __init__(self, problems):
+        """problems - the Problems found, in order. The message lists the first
+        max_reported of them"""
+        self.problems = problems
+        shown = '; '.join(f"{problem.message} at {problem.start} ({problem.excerpt!r})"
+                          for problem in problems[:max_reported])
+        if len(problems) > max_reported:
+            shown += "; and more"
+        super().__init__(f"Invalid input: {shown}")
+
+def _excerpt(text, start, end):
+    """returns the text around text[start:end], for showing where a problem is"""
+    end = min(end, start + max_excerpt)
+    left = max(0, start - excerpt_context)
+    right = min(len(text), end + excerpt_context)
+    return f"{'...'*(left > 0)}{text[left:right]}{'...'*(right < len(text))}"
+
+def _is_number(text):
+    """Check whether text converts to a Num, as parse would (see Num.from_text)"""
+    if _number.fullmatch(text):
+        return True
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return True
+
+# Kinds of token, for validate
+_SPACE, _EXPONENT, _OPERAND, _OPEN, _CLOSE, _PREFIX, _INFIX, _POSTFIX = range(8)
+
+# (lexer, {group name: (kind, class, precedence)}) for the last lexer seen, so
+# the table is only rebuilt when the registry changes
+_table = (None, None)
+
+def _token_table(lexer):
+    """returns {group name: (kind, class, precedence)} for each token of lexer
+    lexer - (regex, {group name: MyOp class}), as operators._lexer"""
+    global _table
+    if _table[0] is not lexer:
+        table = {'space': (_SPACE, None, None)}
+        for name, cls in lexer[1].items():
+            if cls is Num:
+                kind = _EXPONENT
+            elif issubclass(cls, MyEnclosingOp):
+                kind = _OPEN if cls.close is not None else _CLOSE
+            elif not (cls.nleft or cls.nright):
+                kind = _OPERAND
+            elif not cls.nleft:
+                kind = _PREFIX
+            else:
+                kind = _INFIX if cls.nright else _POSTFIX
+            table[name] = (kind, cls, operators._precedence.get(cls))
+        _table = (lexer, table)
+    return _table[1]
+
+class _Enough(Exception):
+    """Raised inside validate once it has found as many problems as asked for"""
+
+def validate(text, limit=None):
+    """Find every problem in text that would make parse or make_tree raise
+    Numbers are checked as parse converts them with no number_type. Errors
+    that only happen when evaluating (ex. division by zero, or a missing
+    placeholder value) aren't checked
+    text - string representing an arithmetic expression
+    limit - stop after finding this many problems. None to find them all
+    returns a list of Problems, in order. Empty if text is valid"""
+    problems = []
+    def problem(start, end, message):
+        problems.append(Problem(start, end, message, _excerpt(text, start, end)))
+        if len(problems) == limit:
+            raise _Enough
+
+    lexer = operators._lexer # Same version as parse uses
+    table = _token_table(lexer)
+    neg_rank = operators._precedence.get(Neg)
+    number = _number.fullmatch
+    opens = [] # (start, end, class) of each opening operator not closed yet
+    need_operand = True # Whether the next item has to be an operand or prefix operator
+    prefix = None # Precedence of the operator just before, if it was a prefix operator
+    last_end = 0 # Where the last token ended
+    any_items = False # Whether the current group has anything in it
+    try:
+        # None at the end, to check any number after the last token
+        for match in chain(lexer[0].finditer(text), [None]):
+            if match is None:
+                kind = _SPACE
+                start = end = len(text)
+            else:
+                kind, cls, rank = table[match.lastgroup]
+                if kind == _EXPONENT:
+                    # Sign of an exponent, part of the number text around it
+                    continue
+                start, end = match.span()
+            if start > last_end:
+                # Text between tokens must be a number
+                if not (number(text, last_end, start) or _is_number(text[last_end:start])):
+                    problem(last_end, start, "Unknown operator or bad input")
+                elif not need_operand:
+                    problem(last_end, start, "Two operands in a row")
+                need_operand = False
+                prefix = None
+                any_items = True
+            last_end = end
+
+            if kind == _SPACE:
+                # Whitespace, or the end of the text
+                continue
+            if rank is None:
+                # Not in prec_order, so it would never be applied
+                problem(start, end, "Operator has no precedence")
+            if kind == _INFIX:
+                if need_operand:
+                    if cls is Sub:
+                        # Sub and Neg share a token
+                        kind, rank = _PREFIX, neg_rank
+                    else:
+                        problem(start, end, "Operator needs a left operand")
+                any_items = True
+                if kind == _INFIX:
+                    need_operand = True
+                    prefix = None
+                    continue
+            if kind == _OPERAND:
+                if not need_operand:
+                    problem(start, end, "Two operands in a row")
+                need_operand = False
+                prefix = None
+                any_items = True
+            elif kind == _PREFIX:
+                if not need_operand:
+                    problem(start, end, "Two operands in a row")
+                elif prefix is not None and rank is not None and prefix <= rank:
+                    problem(start, end, "Repeated prefix operator")
+                need_operand = True
+                prefix = rank
+                any_items = True
+            elif kind == _POSTFIX:
+                if need_operand:
+                    problem(start, end, "Operator needs a left operand")
+                need_operand = False
+                prefix = None
+                any_items = True
+            elif kind == _OPEN:
+                # Starts a group that counts as one operand
+                if not need_operand:
+                    problem(start, end, "Two operands in a row")
+                opens.append((start, end, cls))
+                need_operand = True
+                prefix = None
+                any_items = False
+            elif opens and issubclass(cls, opens[-1][2].close):
+                opens.pop()
+                if not any_items:
+                    problem(start, end, "Nothing between the enclosing operators")
+                elif need_operand:
+                    problem(start, end, "Operator needs a right operand")
+                need_operand = False
+                prefix = None
+                any_items = True
+            else:
+                problem(start, end, "Unmatched or out-of-order closing operator")
+
+        if need_operand and any_items:
+            problem(last_end, len(text), "Operator needs a right operand")
+        elif not any_items and not opens:
+            problem(0, len(text), "Nothing to evaluate")
+        for start, end, _ in opens:
+            problem(start, end, "Opening operator never closed")
+    except _Enough:
+        pass
+    return problems
+
+def check(text, limit=max_reported + 1):
+    """Raise InvalidInput for the problems in text, if it has any (see
+    validate). Checking before process rejects invalid input cheaply, since
+    nothing is built and it stops after limit problems
+    text - string representing an arithmetic expression
+    limit - most problems to find. None to find them all"""
+    problems = validate(text, limit)
+    if problems:
+        raise InvalidInput(problems)
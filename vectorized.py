@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluate one syntax tree over whole NumPy arrays of placeholder values at
+once, instead of substituting each row's values and calling process per row
+Requires NumPy, which is otherwise not needed by this project
+"""
+
+from operators import MyOp, Expression, Num, OpenParen, Pow, Mul, Div, Add, Sub, Neg
+from operators import compile as compile_expression
+
+try:
+    import numpy as np
+except ImportError: # Optional dependency, only needed for this module
+    np = None
+
+def _power(base, exponent):
+    """Pow for arrays. Python returns a float for integers to negative integer
+    powers, where NumPy would raise, so use floats for those"""
+    if (np.issubdtype(np.result_type(base, exponent), np.integer)
+        and np.any(np.asarray(exponent) < 0)):
+        return np.float_power(base, exponent)
+    return np.power(base, exponent)
+
+def _as_objects(value):
+    """returns value as an array of Python objects, so integers in it grow
+    instead of wrapping around"""
+    return np.asarray(value).astype(object)
+
+def _apply_arrays(func, args):
+    """Apply func to arrays. Integer results that don't fit their dtype are
+    computed again with Python ints (an object array), instead of wrapping
+    around
+    func - array function (see _array_funcs), or an operator's func
+    args - arrays, or Python values to broadcast
+    returns the result array"""
+    try:
+        result = func(*args)
+    except OverflowError:
+        # A Python int too big for the dtype of the other operand
+        return func(*[_as_objects(arg) for arg in args])
+    dtype = getattr(result, 'dtype', None)
+    if dtype is None or dtype.kind not in 'iu':
+        return result
+    # Estimate with floats. Within a factor of 2 of overflowing, the estimate
+    # isn't close enough to be sure, so check those exactly
+    info = np.iinfo(dtype)
+    estimate = func(*[np.asarray(arg, dtype=float) for arg in args])
+    if not np.any((estimate < info.min) | (np.abs(estimate) >= 2.0**(info.bits - 2))):
+        return result
+    exact = func(*[_as_objects(arg) for arg in args])
+    try:
+        return np.asarray(exact).astype(dtype)
+    except OverflowError:
+        # Doesn't fit, keep the Python ints
+        return exact
+
+def _apply_scalars(item, args, array_func):
+    """Apply item's func to values that aren't arrays, as MyOp.apply does, so
+    ints are Python ints that grow instead of wrapping around
+    item - MyOp to apply
+    args - its operands' values
+    array_func - used instead for values that process would raise for or make
+    complex, so they're inf or nan like the same rows of an array
+    returns the value"""
+    try:
+        value = item.func(*args)
+    except ArithmeticError:
+        return _apply_arrays(array_func, args)
+    if isinstance(value, complex) and not any(isinstance(arg, complex) for arg in args):
+        return _apply_arrays(array_func, args)
+    return value
+
+# Array function for each of the built-in operators
+_array_funcs = {} if np is None else {Add: np.add,
+                                      Sub: np.subtract,
+                                      Mul: np.multiply,
+                                      Div: np.true_divide,
+                                      Pow: _power,
+                                      Neg: np.negative,
+                                      }
+
+def evaluate_arrays(expr, arrays):
+    """Evaluate expr once over whole arrays of placeholder values
+    expr - an Expression (from operators.compile), the root MyOp of a syntax
+    tree, or the text of an expression
+    arrays - the values for the placeholders (see operators.Placeholder). A dict
+    for named placeholders, or a list for positional ones. Values can be
+    NumPy arrays (or anything np.asarray accepts) of any broadcastable shape
+    returns an array where each element is the value of expr for the
+    corresponding elements of arrays
+    Element-wise, results equal calling process on each row, except:
+        Rows that would raise (ex. division by zero) are inf or nan instead
+        Rows that would give a complex number are nan
+    Parts of expr with no placeholders are applied as process would (ex.
+    "10^20" is an exact int). Integers that don't fit in the dtype of the
+    arrays are Python ints instead, in an array of objects. Rows of those
+    that would raise do raise, like process"""
+    if np is None:
+        raise ImportError("evaluate_arrays requires NumPy")
+    if isinstance(expr, str):
+        expr = compile_expression(expr)
+    tree = expr.tree if isinstance(expr, Expression) else expr
+    if isinstance(arrays, dict):
+        bound = {key: np.asarray(value) for key, value in arrays.items()}
+    else:
+        bound = [np.asarray(value) for value in arrays]
+
+    values = [] # Results of applying each operand, in postorder
+    todo = [tree] # MyOps still to apply, last first. Explicit stack, so deep trees work
+    with np.errstate(all='ignore'): # Bad rows become inf or nan, without warnings
+        while todo:
+            item = todo.pop()
+            if item.__class__ is tuple:
+                # All operands of this MyOp have been applied, apply it
+                item, n = item
+                args = values[-n:]
+                del values[-n:]
+                if isinstance(item, OpenParen):
+                    values.append(args[0]) # Parentheses don't change the value
+                else:
+                    # Fall back to func for other operators, which works if it
+                    # only uses operators NumPy overloads
+                    func = _array_funcs.get(item.__class__, item.func)
+                    if any(isinstance(arg, (np.ndarray, np.generic)) for arg in args):
+                        values.append(_apply_arrays(func, args))
+                    else:
+                        # No placeholders in this subtree
+                        values.append(_apply_scalars(item, args, func))
+            elif not isinstance(item, MyOp):
+                values.append(item)
+            elif isinstance(item, Num):
+                values.append(item.value) # Broadcasts
+            else:
+                operands = item.operands()
+                if operands:
+                    # Apply the operands first, leftmost first
+                    todo.append((item, len(operands)))
+                    todo.extend(reversed(operands))
+                else:
+                    # Placeholder, or another operator with no operands
+                    values.append(item.apply(bound))
+    return values[0]